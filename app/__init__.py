@@ -35,12 +35,53 @@ def create_app(config_name='default'):
             # Log a warning but continue; fallback to default tmp if failed
             print(f"Warning: unable to set custom temp directory {temp_dir}: {e}")
     
+    # Uploads are staged where moving them into storage is a rename
+    from app.utils.blob_store import staging_root
+    staging = staging_root(app.config['UPLOAD_FOLDER'], temp_dir)
+    if temp_dir and staging != temp_dir:
+        print(f"Notice: {temp_dir} is not on the filesystem of {app.config['UPLOAD_FOLDER']}, "
+              f"staging uploads in {staging}")
+    
     # Initialize database
     db = initialize_db(app)
     
     # Initialize Flask-Migrate
     migrate = Migrate(app, db)
     
+    # Limit concurrent uploads and the data they may bring in
+    from app.utils.admission import init_admission
+    init_admission(app)
+    
+    # Workers finishing uploads in the background (Prefer: respond-async)
+    from app.utils.upload_jobs import init_upload_jobs
+    init_upload_jobs(app)
+    
+    # Threads writing the files of multi-file uploads concurrently
+    from app.utils.write_pipeline import init_write_pipeline
+    init_write_pipeline(app)
+    
+    # Token buckets for the bandwidth limits in the system settings
+    from app.utils.bandwidth import init_bandwidth
+    init_bandwidth(app)
+    
+    # Threads compressing folder downloads
+    from app.utils.zip_stream import init_zip_streamer
+    init_zip_streamer(app)
+    
+    # Background writer of download activities (recorded once a body is sent)
+    from app.utils.transfer_tracker import init_transfer_log
+    init_transfer_log(app)
+    
+    # Segment files small uploads are appended to
+    from app.utils.packs import init_pack_store
+    init_pack_store(app)
+    
+    # Reclaim what uploads interrupted by the last shutdown left behind
+    from app.utils.upload_journal import init_upload_journal, run_janitor
+    init_upload_journal(app)
+    with app.app_context():
+        run_janitor()
+    
     # Initialize system monitoring
     SystemMonitor(app, interval=300)  # Monitor every 5 minutes
     
@@ -60,6 +101,10 @@ def create_app(config_name='default'):
     app.register_blueprint(admin_blueprint)
     app.register_blueprint(api_blueprint)
     
+    # Register CLI commands
+    from app.cli import register_commands
+    register_commands(app)
+    
     # Add template globals
     @app.context_processor
     def inject_app_vars():
@@ -0,0 +1,20 @@
+import click
+
+def register_commands(app) -> None:
+    """Register maintenance commands with the flask CLI"""
+
+    @app.cli.command('migrate-storage')
+    @click.option('--dry-run', is_flag=True, help='Only report what would be moved.')
+    @click.option('--batch-size', default=500, show_default=True, help='Rows updated per transaction.')
+    def migrate_storage(dry_run: bool, batch_size: int) -> None:
+        """Move stored files into the sharded blob layout."""
+        from app.utils.blob_store import migrate_storage_layout
+
+        stats = migrate_storage_layout(batch_size=batch_size, dry_run=dry_run)
+        prefix = '[dry run] ' if dry_run else ''
+        click.echo(f"{prefix}Blobs relocated: {stats['blobs_moved']}")
+        click.echo(f"{prefix}Legacy files migrated: {stats['files_migrated']} "
+                   f"({stats['duplicates']} duplicates merged)")
+        click.echo(f"{prefix}Archive checksums computed: {stats['crcs_computed']}")
+        if stats['missing']:
+            click.echo(f"Files missing on disk (left unchanged): {stats['missing']}")
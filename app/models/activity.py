@@ -23,6 +23,8 @@ class Activity(db.Model):
     duration = db.Column(db.Float, nullable=True)  # Duration in seconds
     transfer_speed = db.Column(db.Float, nullable=True)  # Speed in bytes/second
     file_type = db.Column(db.String(50), nullable=True)  # Type of file
+    bytes_sent = db.Column(db.BigInteger, nullable=True)  # Downloads: bytes actually sent, None if sent by the front-end server
+    completed = db.Column(db.Boolean, nullable=True)  # Downloads: whether the client received the whole response
     
     def __init__(self, user_id: int, action: str, target: str = None, details: str = None, ip_address: str = None, 
                  file_size: int = None, duration: float = None, transfer_speed: float = None, file_type: str = None) -> None:
@@ -51,5 +53,7 @@ def to_dict(self) -> dict:
             'file_size': self.file_size,
             'duration': self.duration,
             'transfer_speed': self.transfer_speed,
-            'file_type': self.file_type
+            'file_type': self.file_type,
+            'bytes_sent': self.bytes_sent,
+            'completed': self.completed
         } 
\ No newline at end of file
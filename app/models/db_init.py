@@ -1,16 +1,59 @@
 from app.models.user import User
-from app.models.file import File, Folder
+from app.models.file import File, Folder, Blob
 from app.models.system import SystemMetric, SystemSetting
 from app.models.activity import Activity
+from app.models.upload import UploadSession, UploadChunk, QuotaReservation, UploadJob
 from app.extensions import db
 from werkzeug.security import generate_password_hash
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateColumn
 import os
 
+def upgrade_schema() -> list:
+    """
+    Add the columns models gained since their table was created, and give
+    NOT NULL columns their server default where older rows hold NULL.
+    db.create_all() creates missing tables but leaves existing ones as they
+    are, so databases of older versions would fail on the first query.
+    Safe to run on every start.
+
+    Returns:
+        list: 'table.column' of each column that was added
+    """
+    engine = db.engine
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    preparer = engine.dialect.identifier_preparer
+    added = []
+    with engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            present = {column['name'] for column in inspector.get_columns(table.name)}
+            missing = [column for column in table.columns if column.name not in present]
+            missing_names = {column.name for column in missing}
+            for column in missing:
+                spec = CreateColumn(column).compile(dialect=engine.dialect)
+                connection.execute(text(f'ALTER TABLE {preparer.format_table(table)} ADD COLUMN {spec}'))
+                added.append(f'{table.name}.{column.name}')
+            for index in table.indexes:
+                if any(column.name in missing_names for column in index.columns):
+                    index.create(connection, checkfirst=True)
+            for column in table.columns:
+                if not column.nullable and column.server_default is not None:
+                    # Rows written while the column was still nullable
+                    connection.execute(table.update().where(column.is_(None))
+                                       .values({column.name: text(column.server_default.arg)}))
+    return added
+
 def initialize_db(app):
     db.init_app(app)
     
     with app.app_context():
         db.create_all()
+        added = upgrade_schema()
+        if added:
+            print(f"Notice: added database columns {', '.join(added)}")
         
         # Create default system settings (will insert only if not already present)
         default_settings = [
@@ -22,7 +65,14 @@ def initialize_db(app):
             # Cache-related settings
             SystemSetting(key='enable_cache', value='false', value_type='boolean', description='Enable file caching for previews', is_advanced=False),
             SystemSetting(key='cache_path', value='/tmp/home_cloud_cache', value_type='string', description='Directory path for cache storage', is_advanced=False),
-            SystemSetting(key='direct_write_upload', value='false', value_type='boolean', description='Write uploads directly to target storage without using temp cache', is_advanced=False)
+            # Storage settings
+            SystemSetting(key='storage_compression', value='none', value_type='string', description='Compress text-like files (txt, log, csv, json, source code, ...) when they are stored: none, gzip, lzma or zstd (needs the zstandard package)', is_advanced=True),
+            SystemSetting(key='storage_durability', value='none', value_type='string', description='When stored files reach the disk: none (left to the OS), fsync (each file is flushed before the upload succeeds) or group (files finishing together share one flush)', is_advanced=True),
+            # Bandwidth limits, shared evenly by the transfers they apply to
+            SystemSetting(key='bandwidth_download_limit', value='0', value_type='integer', description='Total download rate of the server (bytes/second, 0 for no limit)', is_advanced=True),
+            SystemSetting(key='bandwidth_upload_limit', value='0', value_type='integer', description='Total upload rate of the server (bytes/second, 0 for no limit)', is_advanced=True),
+            SystemSetting(key='bandwidth_user_download_limit', value='0', value_type='integer', description='Download rate of each user (bytes/second, 0 for no limit)', is_advanced=True),
+            SystemSetting(key='bandwidth_user_upload_limit', value='0', value_type='integer', description='Upload rate of each user (bytes/second, 0 for no limit)', is_advanced=True)
         ]
 
         for setting in default_settings:
@@ -2,6 +2,54 @@
 import os
 from app.models.user import db
 
+class Blob(db.Model):
+    """
+    Stored file content, keyed by its SHA-256. Identical uploads share one
+    blob; the data is removed from disk when the last File referencing it
+    is permanently deleted.
+    """
+    __tablename__ = 'blobs'
+
+    id = db.Column(db.Integer, primary_key=True)
+    sha256 = db.Column(db.String(64), unique=True, nullable=False, index=True)
+    file_path = db.Column(db.String(255), nullable=False)
+    size = db.Column(db.BigInteger, nullable=False)  # Of the content, however it is stored
+    codec = db.Column(db.String(16), nullable=True)  # Compression on disk (see app.utils.compression), None for raw
+    stored_size = db.Column(db.BigInteger, nullable=True)  # Size on disk when compressed or packed
+    pack_offset = db.Column(db.BigInteger, nullable=True)  # Offset in the pack segment at file_path (see app.utils.packs)
+    crc32 = db.Column(db.BigInteger, nullable=True)  # CRC-32 of the content, computed while the upload was written
+    ref_count = db.Column(db.Integer, default=0, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def add_reference(self) -> None:
+        # Increment in SQL so concurrent uploads of the same content don't lose counts
+        Blob.query.filter_by(id=self.id).update({Blob.ref_count: Blob.ref_count + 1}, synchronize_session=False)
+        db.session.refresh(self)
+
+    @property
+    def region(self) -> tuple:
+        """(offset, length) of the data in its pack segment, None if it has a file of its own"""
+        if self.pack_offset is None:
+            return None
+        return self.pack_offset, self.stored_size
+
+    def release(self) -> None:
+        """Drop one reference and delete the data once nothing refers to it"""
+        Blob.query.filter_by(id=self.id).update({Blob.ref_count: Blob.ref_count - 1}, synchronize_session=False)
+        db.session.refresh(self)
+        if self.ref_count > 0:
+            return
+        if self.pack_offset is not None:
+            # Space in a pack segment is reclaimed by compaction
+            db.session.delete(self)
+            return
+        try:
+            if os.path.exists(self.file_path):
+                os.remove(self.file_path)
+        except Exception as e:
+            print(f"Error deleting blob {self.file_path}: {e}")
+        db.session.delete(self)
+
 class File(db.Model):
     __tablename__ = 'files'
     
@@ -18,9 +66,24 @@ class File(db.Model):
     is_deleted = db.Column(db.Boolean, default=False)
     deleted_at = db.Column(db.DateTime, nullable=True)
     expiry_date = db.Column(db.DateTime, nullable=True)  # When this file will be permanently deleted from trash
+    blob_id = db.Column(db.Integer, db.ForeignKey('blobs.id'), nullable=True)  # None for files stored before the blob store
+    sha256 = db.Column(db.String(64), nullable=True, index=True)  # Computed while the upload was written
+    crc32 = db.Column(db.BigInteger, nullable=True)  # Cached for files without a blob (the blob's is used otherwise)
+    
+    blob = db.relationship('Blob')
     
     def get_extension(self) -> str:
         return os.path.splitext(self.original_filename)[1].lower()
+
+    @property
+    def codec(self) -> str:
+        """Compression the content is stored with, None if it is stored raw"""
+        return self.blob.codec if self.blob is not None else None
+
+    @property
+    def region(self) -> tuple:
+        """(offset, length) of the content in a pack segment, None if it has a file of its own"""
+        return self.blob.region if self.blob is not None else None
     
     def to_dict(self) -> dict:
         return {
@@ -28,6 +91,7 @@ def to_dict(self) -> dict:
             'filename': self.original_filename,
             'size': self.size,
             'file_type': self.file_type,
+            'sha256': self.sha256,
             'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S'),
             'updated_at': self.updated_at.strftime('%Y-%m-%d %H:%M:%S'),
             'is_deleted': self.is_deleted,
@@ -65,12 +129,16 @@ def restore_from_trash(self) -> None:
     
     def permanently_delete(self) -> None:
         """Permanently delete the file"""
-        try:
-            if os.path.exists(self.file_path):
-                os.remove(self.file_path)
-        except Exception as e:
-            # Log error but continue with database deletion
-            print(f"Error deleting file {self.file_path}: {e}")
+        if self.blob is not None:
+            # Shared content is only removed with its last reference
+            self.blob.release()
+        else:
+            try:
+                if os.path.exists(self.file_path):
+                    os.remove(self.file_path)
+            except Exception as e:
+                # Log error but continue with database deletion
+                print(f"Error deleting file {self.file_path}: {e}")
         
         db.session.delete(self)
 
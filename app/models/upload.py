@@ -0,0 +1,178 @@
+from datetime import datetime, timedelta
+import json
+import uuid
+from app.models.user import db
+
+class UploadSession(db.Model):
+    """
+    Resumable upload session. Chunks may arrive in any order and over several
+    connections at once; each one is written at its offset into a staging file
+    that is preallocated to the full size, under TEMP_UPLOAD_PATH or, if that is
+    on another filesystem, UPLOAD_FOLDER/.staging. Once every chunk is present
+    the file is renamed into regular storage.
+    """
+    __tablename__ = 'upload_sessions'
+
+    id = db.Column(db.String(32), primary_key=True, default=lambda: uuid.uuid4().hex)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    folder_id = db.Column(db.Integer, db.ForeignKey('folders.id'), nullable=True)
+    filename = db.Column(db.String(255), nullable=False)
+    relative_path = db.Column(db.String(1024), nullable=True)  # Path inside folder uploads
+    total_size = db.Column(db.BigInteger, nullable=False)
+    chunk_size = db.Column(db.Integer, nullable=False)
+    received_size = db.Column(db.BigInteger, default=0)  # Total bytes of all stored chunks
+    staging_path = db.Column(db.String(1024), nullable=False)
+    status = db.Column(db.String(20), default='active')  # active, finalizing, completed, aborted
+    file_id = db.Column(db.Integer, db.ForeignKey('files.id'), nullable=True)
+    reservation_id = db.Column(db.String(32), db.ForeignKey('quota_reservations.id'), nullable=True)
+    job_id = db.Column(db.String(32), db.ForeignKey('upload_jobs.id'), nullable=True)  # Job finalizing the session
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=True)
+
+    reservation = db.relationship('QuotaReservation')
+
+    @property
+    def total_chunks(self) -> int:
+        if self.total_size == 0:
+            return 1
+        return (self.total_size + self.chunk_size - 1) // self.chunk_size
+
+    def received_chunk_indexes(self) -> list[int]:
+        rows = db.session.query(UploadChunk.index).filter_by(session_id=self.id).order_by(UploadChunk.index).all()
+        return [row[0] for row in rows]
+
+    def has_chunk(self, index: int) -> bool:
+        return UploadChunk.query.filter_by(session_id=self.id, index=index).first() is not None
+
+    def received_ranges(self) -> list[list[int]]:
+        """Byte ranges [start, end) the server already has, merged"""
+        if self.status == 'completed':
+            return [[0, self.total_size]]
+        ranges = []
+        for index in self.received_chunk_indexes():
+            start = index * self.chunk_size
+            end = start + self.chunk_length(index)
+            if ranges and ranges[-1][1] == start:
+                ranges[-1][1] = end
+            else:
+                ranges.append([start, end])
+        return ranges
+
+    def next_missing_chunk(self) -> int:
+        """Lowest chunk index not received yet, or None when complete"""
+        if self.status == 'completed':
+            return None
+        expected = 0
+        for index in self.received_chunk_indexes():
+            if index != expected:
+                break
+            expected += 1
+        return expected if expected < self.total_chunks else None
+
+    def chunk_length(self, index: int) -> int:
+        """Expected byte length of the chunk with the given index"""
+        start = index * self.chunk_size
+        return max(min(self.chunk_size, self.total_size - start), 0)
+
+    def is_complete(self) -> bool:
+        if self.total_size == 0:
+            return True
+        return UploadChunk.query.filter_by(session_id=self.id).count() >= self.total_chunks
+
+    def touch(self, ttl_hours: int = 24) -> None:
+        """Push the expiry time forward after activity on the session"""
+        self.expires_at = datetime.utcnow() + timedelta(hours=ttl_hours)
+
+    def to_dict(self, include_ranges: bool = True) -> dict:
+        data = {
+            'id': self.id,
+            'filename': self.filename,
+            'relative_path': self.relative_path,
+            'folder_id': self.folder_id,
+            'total_size': self.total_size,
+            'chunk_size': self.chunk_size,
+            'total_chunks': self.total_chunks,
+            'received_size': self.received_size,
+            'status': self.status,
+            'file_id': self.file_id,
+            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S') if self.created_at else None,
+            'expires_at': self.expires_at.strftime('%Y-%m-%d %H:%M:%S') if self.expires_at else None
+        }
+        if include_ranges:
+            # Listing chunks is proportional to the file size, so chunk
+            # responses leave it out
+            data['received_ranges'] = self.received_ranges()
+            data['next_chunk'] = self.next_missing_chunk()
+        return data
+
+class UploadChunk(db.Model):
+    """A chunk of an upload session that has been written to the staging file"""
+    __tablename__ = 'upload_chunks'
+    __table_args__ = (db.UniqueConstraint('session_id', 'index', name='uq_upload_chunk'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    session_id = db.Column(db.String(32), db.ForeignKey('upload_sessions.id', ondelete='CASCADE'), nullable=False, index=True)
+    index = db.Column(db.Integer, nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class QuotaReservation(db.Model):
+    """
+    Storage quota set aside for an upload in progress. The bytes count towards
+    User.storage_reserved until the upload is recorded (they become
+    storage_used) or fails (they are given back); see app.utils.quota.
+    """
+    __tablename__ = 'quota_reservations'
+
+    id = db.Column(db.String(32), primary_key=True, default=lambda: uuid.uuid4().hex)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False, index=True)
+    size = db.Column(db.BigInteger, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=True)  # None while held by an upload session
+
+class UploadJob(db.Model):
+    """
+    Server-side processing of an upload that continues after the request
+    returned 202: storing received files and writing their records, or
+    hashing and finalizing a resumable session. Live progress is kept in
+    memory by app.utils.upload_jobs; the row holds the final outcome.
+    """
+    __tablename__ = 'upload_jobs'
+
+    id = db.Column(db.String(32), primary_key=True, default=lambda: uuid.uuid4().hex)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False, index=True)
+    kind = db.Column(db.String(20), nullable=False)  # multipart, session
+    status = db.Column(db.String(20), default='queued')  # queued, processing, completed, failed
+    total_files = db.Column(db.Integer, default=0)
+    total_bytes = db.Column(db.BigInteger, default=0)
+    processed_files = db.Column(db.Integer, default=0)
+    processed_bytes = db.Column(db.BigInteger, default=0)
+    files = db.Column(db.Text, nullable=True)  # JSON list of {name, size, status, ...} per file
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    def is_finished(self) -> bool:
+        return self.status in ('completed', 'failed')
+
+    def get_files(self) -> list[dict]:
+        return json.loads(self.files) if self.files else []
+
+    def set_files(self, files: list[dict]) -> None:
+        self.files = json.dumps(files)
+
+    def to_dict(self) -> dict:
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'total_files': self.total_files,
+            'total_bytes': self.total_bytes,
+            'processed_files': self.processed_files,
+            'processed_bytes': self.processed_bytes,
+            'files': self.get_files(),
+            'error': self.error,
+            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S') if self.created_at else None,
+            'finished_at': self.finished_at.strftime('%Y-%m-%d %H:%M:%S') if self.finished_at else None
+        }
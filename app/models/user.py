@@ -13,6 +13,7 @@ class User(db.Model):
     role = db.Column(db.String(20), default='user')  # 'user' or 'admin'
     storage_quota = db.Column(db.BigInteger, default=5 * 1024 * 1024 * 1024)  # 5GB default
     storage_used = db.Column(db.BigInteger, default=0)
+    storage_reserved = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')  # Held by uploads in progress (see app.utils.quota)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     last_login = db.Column(db.DateTime, nullable=True)
     trash_retention_days = db.Column(db.Integer, default=30)  # Default 30 days for trash retention
@@ -47,4 +48,4 @@ def update_storage_used(self) -> int:
     
     def has_space_for_file(self, file_size: int) -> bool:
         """Check if user has enough space for a file of the given size"""
-        return (self.storage_used + file_size) <= self.storage_quota 
\ No newline at end of file
+        return (self.storage_used + self.storage_reserved + file_size) <= self.storage_quota 
\ No newline at end of file
@@ -158,17 +158,14 @@ def delete_user(user_id: int) -> str:
     
     user = User.query.get_or_404(user_id)
     
-    # Delete user's files from storage
+    # Delete user's files from storage and database (shared blobs are kept
+    # while other users still reference them)
     files = File.query.filter_by(user_id=user_id).all()
     for file in files:
-        if os.path.exists(file.file_path):
-            try:
-                os.remove(file.file_path)
-            except:
-                pass
+        file.permanently_delete()
+    db.session.flush()
     
-    # Delete user's records from database
-    File.query.filter_by(user_id=user_id).delete()
+    # Delete user's folders from database
     Folder.query.filter_by(user_id=user_id).delete()
     
     db.session.delete(user)
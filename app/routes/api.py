@@ -1,15 +1,31 @@
-from typing import Callable
+from typing import Callable, Union
 from flask import Blueprint, request, jsonify, session, g
 from app.models.user import db, User
 from app.models.file import File, Folder
+from app.models.upload import QuotaReservation
 from app.models.system import SystemMetric, SystemSetting
 from functools import wraps
 import datetime
 import psutil
 import os
-import uuid
 from werkzeug.utils import secure_filename
 from werkzeug.security import check_password_hash
+from werkzeug.http import parse_options_header
+from app.utils.uploads import (UploadError, declared_digests, get_max_upload_size, get_upload_root_folder,
+                               unique_upload_filename, record_uploaded_file, instant_upload, get_upload_session,
+                               create_upload_session, write_upload_chunk, finalize_upload_session,
+                               abort_upload_session, apply_delta_upload, parse_declared_sizes,
+                               check_upload_request, UploadBatch, queue_upload_batch, queue_upload_session)
+from app.utils.upload_jobs import (prefers_async, get_upload_job, job_status, job_accepted_response,
+                                   job_events_response)
+from app.utils.delta import DEFAULT_BLOCK_SIZE, MIN_BLOCK_SIZE, MAX_BLOCK_SIZE, compute_signature
+from app.utils.multipart_stream import MultipartStreamParser
+from app.utils.storage import STORED_DIGESTS, StorageWriter, SizeLimitExceeded, DigestMismatch
+from app.utils.blob_store import file_sync, new_temp_path, store_blob
+from app.utils.compression import choose_codec, open_content
+from app.utils.quota import QuotaExceeded, reserve_quota, release_reservation
+from app.utils.admission import upload_admission, rejection_response
+from app.utils.bandwidth import shaped_input
 
 api = Blueprint('api', __name__)
 
@@ -157,72 +173,275 @@ def api_create_folder() -> jsonify:
 
 @api.route('/api/files/upload', methods=['POST'])
 @api_login_required
+@upload_admission()
 def api_upload_file() -> jsonify:
     user = g.user
-    folder_id = request.form.get('folder_id', type=int)
     
-    if 'file' not in request.files:
+    mimetype, options = parse_options_header(request.headers.get('Content-Type', ''))
+    boundary = options.get('boundary')
+    if mimetype != 'multipart/form-data' or not boundary:
         return jsonify({'error': 'No file provided'}), 400
     
-    uploaded_file = request.files['file']
-    
-    if uploaded_file.filename == '':
-        return jsonify({'error': 'No file selected'}), 400
-    
     # Get max upload size from settings
-    max_size_setting = SystemSetting.query.filter_by(key='max_upload_size').first()
-    max_size = 1024 * 1024 * 1024  # Default 1GB
-    if max_size_setting:
-        max_size = max_size_setting.get_typed_value()
-    
-    # Check file size
-    uploaded_file.seek(0, os.SEEK_END)
-    file_size = uploaded_file.tell()
-    uploaded_file.seek(0)
-    
-    if file_size > max_size:
-        return jsonify({'error': 'File too large'}), 400
-    
-    # Check if user has enough space
-    if not user.has_space_for_file(file_size):
+    max_size = get_max_upload_size(1024 * 1024 * 1024)  # Default 1GB
+    
+    # Refuse uploads that can't fit before receiving any of the data
+    try:
+        declared_sizes = parse_declared_sizes(request.headers.get('X-File-Sizes'))
+        check_upload_request(user, request.content_length, declared_sizes, max_size, single_file=True)
+    except UploadError as e:
+        return rejection_response(e)
+    
+    # Hold quota for the request before reading it, bounded by the body size
+    try:
+        reservation = reserve_quota(user, request.content_length or user.storage_quota, partial=True)
+        reserved_bytes = reservation.size
+        db.session.commit()
+    except QuotaExceeded:
+        db.session.rollback()
         return jsonify({'error': 'Not enough storage space'}), 400
     
-    # Save file
-    original_filename = secure_filename(uploaded_file.filename)
-    
-    # Generate unique filename to avoid conflicts
-    filename = f"{uuid.uuid4().hex}_{original_filename}"
-    
-    # Create uploads directory if it doesn't exist
-    upload_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'uploads', str(user.id))
-    if not os.path.exists(upload_dir):
-        os.makedirs(upload_dir)
-    
-    file_path = os.path.join(upload_dir, filename)
-    uploaded_file.save(file_path)
-    
-    # Create file record in database
-    from app.routes.files import get_file_type
-    file_type = get_file_type(original_filename)
-    new_file = File(
-        filename=filename,
-        original_filename=original_filename,
-        file_path=file_path,
-        size=file_size,
-        file_type=file_type,
-        user_id=user.id,
-        folder_id=folder_id
-    )
+    # With Prefer: respond-async the file is stored and recorded by a
+    # background job once its data is on disk
+    defer = prefers_async()
+    received = None
+    error = None
+    try:
+        received = _receive_api_upload(user, boundary, max_size, reservation, reserved_bytes, defer,
+                                       declared_sizes[0] if declared_sizes else None)
+    except UploadError as e:
+        error = e
+    
+    if received is None:
+        # Nothing stored, give the reserved quota back
+        db.session.rollback()
+        release_reservation(reservation)
+        db.session.commit()
+        if error is not None:
+            return jsonify({'error': error.message}), error.status_code
+        return jsonify({'error': 'No file provided'}), 400
     
-    db.session.add(new_file)
-    db.session.commit()
+    if defer:
+        job = queue_upload_batch(received, user, reservation)
+        return job_accepted_response(job, 'api.api_upload_job')
     
-    # Update user's storage usage
-    user.storage_used += file_size
     db.session.commit()
     
+    return jsonify({'success': True, 'file': received.to_dict()})
+
+def _receive_api_upload(user: User, boundary: str, max_size: int, reservation: QuotaReservation,
+                        reserved_bytes: int, defer: bool = False,
+                        declared_size: int = None) -> Union[File, UploadBatch]:
+    """
+    Stream the single file part of an API upload into storage, returning its
+    uncommitted File. With defer the file is only written to a temp file and
+    returned in an UploadBatch for a background job to store. A declared_size
+    (from X-File-Sizes) is allocated on disk before the data arrives.
+    """
+    # The body is parsed as it arrives; folder_id must precede the file part
+    # (or be passed as a query argument)
+    form = {}
+    new_file = None
+    batch = None
+    try:
+        for part in MultipartStreamParser(shaped_input(request.stream, user.id), boundary.encode('latin-1')):
+            if part.filename is None:
+                form[part.name] = part.read_text()
+                continue
+            if part.name != 'file' or new_file is not None or batch is not None:
+                continue
+            if not part.filename:
+                raise UploadError('No file selected')
+            
+            folder_id = form.get('folder_id') or request.args.get('folder_id')
+            folder = get_upload_root_folder(user.id, int(folder_id) if folder_id and folder_id.isdigit() else None)
+            if defer:
+                pending = UploadBatch(user, folder)
+                original_filename = pending.unique_filename(folder.id, secure_filename(part.filename))
+            else:
+                original_filename = unique_upload_filename(secure_filename(part.filename), folder.id, user.id)
+            
+            # Size, quota and any Digest/Content-MD5 header on the part are
+            # checked while the data is written
+            try:
+                expected_digests = declared_digests(part.headers)
+                limit = min(max_size, reserved_bytes)
+                with StorageWriter(new_temp_path(), max_size=limit, hash_algorithms=STORED_DIGESTS,
+                                   expected_digests=expected_digests, sync=file_sync(),
+                                   expected_size=min(declared_size, limit) if declared_size else None) as writer:
+                    for data in part:
+                        writer.write(data)
+            except SizeLimitExceeded:
+                if max_size <= reserved_bytes:
+                    raise UploadError('File too large')
+                raise UploadError('Not enough storage space')
+            except DigestMismatch as e:
+                raise UploadError(str(e))
+            
+            if defer:
+                pending.add_file(folder.id, original_filename, writer.path, writer.hexdigest('sha256'), writer.size,
+                                 int(writer.hexdigest('crc32'), 16))
+                batch = pending
+                continue
+            
+            # Store by content so identical uploads share one copy on disk
+            blob = store_blob(writer.path, writer.hexdigest('sha256'), writer.size, choose_codec(original_filename),
+                              crc32=int(writer.hexdigest('crc32'), 16))
+            
+            # Create file record in database and turn the reservation into usage
+            new_file = record_uploaded_file(user, folder, original_filename, blob, reservation=reservation)
+            db.session.flush()
+    except ValueError as e:
+        if batch is not None:
+            batch.discard()
+        raise UploadError(f'Malformed upload: {e}')
+    return batch if defer else new_file
+
+@api.route('/api/files/upload/instant', methods=['POST'])
+@api_login_required
+def api_instant_upload() -> jsonify:
+    user = g.user
+    data = request.get_json(silent=True) or {}
+    entries = data.get('files')
+    if not isinstance(entries, list) or not all(isinstance(entry, dict) for entry in entries):
+        return jsonify({'error': 'files must be a list'}), 400
+    if len(entries) > 1000:
+        return jsonify({'error': 'At most 1000 files per request'}), 400
+
+    results = instant_upload(user, data.get('folder_id'), entries)
+    return jsonify({'success': True, 'results': results})
+
+@api.route('/api/files/<int:file_id>/signature', methods=['GET'])
+@api_login_required
+def api_file_signature(file_id: int) -> jsonify:
+    """Block checksums of a file's current content, for delta uploads"""
+    user = g.user
+    file = File.query.filter_by(id=file_id, user_id=user.id, is_deleted=False).first()
+    if not file:
+        return jsonify({'error': 'File not found'}), 404
+    
+    block_size = request.args.get('block_size', DEFAULT_BLOCK_SIZE, type=int)
+    if not MIN_BLOCK_SIZE <= block_size <= MAX_BLOCK_SIZE:
+        return jsonify({'error': f'block_size must be between {MIN_BLOCK_SIZE} and {MAX_BLOCK_SIZE}'}), 400
+    
+    with open_content(file) as f:
+        signature = compute_signature(f, block_size)
+    if not file.sha256:
+        # Stored before digests were recorded
+        file.sha256 = signature['sha256']
+        db.session.commit()
+    
+    return jsonify({'file_id': file.id, **signature})
+
+@api.route('/api/files/<int:file_id>/delta', methods=['POST'])
+@api_login_required
+@upload_admission()
+def api_apply_delta(file_id: int) -> jsonify:
+    """Update a file from a delta stream against its current content"""
+    user = g.user
+    file = File.query.filter_by(id=file_id, user_id=user.id, is_deleted=False).first()
+    if not file:
+        return jsonify({'error': 'File not found'}), 404
+    
+    try:
+        file, literal_bytes = apply_delta_upload(file, user, shaped_input(request.stream, user.id),
+                                                 request.args.get('base_sha256'), declared_digests(request.headers))
+    except UploadError as e:
+        db.session.rollback()
+        return jsonify({'error': e.message}), e.status_code
+    
+    return jsonify({'success': True, 'file': file.to_dict(), 'transferred': literal_bytes})
+
+@api.route('/api/files/upload/sessions', methods=['POST'])
+@api_login_required
+def api_create_upload_session() -> jsonify:
+    user = g.user
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Expected a JSON object'}), 400
+
+    try:
+        upload_session = create_upload_session(
+            user,
+            folder_id=data.get('folder_id'),
+            filename=data.get('filename'),
+            total_size=data.get('size'),
+            relative_path=data.get('relative_path')
+        )
+    except UploadError as e:
+        return jsonify({'error': e.message}), e.status_code
+
+    return jsonify({'success': True, 'session': upload_session.to_dict()}), 201
+
+@api.route('/api/files/upload/sessions/<session_id>', methods=['GET'])
+@api_login_required
+def api_upload_session_status(session_id: str) -> jsonify:
+    upload_session = get_upload_session(session_id, g.user.id)
+    if not upload_session:
+        return jsonify({'error': 'Upload session not found'}), 404
+
+    return jsonify({'session': upload_session.to_dict()})
+
+@api.route('/api/files/upload/sessions/<session_id>/chunks/<int:index>', methods=['PUT'])
+@api_login_required
+@upload_admission(count_bytes=False)
+def api_upload_session_chunk(session_id: str, index: int) -> jsonify:
+    upload_session = get_upload_session(session_id, g.user.id)
+    if not upload_session:
+        return jsonify({'error': 'Upload session not found'}), 404
+
+    try:
+        upload_session = write_upload_chunk(upload_session, index, shaped_input(request.stream, g.user.id),
+                                            request.content_length or 0, declared_digests(request.headers))
+    except UploadError as e:
+        return jsonify({'error': e.message, 'session': upload_session.to_dict()}), e.status_code
+
+    return jsonify({'success': True, 'session': upload_session.to_dict(include_ranges=False)})
+
+@api.route('/api/files/upload/sessions/<session_id>/complete', methods=['POST'])
+@api_login_required
+@upload_admission(count_bytes=False)
+def api_complete_upload_session(session_id: str) -> jsonify:
+    upload_session = get_upload_session(session_id, g.user.id)
+    if not upload_session:
+        return jsonify({'error': 'Upload session not found'}), 404
+
+    try:
+        if prefers_async() and upload_session.status != 'completed':
+            job = queue_upload_session(upload_session, g.user, declared_digests(request.headers))
+            return job_accepted_response(job, 'api.api_upload_job')
+        new_file = finalize_upload_session(upload_session, g.user, declared_digests(request.headers))
+    except UploadError as e:
+        return jsonify({'error': e.message, 'session': upload_session.to_dict()}), e.status_code
+
     return jsonify({'success': True, 'file': new_file.to_dict()})
 
+@api.route('/api/files/upload/jobs/<job_id>', methods=['GET'])
+@api_login_required
+def api_upload_job_status(job_id: str) -> jsonify:
+    job = get_upload_job(job_id, g.user.id)
+    if not job:
+        return jsonify({'error': 'Upload job not found'}), 404
+    return jsonify({'job': job_status(job)})
+
+@api.route('/api/files/upload/jobs/<job_id>/events', methods=['GET'])
+@api_login_required
+def api_upload_job_events(job_id: str):
+    job = get_upload_job(job_id, g.user.id)
+    if not job:
+        return jsonify({'error': 'Upload job not found'}), 404
+    return job_events_response(job)
+
+@api.route('/api/files/upload/sessions/<session_id>', methods=['DELETE'])
+@api_login_required
+def api_cancel_upload_session(session_id: str) -> jsonify:
+    upload_session = get_upload_session(session_id, g.user.id)
+    if not upload_session:
+        return jsonify({'error': 'Upload session not found'}), 404
+
+    abort_upload_session(upload_session)
+    return jsonify({'success': True})
+
 # Admin API endpoints
 @api.route('/api/admin/users')
 @api_admin_required
@@ -5,73 +5,41 @@
 from app.models.activity import Activity
 from app.routes.auth import login_required
 from werkzeug.utils import secure_filename
+from werkzeug.http import parse_options_header
 import os
 import uuid
 from datetime import datetime
 import mimetypes
-import time
-from flask import after_this_request
 import json
-import zipfile
 import io
-from app.utils.transfer_tracker import TransferSpeedTracker
-import shutil  # 新增，用于磁盘空间检测
+from app.utils.transfer_tracker import DownloadTracker
+from app.utils.file_utils import allowed_file, get_file_type
+from app.utils.multipart_stream import MultipartStreamParser
+from app.utils.storage import STORED_DIGESTS, StorageWriter, SizeLimitExceeded, DigestMismatch, parse_digest_headers
+from app.utils.blob_store import file_sync, new_temp_path, store_blob
+from app.utils.compression import choose_codec, iter_content, send_stored_file
+from app.utils.quota import QuotaExceeded, reserve_quota, release_reservation
+from app.utils.admission import upload_admission, rejection_response
+from app.utils.bandwidth import download_throttle, shape_chunks, shaped_input
+from app.utils.zip_stream import StoredArchive, ZipEntry, get_zip_streamer, send_archive, stored_member
+from app.utils.write_pipeline import get_write_pipeline
+from app.utils.uploads import (UploadError, declared_digests, get_max_upload_size, get_upload_root_folder,
+                               record_uploaded_file, instant_upload, UploadBatch, parse_declared_sizes,
+                               check_upload_request,
+                               get_upload_session, create_upload_session, write_upload_chunk,
+                               finalize_upload_session, abort_upload_session, queue_upload_batch,
+                               queue_upload_session)
+from app.utils.upload_jobs import (prefers_async, get_upload_job, job_status, job_accepted_response,
+                                   job_events_response)
 
 files = Blueprint('files', __name__)
 
-def allowed_file(filename):
-    # Get allowed file types from system settings
-    allowed_types_setting = SystemSetting.query.filter_by(key='allowed_file_types').first()
-    if allowed_types_setting:
-        allowed_types = allowed_types_setting.get_typed_value()
-        if allowed_types == '*':
-            return True
-        
-        allowed_extensions = set(allowed_types.split(','))
-        return '.' in filename and \
-               filename.rsplit('.', 1)[1].lower() in allowed_extensions
-    
-    # Default allowed extensions if setting not found
-    return '.' in filename
-
-def get_file_type(filename):
-    extension = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
-    mime_type, _ = mimetypes.guess_type(filename)
-    
-    # Categorize files
-    if mime_type:
-        if mime_type.startswith('image/'):
-            return 'image'
-        elif mime_type.startswith('video/'):
-            return 'video'
-        elif mime_type.startswith('audio/'):
-            return 'audio'
-        elif mime_type.startswith('text/'):
-            return 'document'
-        elif mime_type == 'application/pdf':
-            return 'document'
-        elif 'spreadsheet' in mime_type or 'excel' in mime_type:
-            return 'spreadsheet'
-        elif 'presentation' in mime_type or 'powerpoint' in mime_type:
-            return 'presentation'
-        elif mime_type.startswith('application/'):
-            return 'application'
-    
-    # Based on extension
-    if extension in ['zip', 'rar', '7z', 'tar', 'gz']:
-        return 'archive'
-    
-    return 'other'
-
-def get_free_space(path):
-    """Return free space (in bytes) for the disk containing the given path"""
+def _form_int(value):
+    """Convert a streamed form value to int, or None"""
     try:
-        usage = shutil.disk_usage(path)
-        return usage.free
-    except Exception as e:
-        print(f"Error getting free space for {path}: {e}")
-        # 如果无法获取，返回0表示空间不足
-        return 0
+        return int(value)
+    except (TypeError, ValueError):
+        return None
 
 @files.route('/files')
 @login_required
@@ -118,227 +86,186 @@ def index():
 
 @files.route('/files/upload', methods=['POST'])
 @login_required
+@upload_admission()
 def upload_file():
-    """Handle file upload, supporting both regular file and folder uploads"""
+    """Handle file upload, supporting both regular file and folder uploads
+
+    The multipart body is parsed while it arrives and every file part is written
+    straight to its final storage path, so each uploaded byte is written to disk
+    once. Form fields (folder_id, is_folder_upload) must precede the file parts;
+    they may also be passed as query arguments.
+    """
     user_id = session.get('user_id')
-    is_folder_upload = request.form.get('is_folder_upload') == 'true'
-    folder_id = request.form.get('folder_id', type=int)
     
-    if not request.files.getlist('files[]'):
+    mimetype, options = parse_options_header(request.headers.get('Content-Type', ''))
+    boundary = options.get('boundary')
+    if mimetype != 'multipart/form-data' or not boundary:
         flash('No files selected for upload', 'warning')
         return redirect(url_for('files.index'))
     
-    # Get current folder
-    current_folder = None
-    if folder_id:
-        current_folder = Folder.query.filter_by(id=folder_id, user_id=user_id).first()
-    if not current_folder:
-        current_folder = Folder.query.filter_by(user_id=user_id, parent_id=None).first()
-        if not current_folder:
-            current_folder = Folder(name='root', user_id=user_id)
-            db.session.add(current_folder)
-            db.session.commit()
+    form = {
+        'folder_id': request.args.get('folder_id'),
+        'is_folder_upload': request.args.get('is_folder_upload')
+    }
+    
+    # Free disk space was checked by upload_admission against the whole body
+    content_length = request.content_length or 0
     
     # Get max upload size from settings
-    max_size_setting = SystemSetting.query.filter_by(key='max_upload_size').first()
-    max_size = int(max_size_setting.value) if max_size_setting else 2000 * 1024 * 1024 * 1024  # Default 2TB
+    max_size = get_max_upload_size()
     
     # Get user info
     user = User.query.get(user_id)
     
-    # Dictionary to keep track of created folders
-    created_folders = {}
+    # Refuse uploads that can't fit before receiving any of the data
+    try:
+        declared_sizes = parse_declared_sizes(request.headers.get('X-File-Sizes'))
+        check_upload_request(user, request.content_length, declared_sizes, max_size)
+    except UploadError as e:
+        return rejection_response(e)
+    
+    # Hold quota for the whole request before reading it; the body size is an
+    # upper bound of what can be stored. Parallel uploads see the reservation.
+    try:
+        reservation = reserve_quota(user, content_length or user.storage_quota, partial=True)
+        reserved_bytes = reservation.size
+        db.session.commit()
+    except QuotaExceeded:
+        db.session.rollback()
+        flash('Not enough storage space', 'danger')
+        return redirect(url_for('files.index', folder_id=form['folder_id']))
+    
+    # Folder lookups, name checks and row inserts for the whole request are
+    # batched; the batch is created once the target folder is known
+    batch = None
+    received_files = 0
     uploaded_count = 0
     error_count = 0
+    quota_exhausted = False
     
-    def direct_save_file(file_obj, save_path):
-        """Directly save file to target location without using temporary storage"""
-        try:
-            with open(save_path, 'wb') as f:
-                while True:
-                    chunk = file_obj.read(8192)  # Read in 8KB chunks
-                    if not chunk:
-                        break
-                    f.write(chunk)
-            return True
-        except Exception as e:
-            print(f"Error in direct_save_file: {str(e)}")
-            return False
-    
-    # Determine if we should force direct write based on system setting
-    direct_write_setting = SystemSetting.query.filter_by(key='direct_write_upload').first()
-    force_direct_write = False
-    if direct_write_setting:
-        try:
-            force_direct_write = bool(direct_write_setting.get_typed_value())
-        except Exception:
-            force_direct_write = False
-
-    # Process each uploaded file
-    for uploaded_file in request.files.getlist('files[]'):
-        if not uploaded_file.filename:
-            continue
-        
-        try:
-            # Get the relative path for folder uploads
-            relative_path = uploaded_file.filename
-            
-            # Handle folder structure
-            parent_folder = current_folder
-            if is_folder_upload and '/' in relative_path:
-                # Split path into folder parts
-                path_parts = relative_path.split('/')
-                filename = path_parts.pop()  # Last part is the filename
-                
-                # Create folder structure
-                current_path = ""
-                for folder_name in path_parts:
-                    if not folder_name:  # Skip empty folder names
-                        continue
-                    
-                    # Build current path for folder tracking
-                    current_path = os.path.join(current_path, folder_name) if current_path else folder_name
-                    
-                    # Check if we've already created this folder
-                    if current_path in created_folders:
-                        parent_folder = created_folders[current_path]
-                    else:
-                        # Check for existing folder
-                        existing_folder = Folder.query.filter_by(
-                            name=folder_name,
-                            parent_id=parent_folder.id,
-                            user_id=user_id,
-                            is_deleted=False
-                        ).first()
-                        
-                        if existing_folder:
-                            parent_folder = existing_folder
-                        else:
-                            # Create new folder
-                            new_folder = Folder(
-                                name=folder_name,
-                                parent_id=parent_folder.id,
-                                user_id=user_id
-                            )
-                            db.session.add(new_folder)
-                            db.session.flush()  # Get the ID without committing
-                            parent_folder = new_folder
-                        
-                        created_folders[current_path] = parent_folder
-            else:
-                filename = os.path.basename(relative_path)
-            
-            # Check if file with same name exists
-            existing_file = File.query.filter_by(
-                original_filename=filename,
-                folder_id=parent_folder.id,
-                user_id=user_id,
-                is_deleted=False
-            ).first()
-            
-            if existing_file:
-                # Add timestamp to make filename unique
-                name_parts = os.path.splitext(filename)
-                timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-                filename = f"{name_parts[0]}_{timestamp}{name_parts[1]}"
-            
-            # Check file type
-            if not allowed_file(filename):
-                flash(f'File type not allowed: {filename}', 'danger')
-                error_count += 1
+    # File data is written and hashed by the write pipeline while the next
+    # part is parsed; results are collected once the body has been read
+    pipeline = get_write_pipeline()
+    pending_writes = []
+    pending_bytes = 0
+    sync = file_sync()
+    
+    try:
+        for part in MultipartStreamParser(shaped_input(request.stream, user_id), boundary.encode('latin-1')):
+            if part.filename is None:
+                # Regular form field
+                form[part.name] = part.read_text()
                 continue
             
-            # Get file size
-            uploaded_file.seek(0, os.SEEK_END)
-            file_size = uploaded_file.tell()
-            uploaded_file.seek(0)
-            
-            # Check file size
-            if file_size > max_size:
-                flash(f'File too large: {filename}', 'danger')
-                error_count += 1
+            if part.name != 'files[]' or not part.filename:
                 continue
+            received_files += 1
             
-            # Check user quota
-            if not user.has_space_for_file(file_size):
-                flash('Not enough storage space', 'danger')
+            if quota_exhausted:
+                # Skip the remaining files, the parser drains their data
                 error_count += 1
-                break
-            
-            # Generate unique filename for storage
-            storage_filename = f"{uuid.uuid4().hex}_{secure_filename(filename)}"
+                continue
             
-            # Create folder structure in storage if needed
-            folder_path = os.path.join(current_app.config['UPLOAD_FOLDER'], str(parent_folder.id))
-            if not os.path.exists(folder_path):
-                os.makedirs(folder_path)
+            # The target folder is known once the leading form fields were read
+            if batch is None:
+                current_folder = get_upload_root_folder(user_id, _form_int(form.get('folder_id')))
+                batch = UploadBatch(user, current_folder)
+            is_folder_upload = form.get('is_folder_upload') == 'true'
             
-            save_path = os.path.join(folder_path, storage_filename)
+            # Get the relative path for folder uploads
+            relative_path = part.filename
             
-            # Decide whether to use temp cache or direct write
-            use_temp_cache = False
-            if not force_direct_write:
-                temp_dir = current_app.config.get('TEMP_UPLOAD_PATH')
-                if temp_dir and os.path.isdir(temp_dir):
-                    free_space = get_free_space(temp_dir)
-                    if free_space >= file_size + 10 * 1024 * 1024:  # 保留10MB余量
-                        use_temp_cache = True
-
             try:
-                if use_temp_cache:
-                    # 使用本地缓存目录
-                    tmp_path = os.path.join(temp_dir, storage_filename)
-                    uploaded_file.save(tmp_path)
-                    shutil.move(tmp_path, save_path)
-                else:
-                    # 直接写入目标存储
-                    if not direct_save_file(uploaded_file, save_path):
-                        raise Exception('direct_save_file failed')
-
-                # Create file record
-                file_type = get_file_type(filename)
-                new_file = File(
-                    filename=storage_filename,
-                    original_filename=filename,
-                    file_path=save_path,
-                    size=file_size,
-                    file_type=file_type,
-                    user_id=user_id,
-                    folder_id=parent_folder.id
-                )
+                # Handle folder structure
+                parent_folder, filename = batch.resolve(relative_path, is_folder_upload)
                 
-                db.session.add(new_file)
+                # Check if file with same name exists
+                filename = batch.unique_filename(parent_folder, filename)
                 
-                # Update user storage quota
-                user.storage_used += file_size
+                # Check file type
+                if not batch.allowed_file(filename):
+                    flash(f'File type not allowed: {filename}', 'danger')
+                    error_count += 1
+                    continue
                 
-                # Log activity
-                activity = Activity(
-                    user_id=user_id,
-                    action='upload',
-                    target=filename,
-                    details=f'Uploaded to folder {parent_folder.name}',
-                    file_size=file_size,
-                    file_type=file_type
-                )
-                db.session.add(activity)
+                # Size and quota are enforced while the data streams in
+                remaining_quota = max(reserved_bytes - pending_bytes, 0)
+                limit = min(max_size, remaining_quota)
                 
-                uploaded_count += 1
+                # Data is hashed as it is written, checked against any
+                # Digest/Content-MD5 header on the part, then stored by content
+                # Files whose size the client declared get their space allocated up front
+                declared_size = declared_sizes[received_files - 1] if received_files <= len(declared_sizes) else None
+                writer = pipeline.open(new_temp_path(), max_size=limit, hash_algorithms=STORED_DIGESTS,
+                                       expected_digests=parse_digest_headers(part.headers),
+                                       expected_size=min(declared_size, limit) if declared_size else None,
+                                       sync=sync)
+                try:
+                    for data in part:
+                        writer.write(data)
+                except SizeLimitExceeded:
+                    writer.abort()
+                    if max_size <= remaining_quota:
+                        flash(f'File too large: {filename}', 'danger')
+                    else:
+                        flash('Not enough storage space', 'danger')
+                        quota_exhausted = True
+                    error_count += 1
+                    continue
+                except Exception:
+                    writer.abort()
+                    raise
+                
+                writer.finish()
+                pending_writes.append((writer, parent_folder, filename))
+                pending_bytes += writer.size
             except Exception as e:
-                print(f"Error saving file {filename}: {str(e)}")
+                print(f"Error saving file {relative_path}: {str(e)}")
                 error_count += 1
                 continue
-            
-        except Exception as e:
-            print(f"Error processing file {uploaded_file.filename}: {str(e)}")
+    except ValueError as e:
+        # Malformed or truncated body (e.g. client disconnected)
+        print(f"Error parsing upload stream: {str(e)}")
+        error_count += 1
+    
+    # Queue the files in the order they arrived once their writes are done
+    for writer, parent_folder, filename in pending_writes:
+        writer.wait()
+        if isinstance(writer.error, DigestMismatch):
+            flash(f'Checksum mismatch, file corrupted in transfer: {filename}', 'danger')
             error_count += 1
-            continue
+        elif writer.error is not None:
+            print(f"Error saving file {filename}: {str(writer.error)}")
+            error_count += 1
+        else:
+            batch.add_file(parent_folder, filename, writer.path, writer.hexdigest('sha256'), writer.size,
+                           int(writer.hexdigest('crc32'), 16))
+    
+    if received_files == 0:
+        release_reservation(reservation)
+        db.session.commit()
+        flash('No files selected for upload', 'warning')
+        return redirect(url_for('files.index'))
     
-    # Commit all changes
+    # Store the blobs and insert the folder, file and activity rows in bulk,
+    # sharing content that is already stored instead of keeping it twice
     try:
+        if batch is not None and len(batch) and prefers_async():
+            # The data is on disk; storing and recording it continues in the
+            # background while the client follows the job
+            job = queue_upload_batch(batch, user, reservation)
+            return job_accepted_response(job, 'files.upload_job', failed=error_count)
+        if batch is not None:
+            uploaded_count = batch.flush(reservation)
+        else:
+            release_reservation(reservation)
         db.session.commit()
     except Exception as e:
         db.session.rollback()
+        if batch is not None:
+            batch.discard()
+        release_reservation(reservation)
+        db.session.commit()
         print(f"Error committing changes: {str(e)}")
         flash('Error saving files to database', 'danger')
         return redirect(url_for('files.index'))
@@ -351,7 +278,120 @@ def direct_save_file(file_obj, save_path):
     else:
         flash(f'All {uploaded_count} files uploaded successfully', 'success')
     
-    return redirect(url_for('files.index', folder_id=folder_id))
+    return redirect(url_for('files.index', folder_id=_form_int(form.get('folder_id'))))
+
+@files.route('/files/upload/instant', methods=['POST'])
+@login_required
+def instant_upload_files():
+    """Add files the user already has stored, identified by SHA-256 and size"""
+    user = User.query.get(session.get('user_id'))
+    data = request.get_json(silent=True) or {}
+    entries = data.get('files')
+    if not isinstance(entries, list) or not all(isinstance(entry, dict) for entry in entries):
+        return jsonify({'error': 'files must be a list'}), 400
+    if len(entries) > 1000:
+        return jsonify({'error': 'At most 1000 files per request'}), 400
+
+    results = instant_upload(user, data.get('folder_id'), entries)
+    return jsonify({'success': True, 'results': results})
+
+@files.route('/files/upload/sessions', methods=['POST'])
+@login_required
+def start_upload_session():
+    """Open a resumable chunked upload session"""
+    user = User.query.get(session.get('user_id'))
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Expected a JSON object'}), 400
+
+    try:
+        upload_session = create_upload_session(
+            user,
+            folder_id=data.get('folder_id'),
+            filename=data.get('filename'),
+            total_size=data.get('size'),
+            relative_path=data.get('relative_path')
+        )
+    except UploadError as e:
+        return jsonify({'error': e.message}), e.status_code
+
+    return jsonify({'success': True, 'session': upload_session.to_dict()}), 201
+
+@files.route('/files/upload/sessions/<session_id>', methods=['GET'])
+@login_required
+def upload_session_status(session_id):
+    """Report how much of a resumable upload the server already has"""
+    upload_session = get_upload_session(session_id, session.get('user_id'))
+    if not upload_session:
+        return jsonify({'error': 'Upload session not found'}), 404
+    return jsonify({'session': upload_session.to_dict()})
+
+@files.route('/files/upload/sessions/<session_id>/chunks/<int:index>', methods=['PUT'])
+@login_required
+@upload_admission(count_bytes=False)
+def upload_session_chunk(session_id, index):
+    """Store one numbered chunk of a resumable upload"""
+    upload_session = get_upload_session(session_id, session.get('user_id'))
+    if not upload_session:
+        return jsonify({'error': 'Upload session not found'}), 404
+
+    try:
+        upload_session = write_upload_chunk(upload_session, index,
+                                            shaped_input(request.stream, session.get('user_id')),
+                                            request.content_length or 0, declared_digests(request.headers))
+    except UploadError as e:
+        return jsonify({'error': e.message, 'session': upload_session.to_dict()}), e.status_code
+
+    return jsonify({'success': True, 'session': upload_session.to_dict(include_ranges=False)})
+
+@files.route('/files/upload/sessions/<session_id>/complete', methods=['POST'])
+@login_required
+@upload_admission(count_bytes=False)
+def complete_upload_session(session_id):
+    """Finalize a resumable upload once every chunk has been received"""
+    user = User.query.get(session.get('user_id'))
+    upload_session = get_upload_session(session_id, user.id)
+    if not upload_session:
+        return jsonify({'error': 'Upload session not found'}), 404
+
+    try:
+        if prefers_async() and upload_session.status != 'completed':
+            job = queue_upload_session(upload_session, user, declared_digests(request.headers))
+            return job_accepted_response(job, 'files.upload_job')
+        new_file = finalize_upload_session(upload_session, user, declared_digests(request.headers))
+    except UploadError as e:
+        return jsonify({'error': e.message, 'session': upload_session.to_dict()}), e.status_code
+
+    return jsonify({'success': True, 'file': new_file.to_dict()})
+
+@files.route('/files/upload/jobs/<job_id>', methods=['GET'])
+@login_required
+def upload_job_status(job_id):
+    """Report the server-side progress of an upload accepted with 202"""
+    job = get_upload_job(job_id, session.get('user_id'))
+    if not job:
+        return jsonify({'error': 'Upload job not found'}), 404
+    return jsonify({'job': job_status(job)})
+
+@files.route('/files/upload/jobs/<job_id>/events', methods=['GET'])
+@login_required
+def upload_job_events(job_id):
+    """Stream the progress of an upload job as server-sent events"""
+    job = get_upload_job(job_id, session.get('user_id'))
+    if not job:
+        return jsonify({'error': 'Upload job not found'}), 404
+    return job_events_response(job)
+
+@files.route('/files/upload/sessions/<session_id>', methods=['DELETE'])
+@login_required
+def cancel_upload_session(session_id):
+    """Abort a resumable upload and discard its staged data"""
+    upload_session = get_upload_session(session_id, session.get('user_id'))
+    if not upload_session:
+        return jsonify({'error': 'Upload session not found'}), 404
+
+    abort_upload_session(upload_session)
+    return jsonify({'success': True})
 
 @files.route('/files/download/<int:file_id>')
 @login_required
@@ -361,39 +401,18 @@ def download_file(file_id):
     user_id = session.get('user_id')
     file = File.query.filter_by(id=file_id, user_id=user_id, is_deleted=False).first_or_404()
     
-    # Record activity upfront (duration and speed to be filled after response)
-    activity = Activity(
-        user_id=user_id,
-        action='download',
-        target=file.original_filename,
-        file_size=file.size,
-        file_type=file.file_type
-    )
-    db.session.add(activity)
-    db.session.commit()
-
-    start_time = time.time()
-
-    @after_this_request
-    def update_metrics(response):
-        duration = max(time.time() - start_time, 0.0001)  # avoid division by zero
-        speed = file.size / duration
-        activity.duration = duration
-        activity.transfer_speed = speed
-        db.session.commit()
-        return response
-
     # Determine mime type from filename for better browser handling
     mime_type, _ = mimetypes.guess_type(file.original_filename)
     if mime_type is None:
         mime_type = 'application/octet-stream'
 
-    response = send_file(
-        file.file_path,
-        mimetype=mime_type,
-        as_attachment=True,
-        download_name=file.original_filename
-    )
+    # The activity is recorded once the body has been sent, with the bytes
+    # and time the transfer actually took
+    tracker = DownloadTracker(user_id, 'download', file.original_filename, file.size, file.file_type)
+
+    # Compressed files are decompressed on the fly or sent with Content-Encoding
+    response = send_stored_file(file, mime_type, as_attachment=True, on_close=tracker.finish,
+                                throttle=download_throttle(user_id))
     # Ensure Content-Disposition includes both filename and filename* (UTF-8)
     from urllib.parse import quote
     ascii_filename = secure_filename(file.original_filename)
@@ -401,7 +420,7 @@ def update_metrics(response):
         ascii_filename = 'download'
     disposition = f"attachment; filename=\"{ascii_filename}\"; filename*=UTF-8''{quote(file.original_filename)}"
     response.headers['Content-Disposition'] = disposition
-    return response
+    return tracker.watch(response)
 
 @files.route('/files/trash')
 @login_required
@@ -1075,8 +1094,10 @@ def mark_subfolders_deleted(parent_id):
 @files.route('/files/download_folder/<int:folder_id>')
 @login_required
 def download_folder(folder_id):
-    """Stream a folder as ZIP without waiting for full compression."""
-    import zipstream  # lazily import to avoid overhead if never used
+    """
+    Stream a folder as ZIP without waiting for full compression. With
+    ?mode=store the archive is uncompressed and can be resumed with Range.
+    """
     user_id = session.get('user_id')
     folder = Folder.query.filter_by(id=folder_id, user_id=user_id, is_deleted=False).first_or_404()
 
@@ -1086,7 +1107,7 @@ def iter_folder_files(cur_folder, path_in_zip=""):
         files = File.query.filter_by(folder_id=cur_folder.id, user_id=user_id, is_deleted=False).all()
         for f in files:
             arc = os.path.join(path_in_zip, f.original_filename)
-            yield f.file_path, arc, f.size, f.file_type
+            yield f, arc
         # subfolders
         subfolders = Folder.query.filter_by(parent_id=cur_folder.id, user_id=user_id, is_deleted=False).all()
         for sub in subfolders:
@@ -1094,34 +1115,39 @@ def iter_folder_files(cur_folder, path_in_zip=""):
             # even if folder empty, ZipStream will include parent paths automatically when files present
             yield from iter_folder_files(sub, sub_path)
 
-    # Stream zip
-    z = zipstream.ZipFile(mode='w', compression=zipfile.ZIP_DEFLATED)
-
-    total_size = 0
-    for file_path, arcname, fsize, ftype in iter_folder_files(folder):
-        total_size += fsize
-        z.write(file_path, arcname)
+    folder_files = list(iter_folder_files(folder))
+    total_size = sum(f.size for f, _ in folder_files)
 
     timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
     download_name = f"{folder.name}_{timestamp}.zip"
 
-    # Log activity (size pre-zip)
-    activity = Activity(
-        user_id=user_id,
-        action='download_folder',
-        target=folder.name,
-        file_size=total_size,
-        details='Streamed folder as zip'
-    )
-    db.session.add(activity)
-    db.session.commit()
-
     from urllib.parse import quote
     ascii_name = secure_filename(download_name) or 'download.zip'
     disposition = f"attachment; filename=\"{ascii_name}\"; filename*=UTF-8''{quote(download_name)}"
 
+    if request.args.get('mode') == 'store':
+        # Uncompressed ZIP64 laid out up front: exact Content-Length and Range
+        # support, so download managers can resume it or fetch it in parallel
+        archive = StoredArchive([stored_member(f, arcname) for f, arcname in folder_files])
+        db.session.commit()  # CRCs computed for the layout
+        tracker = DownloadTracker(user_id, 'download_folder', folder.name, total_size,
+                                  details='Streamed folder as stored zip')
+        response = send_archive(archive, disposition, on_close=tracker.finish,
+                                throttle=download_throttle(user_id))
+        return tracker.watch(response)
+
+    # Stream zip; already compressed types are stored, the rest deflated in parallel
+    entries = [ZipEntry(arcname, iter_content(f), size=f.size, modified=f.updated_at)
+               for f, arcname in folder_files]
+
+    # Recorded once the archive has been sent, with the bytes that went out
+    tracker = DownloadTracker(user_id, 'download_folder', folder.name, total_size,
+                              details='Streamed folder as zip')
+    # Shaped whenever a download limit is set, also one set while it streams
+    body = shape_chunks(get_zip_streamer().stream(entries), download_throttle(user_id))
+
     return Response(
-        z,  # zipstream is iterable
+        tracker.stream(body),
         mimetype='application/zip',
         headers={
             'Content-Disposition': disposition,
@@ -1220,11 +1246,11 @@ def raw_file(file_id):
     file = File.query.filter_by(id=file_id, user_id=user_id, is_deleted=False).first_or_404()
 
     # Determine MIME type for correct rendering in browser
-    mime_type, _ = mimetypes.guess_type(file.file_path)
+    mime_type, _ = mimetypes.guess_type(file.original_filename)
     if mime_type is None:
         mime_type = 'application/octet-stream'
 
-    return send_file(file.file_path, mimetype=mime_type, as_attachment=False, download_name=file.original_filename)
+    return send_stored_file(file, mime_type, throttle=download_throttle(user_id))
 
 
 @files.route('/files/preview/<int:file_id>')
@@ -1238,6 +1264,7 @@ def preview_file(file_id):
 
 @files.route('/files/remote_download', methods=['POST'])
 @login_required
+@upload_admission()
 def remote_download():
     """Download a remote file directly into the user's cloud storage."""
     import requests
@@ -1317,55 +1344,49 @@ def remote_download():
                 timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
                 filename = f"{name_prefix}_{timestamp}{ext}"
 
-            # Prepare storage path
-            storage_filename = f"{uuid.uuid4().hex}_{secure_filename(filename)}"
-            folder_path = os.path.join(current_app.config['UPLOAD_FOLDER'], str(current_folder.id))
-            os.makedirs(folder_path, exist_ok=True)
-            save_path = os.path.join(folder_path, storage_filename)
-
-            # Write stream to file
-            with open(save_path, 'wb') as f:
+            # Verify the server's own checksum headers when the body is not
+            # content-encoded (requests decodes it, so the digest wouldn't match)
+            expected_digests = {}
+            if not r.headers.get('Content-Encoding'):
+                try:
+                    expected_digests = parse_digest_headers(r.headers)
+                except ValueError:
+                    pass
+
+            # Write stream to storage, hashing as it arrives. Content-Length
+            # is the stored size unless requests decodes the body
+            with StorageWriter(new_temp_path(), hash_algorithms=STORED_DIGESTS, expected_digests=expected_digests,
+                               expected_size=None if r.headers.get('Content-Encoding') else file_size,
+                               sync=file_sync()) as writer:
                 for chunk in r.iter_content(chunk_size=8192):
                     if chunk:
-                        f.write(chunk)
+                        writer.write(chunk)
 
         # Final size if not known before
         if not file_size:
-            file_size = os.path.getsize(save_path)
+            file_size = writer.size
             # Re-check quota edge case
             user = User.query.get(user_id)
             if not user.has_space_for_file(file_size):
-                os.remove(save_path)
+                writer.abort()
                 flash('Not enough storage space', 'danger')
                 return redirect(url_for('files.index'))
 
-        # Record file in DB
-        file_type = get_file_type(filename)
-        new_file = File(
-            filename=storage_filename,
-            original_filename=filename,
-            file_path=save_path,
-            size=file_size,
-            file_type=file_type,
-            user_id=user_id,
-            folder_id=current_folder.id
-        )
-        db.session.add(new_file)
-        user.storage_used += file_size
-
-        # Activity log
-        activity = Activity(
-            user_id=user_id,
-            action='remote_download',
-            target=filename,
-            file_size=file_size,
-            file_type=file_type,
-            details=f'Downloaded from {file_url}'
-        )
-        db.session.add(activity)
+        # Record file in DB and log activity; the quota is charged atomically
+        # in case another upload used it up during the download
+        blob = store_blob(writer.path, writer.hexdigest('sha256'), writer.size, choose_codec(filename),
+                          crc32=int(writer.hexdigest('crc32'), 16))
+        record_uploaded_file(user, current_folder, filename, blob, action='remote_download',
+                             details=f'Downloaded from {file_url}')
         db.session.commit()
 
         flash('File downloaded successfully', 'success')
+    except QuotaExceeded:
+        db.session.rollback()
+        flash('Not enough storage space', 'danger')
+    except DigestMismatch as e:
+        print(f"Remote download checksum error: {e}")
+        flash('Downloaded file failed checksum verification', 'danger')
     except Exception as e:
         print(f"Remote download error: {e}")
         flash('Failed to download file', 'danger')
@@ -0,0 +1,133 @@
+// Web Worker that computes the SHA-256 of a File for instant uploads
+//
+// crypto.subtle.digest() needs the whole input in memory at once, which is not
+// an option for multi-gigabyte files, so this is an incremental SHA-256 that
+// reads the file block by block. Posts {loaded} progress messages while
+// hashing and {sha256} (hex) or {error} when done.
+
+const READ_BLOCK_SIZE = 4 * 1024 * 1024; // 4MB
+
+const K = new Int32Array([
+    0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
+    0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
+    0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+    0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
+    0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13, 0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
+    0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+    0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
+    0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208, 0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2
+]);
+
+class Sha256 {
+    constructor() {
+        this.state = new Int32Array([
+            0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a, 0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19
+        ]);
+        this.words = new Int32Array(64);
+        this.pending = new Uint8Array(64);
+        this.pendingLength = 0;
+        this.bytesHashed = 0;
+    }
+
+    update(data) {
+        let pos = 0;
+        const length = data.length;
+        this.bytesHashed += length;
+
+        // Complete a block left over from the previous update
+        if (this.pendingLength > 0) {
+            while (this.pendingLength < 64 && pos < length) {
+                this.pending[this.pendingLength++] = data[pos++];
+            }
+            if (this.pendingLength === 64) {
+                this.compress(this.pending, 0);
+                this.pendingLength = 0;
+            }
+        }
+        while (length - pos >= 64) {
+            this.compress(data, pos);
+            pos += 64;
+        }
+        while (pos < length) {
+            this.pending[this.pendingLength++] = data[pos++];
+        }
+    }
+
+    compress(bytes, offset) {
+        const w = this.words;
+        for (let i = 0; i < 16; i++) {
+            const j = offset + i * 4;
+            w[i] = (bytes[j] << 24) | (bytes[j + 1] << 16) | (bytes[j + 2] << 8) | bytes[j + 3];
+        }
+        for (let i = 16; i < 64; i++) {
+            const x = w[i - 15];
+            const y = w[i - 2];
+            const s0 = ((x >>> 7) | (x << 25)) ^ ((x >>> 18) | (x << 14)) ^ (x >>> 3);
+            const s1 = ((y >>> 17) | (y << 15)) ^ ((y >>> 19) | (y << 13)) ^ (y >>> 10);
+            w[i] = (((w[i - 16] + s0) | 0) + ((w[i - 7] + s1) | 0)) | 0;
+        }
+
+        const state = this.state;
+        let a = state[0], b = state[1], c = state[2], d = state[3];
+        let e = state[4], f = state[5], g = state[6], h = state[7];
+        for (let i = 0; i < 64; i++) {
+            const S1 = ((e >>> 6) | (e << 26)) ^ ((e >>> 11) | (e << 21)) ^ ((e >>> 25) | (e << 7));
+            const ch = (e & f) ^ (~e & g);
+            const t1 = (((((h + S1) | 0) + ch) | 0) + ((K[i] + w[i]) | 0)) | 0;
+            const S0 = ((a >>> 2) | (a << 30)) ^ ((a >>> 13) | (a << 19)) ^ ((a >>> 22) | (a << 10));
+            const maj = (a & b) ^ (a & c) ^ (b & c);
+            const t2 = (S0 + maj) | 0;
+            h = g;
+            g = f;
+            f = e;
+            e = (d + t1) | 0;
+            d = c;
+            c = b;
+            b = a;
+            a = (t1 + t2) | 0;
+        }
+        state[0] = (state[0] + a) | 0;
+        state[1] = (state[1] + b) | 0;
+        state[2] = (state[2] + c) | 0;
+        state[3] = (state[3] + d) | 0;
+        state[4] = (state[4] + e) | 0;
+        state[5] = (state[5] + f) | 0;
+        state[6] = (state[6] + g) | 0;
+        state[7] = (state[7] + h) | 0;
+    }
+
+    hexDigest() {
+        // Padding: 0x80, zeros, then the message length in bits (64-bit big endian)
+        const bitsHigh = Math.floor(this.bytesHashed / 0x20000000);
+        const bitsLow = (this.bytesHashed % 0x20000000) * 8;
+        const padLength = (this.pendingLength < 56 ? 56 : 120) - this.pendingLength;
+        const padding = new Uint8Array(padLength + 8);
+        padding[0] = 0x80;
+        const view = new DataView(padding.buffer);
+        view.setUint32(padLength, bitsHigh);
+        view.setUint32(padLength + 4, bitsLow);
+        const bytesHashed = this.bytesHashed;
+        this.update(padding);
+        this.bytesHashed = bytesHashed;
+
+        return Array.from(this.state, word => (word >>> 0).toString(16).padStart(8, '0')).join('');
+    }
+}
+
+async function hashFile(file) {
+    const sha256 = new Sha256();
+    for (let offset = 0; offset < file.size; offset += READ_BLOCK_SIZE) {
+        const block = await file.slice(offset, offset + READ_BLOCK_SIZE).arrayBuffer();
+        sha256.update(new Uint8Array(block));
+        self.postMessage({loaded: Math.min(offset + READ_BLOCK_SIZE, file.size)});
+    }
+    return sha256.hexDigest();
+}
+
+self.onmessage = async function(e) {
+    try {
+        self.postMessage({sha256: await hashFile(e.data.file)});
+    } catch (err) {
+        self.postMessage({error: err.message});
+    }
+};
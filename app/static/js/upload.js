@@ -1,211 +1,588 @@
 // File upload handling with progress tracking
+//
+// Small files are sent together in one multipart POST. Files at or above
+// CHUNKED_UPLOAD_THRESHOLD go through a resumable upload session: the file is
+// sent as numbered chunks over several parallel requests, and after a dropped
+// connection (or a page reload) only the chunks the server is missing are sent.
+//
+// Before any of that, files of INSTANT_UPLOAD_MIN_SIZE and above are hashed in a
+// Web Worker; content the user already has on the server is added without
+// transferring it again ("instant upload").
+//
+// Uploads are sent with "Prefer: respond-async": once the data is on the server
+// it answers 202 with an upload job, and storing the files continues there.
+// Its progress is followed over server-sent events, or by polling.
 document.addEventListener('DOMContentLoaded', function() {
     const uploadForm = document.getElementById('uploadForm');
-    const fileInput = document.getElementById('file');
-    const uploadModal = document.getElementById('uploadModal');
-    const uploadProgressContainer = document.getElementById('uploadProgressContainer');
-    const uploadBtn = document.getElementById('uploadBtn');
-    
-    if (!uploadForm || !fileInput) return;
-    
-    // Create bootstrap modal instance if it exists
-    const uploadModalInstance = uploadModal ? new bootstrap.Modal(uploadModal) : null;
-    
-    uploadForm.addEventListener('submit', function(e) {
+    if (!uploadForm) return;
+
+    const CHUNKED_UPLOAD_THRESHOLD = 64 * 1024 * 1024; // 64MB
+    const MAX_CHUNK_RETRIES = 8;
+    const MAX_BUSY_WAITS = 60; // Times to wait out a "server busy" answer (Retry-After)
+    const MAX_SIZES_HEADER_LENGTH = 4096;
+    const PARALLEL_CHUNKS = 4;
+    const INSTANT_UPLOAD_MIN_SIZE = 1024 * 1024; // 1MB
+    const INSTANT_UPLOAD_BATCH = 500;
+    const JOB_POLL_INTERVAL = 1000; // ms, when server-sent events are unavailable
+
+    const uploadButton = document.getElementById('uploadButton');
+    const uploadingFiles = document.getElementById('uploadingFiles');
+    const fileProgressBar = document.getElementById('fileProgressBar');
+    const totalProgressBar = document.getElementById('totalProgressBar');
+    const currentFileName = document.getElementById('currentFileName');
+    const uploadSpeed = document.getElementById('uploadSpeed');
+    const uploadedCount = document.getElementById('uploadedCount');
+    const filesInput = document.getElementById('files');
+    const folderInput = document.getElementById('folder');
+    const filesTab = document.getElementById('files-tab');
+    const folderTab = document.getElementById('folder-tab');
+
+    const uploadUrl = uploadForm.getAttribute('action');
+    const sessionsUrl = uploadForm.dataset.sessionsUrl;
+    const folderId = uploadForm.dataset.folderId;
+    const instantUrl = uploadForm.dataset.instantUrl;
+    const hashWorkerUrl = uploadForm.dataset.hashWorkerUrl;
+
+    uploadForm.addEventListener('submit', async function(e) {
         e.preventDefault();
-        
-        const files = fileInput.files;
-        if (files.length === 0) return;
-        
-        // Show upload modal if exists
-        if (uploadModalInstance) {
-            uploadModalInstance.show();
-        }
-        
-        // Clear previous upload progress
-        if (uploadProgressContainer) {
-            uploadProgressContainer.innerHTML = '';
-        }
-        
-        const formData = new FormData(uploadForm);
-        const xhr = new XMLHttpRequest();
-        
-        // Time tracking for speed calculation
-        let startTime = Date.now();
-        let lastTime = Date.now();
-        let lastLoaded = 0;
-        let uploadSpeed = 0;
-        let updateInterval;
-        
-        // Create progress elements for each file
-        Array.from(files).forEach(file => {
-            const progressDiv = document.createElement('div');
-            progressDiv.classList.add('upload-progress');
-            progressDiv.id = `progress-${file.name.replace(/[^a-zA-Z0-9]/g, '_')}`;
-            
-            // File info
-            const fileDiv = document.createElement('div');
-            fileDiv.classList.add('file-uploading');
-            
-            const fileName = document.createElement('div');
-            fileName.classList.add('file-name');
-            fileName.textContent = file.name;
-            fileDiv.appendChild(fileName);
-            
-            const fileSize = document.createElement('div');
-            fileSize.classList.add('file-size');
-            fileSize.textContent = formatFileSize(file.size);
-            fileDiv.appendChild(fileSize);
-            
-            progressDiv.appendChild(fileDiv);
-            
-            // Speed display
-            const speedDisplay = document.createElement('div');
-            speedDisplay.classList.add('upload-speed');
-            speedDisplay.textContent = 'Calculating...';
-            progressDiv.appendChild(speedDisplay);
-            
-            // Progress bar
-            const progressBar = document.createElement('div');
-            progressBar.classList.add('progress');
-            
-            const progressBarInner = document.createElement('div');
-            progressBarInner.classList.add('progress-bar', 'progress-bar-striped', 'progress-bar-animated');
-            progressBarInner.setAttribute('role', 'progressbar');
-            progressBarInner.setAttribute('aria-valuenow', '0');
-            progressBarInner.setAttribute('aria-valuemin', '0');
-            progressBarInner.setAttribute('aria-valuemax', '100');
-            progressBarInner.style.width = '0%';
-            
-            progressBar.appendChild(progressBarInner);
-            progressDiv.appendChild(progressBar);
-            
-            if (uploadProgressContainer) {
-                uploadProgressContainer.appendChild(progressDiv);
+
+        const isFolderUpload = folderTab.classList.contains('active');
+        const files = Array.from(isFolderUpload ? folderInput.files : filesInput.files);
+
+        if (files.length === 0) {
+            alert('Please select files to upload');
+            return;
+        }
+
+        uploadButton.disabled = true;
+        uploadingFiles.classList.remove('d-none');
+
+        const progress = createProgressTracker(files);
+
+        try {
+            const remaining = await uploadInstant(files, isFolderUpload, progress);
+            const smallFiles = remaining.filter(file => file.size < CHUNKED_UPLOAD_THRESHOLD);
+            const largeFiles = remaining.filter(file => file.size >= CHUNKED_UPLOAD_THRESHOLD);
+
+            if (smallFiles.length > 0) {
+                await withBusyRetry(() => uploadMultipart(smallFiles, isFolderUpload, progress));
             }
-        });
-        
-        xhr.upload.addEventListener('progress', function(e) {
-            if (e.lengthComputable) {
-                const percentComplete = Math.round((e.loaded / e.total) * 100);
-                
-                // Update all progress bars
-                const progressBars = document.querySelectorAll('.progress-bar');
-                progressBars.forEach(bar => {
-                    bar.style.width = percentComplete + '%';
-                    bar.setAttribute('aria-valuenow', percentComplete);
+            for (const file of largeFiles) {
+                const relativePath = isFolderUpload ? file.webkitRelativePath : null;
+                await uploadResumable(file, relativePath, progress);
+            }
+            window.location.reload();
+        } catch (err) {
+            showAlert('danger', 'Upload failed: ' + err.message);
+            uploadButton.disabled = false;
+        } finally {
+            progress.stop();
+        }
+    });
+
+    // Add files whose content is already stored without uploading them, and
+    // return the files that still have to be sent
+    async function uploadInstant(files, isFolderUpload, progress) {
+        const candidates = files.filter(file => file.size >= INSTANT_UPLOAD_MIN_SIZE);
+        if (candidates.length === 0 || !instantUrl || !window.Worker) {
+            return files;
+        }
+
+        const hashes = await hashFiles(candidates);
+        const hashed = candidates.filter(file => hashes.has(file));
+        const stored = new Set();
+
+        for (let start = 0; start < hashed.length; start += INSTANT_UPLOAD_BATCH) {
+            const batch = hashed.slice(start, start + INSTANT_UPLOAD_BATCH);
+            let data;
+            try {
+                data = await jsonRequest('POST', instantUrl, {
+                    folder_id: folderId,
+                    files: batch.map(file => ({
+                        filename: file.name,
+                        relative_path: isFolderUpload ? file.webkitRelativePath : null,
+                        size: file.size,
+                        sha256: hashes.get(file)
+                    }))
                 });
-                
-                // Calculate upload speed
-                const currentTime = Date.now();
-                const timeDiff = (currentTime - lastTime) / 1000; // Convert to seconds
-                
-                if (timeDiff > 0) {
-                    // Calculate speed in bytes per second
-                    const bytesDiff = e.loaded - lastLoaded;
-                    uploadSpeed = bytesDiff / timeDiff;
-                    
-                    // Update speed display
-                    const speedDisplays = document.querySelectorAll('.upload-speed');
-                    speedDisplays.forEach(display => {
-                        display.textContent = `Upload speed: ${formatFileSize(uploadSpeed)}/s`;
-                    });
-                    
-                    // Update for next calculation
-                    lastLoaded = e.loaded;
-                    lastTime = currentTime;
+            } catch (err) {
+                // Fall back to uploading the files normally
+                break;
+            }
+            data.results.forEach((result, i) => {
+                if (result.instant) {
+                    stored.add(batch[i]);
+                    progress.update(batch[i], batch[i].size);
                 }
+            });
+        }
+        return files.filter(file => !stored.has(file));
+    }
+
+    // Hash files one after another in a Web Worker; files that fail are left out
+    function hashFiles(files) {
+        return new Promise(resolve => {
+            const hashes = new Map();
+            let worker;
+            try {
+                worker = new Worker(hashWorkerUrl);
+            } catch (err) {
+                resolve(hashes);
+                return;
             }
+
+            let index = 0;
+            const next = () => {
+                if (index >= files.length) {
+                    worker.terminate();
+                    resolve(hashes);
+                    return;
+                }
+                currentFileName.textContent = `Checking ${files[index].name}…`;
+                worker.postMessage({file: files[index]});
+            };
+            worker.onmessage = function(e) {
+                const file = files[index];
+                if (e.data.loaded !== undefined) {
+                    const percent = file.size > 0 ? Math.round(e.data.loaded / file.size * 100) : 100;
+                    currentFileName.textContent = `Checking ${file.name}… ${percent}%`;
+                    return;
+                }
+                if (e.data.sha256) {
+                    hashes.set(file, e.data.sha256);
+                }
+                index++;
+                next();
+            };
+            worker.onerror = function() {
+                worker.terminate();
+                resolve(hashes);
+            };
+            next();
         });
-        
-        xhr.addEventListener('load', function() {
-            if (xhr.status === 200) {
-                // Upload completed successfully
-                const response = JSON.parse(xhr.responseText);
-                
-                // Show success message
-                showAlert('success', 'Files uploaded successfully!');
-                
-                // Close modal after short delay
-                setTimeout(() => {
-                    if (uploadModalInstance) {
-                        uploadModalInstance.hide();
-                    }
-                    
-                    // Reload the file list if we're on the files page
-                    if (window.location.pathname.includes('/files')) {
-                        window.location.reload();
-                    }
-                }, 1000);
-            } else {
-                // Upload failed
-                showAlert('danger', 'Upload failed: ' + xhr.statusText);
+    }
+
+    // Send small files in a single multipart request
+    function uploadMultipart(files, isFolderUpload, progress) {
+        return new Promise((resolve, reject) => {
+            const formData = new FormData();
+            formData.append('folder_id', folderId);
+            formData.append('is_folder_upload', isFolderUpload ? 'true' : 'false');
+
+            // For folder upload, use webkitRelativePath to preserve structure
+            files.forEach(file => {
+                formData.append('files[]', file, isFolderUpload ? file.webkitRelativePath : file.name);
+            });
+
+            const xhr = new XMLHttpRequest();
+            xhr.open('POST', uploadUrl, true);
+            xhr.setRequestHeader('Prefer', 'respond-async');
+            // Lets the server refuse files that are too large or over quota
+            // before the body is sent (skipped if the header would get too long
+            // for proxies)
+            const sizes = files.map(file => file.size).join(',');
+            if (sizes.length <= MAX_SIZES_HEADER_LENGTH) {
+                xhr.setRequestHeader('X-File-Sizes', sizes);
             }
-            
-            // Reset form and input
-            uploadForm.reset();
-            clearInterval(updateInterval);
+            progress.setCurrent(files.length === 1 ? files[0] : null, files.length === 1 ? files[0].name : `${files.length} files`);
+
+            xhr.upload.onprogress = function(e) {
+                if (e.lengthComputable) {
+                    // Spread progress over the batch proportionally
+                    const ratio = e.loaded / e.total;
+                    files.forEach(file => progress.update(file, file.size * ratio));
+                    if (ratio >= 1) {
+                        currentFileName.textContent = 'Processing on server side. Please wait…';
+                    }
+                }
+            };
+            xhr.onload = function() {
+                if (xhr.status === 202) {
+                    resolve(waitForJob(JSON.parse(xhr.responseText), progress));
+                    return;
+                }
+                if (xhr.status === 200) {
+                    resolve();
+                    return;
+                }
+                let data = {};
+                try {
+                    data = JSON.parse(xhr.responseText);
+                } catch (parseErr) {
+                    // Non-JSON error page
+                }
+                const err = new Error(data.error || xhr.statusText || 'Server error');
+                err.retryAfter = retryAfterSeconds(xhr);
+                reject(err);
+            };
+            xhr.onerror = () => reject(new Error('Network error'));
+            xhr.send(formData);
         });
-        
-        xhr.addEventListener('error', function() {
-            showAlert('danger', 'Upload failed. Please try again.');
-            clearInterval(updateInterval);
+    }
+
+    // Upload one large file through a resumable session
+    async function uploadResumable(file, relativePath, progress) {
+        const resumeKey = `upload-session:${folderId}:${relativePath || file.name}:${file.size}:${file.lastModified}`;
+        progress.setCurrent(file, file.name);
+
+        let uploadSession = await restoreSession(resumeKey);
+        if (!uploadSession) {
+            const created = await jsonRequest('POST', sessionsUrl, {
+                filename: file.name,
+                size: file.size,
+                folder_id: folderId,
+                relative_path: relativePath
+            });
+            uploadSession = created.session;
+            localStorage.setItem(resumeKey, uploadSession.id);
+        }
+
+        // Workers pull missing chunks off a shared queue, so up to
+        // PARALLEL_CHUNKS chunks of this file are in flight at once
+        const pending = missingChunks(uploadSession);
+        const inFlight = new Map();
+        let confirmed = uploadSession.received_size;
+        const report = () => {
+            let loaded = confirmed;
+            inFlight.forEach(value => { loaded += value; });
+            progress.update(file, loaded);
+        };
+        report();
+
+        async function worker() {
+            while (pending.length > 0) {
+                const index = pending.shift();
+                try {
+                    await sendChunkWithRetry(file, uploadSession, index, loaded => {
+                        inFlight.set(index, loaded);
+                        report();
+                    });
+                } catch (err) {
+                    // Stop the other workers from picking up more chunks
+                    pending.length = 0;
+                    throw err;
+                }
+                inFlight.delete(index);
+                confirmed += Math.min(uploadSession.chunk_size, file.size - index * uploadSession.chunk_size);
+                report();
+            }
+        }
+        const workers = [];
+        for (let i = 0; i < Math.min(PARALLEL_CHUNKS, pending.length); i++) {
+            workers.push(worker());
+        }
+        await Promise.all(workers);
+
+        const completed = await withBusyRetry(() => jsonRequest(
+            'POST', `${sessionsUrl}/${uploadSession.id}/complete`, undefined, {'Prefer': 'respond-async'}
+        ));
+        if (completed.job) {
+            await waitForJob(completed, progress);
+        }
+        localStorage.removeItem(resumeKey);
+        progress.update(file, file.size);
+    }
+
+    // Resume a session left over from an earlier attempt, if it is still usable
+    async function restoreSession(resumeKey) {
+        const sessionId = localStorage.getItem(resumeKey);
+        if (!sessionId) return null;
+        try {
+            const data = await jsonRequest('GET', `${sessionsUrl}/${sessionId}`);
+            if (data.session.status === 'active') {
+                return data.session;
+            }
+        } catch (err) {
+            // Session expired or was removed on the server
+        }
+        localStorage.removeItem(resumeKey);
+        return null;
+    }
+
+    // Chunk indexes not yet covered by the session's received byte ranges
+    function missingChunks(uploadSession) {
+        const received = new Set();
+        (uploadSession.received_ranges || []).forEach(([start, end]) => {
+            for (let offset = start; offset < end; offset += uploadSession.chunk_size) {
+                received.add(Math.floor(offset / uploadSession.chunk_size));
+            }
         });
-        
-        xhr.addEventListener('abort', function() {
-            showAlert('warning', 'Upload aborted.');
-            clearInterval(updateInterval);
+        const missing = [];
+        for (let index = 0; index < uploadSession.total_chunks; index++) {
+            if (!received.has(index)) missing.push(index);
+        }
+        return missing;
+    }
+
+    async function sendChunkWithRetry(file, uploadSession, index, onProgress) {
+        const start = index * uploadSession.chunk_size;
+        const chunk = file.slice(start, Math.min(start + uploadSession.chunk_size, file.size));
+
+        let busyWaits = 0;
+        for (let attempt = 0; ; ) {
+            try {
+                return await sendChunk(uploadSession, index, chunk, onProgress);
+            } catch (err) {
+                onProgress(0);
+                if (err.retryAfter && busyWaits < MAX_BUSY_WAITS) {
+                    // Refused before the chunk was stored; come back when asked to
+                    busyWaits++;
+                    currentFileName.textContent = `Server busy, waiting to continue ${file.name}…`;
+                    await sleep(err.retryAfter * 1000);
+                    currentFileName.textContent = file.name;
+                    continue;
+                }
+                if (err.fatal || attempt >= MAX_CHUNK_RETRIES) {
+                    throw err;
+                }
+                attempt++;
+                currentFileName.textContent = `Connection lost, retrying ${file.name}…`;
+                // Re-sending a chunk the server already stored is harmless
+                await sleep(Math.min(1000 * Math.pow(2, attempt - 1), 30000));
+                currentFileName.textContent = file.name;
+            }
+        }
+    }
+
+    // Repeat a request while the server answers "busy" with a Retry-After
+    async function withBusyRetry(send) {
+        for (let busyWaits = 0; ; busyWaits++) {
+            try {
+                return await send();
+            } catch (err) {
+                if (!err.retryAfter || busyWaits >= MAX_BUSY_WAITS) {
+                    throw err;
+                }
+                currentFileName.textContent = 'Server busy, waiting to upload…';
+                await sleep(err.retryAfter * 1000);
+            }
+        }
+    }
+
+    // Seconds from a Retry-After header (delta-seconds form), or null
+    function retryAfterSeconds(xhr) {
+        const seconds = parseInt(xhr.getResponseHeader('Retry-After'), 10);
+        return seconds > 0 ? seconds : null;
+    }
+
+    function sendChunk(uploadSession, index, chunk, onProgress) {
+        return new Promise((resolve, reject) => {
+            const xhr = new XMLHttpRequest();
+            xhr.open('PUT', `${sessionsUrl}/${uploadSession.id}/chunks/${index}`, true);
+            xhr.setRequestHeader('Content-Type', 'application/octet-stream');
+            xhr.setRequestHeader('X-Requested-With', 'XMLHttpRequest');
+
+            xhr.upload.onprogress = function(e) {
+                if (e.lengthComputable) {
+                    onProgress(e.loaded);
+                }
+            };
+            xhr.onload = function() {
+                let data = {};
+                try {
+                    data = JSON.parse(xhr.responseText);
+                } catch (parseErr) {
+                    // Non-JSON error page
+                }
+                if (xhr.status === 200) {
+                    resolve(data.session);
+                    return;
+                }
+                const err = new Error(data.error || xhr.statusText || 'Server error');
+                err.retryAfter = retryAfterSeconds(xhr);
+                // 4xx responses will not succeed on retry
+                err.fatal = xhr.status >= 400 && xhr.status < 500;
+                reject(err);
+            };
+            xhr.onerror = () => reject(new Error('Network error'));
+            xhr.send(chunk);
         });
-        
-        xhr.open('POST', uploadForm.getAttribute('action'), true);
-        xhr.send(formData);
-        
-        // Update speed display every 500ms instead of 1000ms for smoother updates
-        updateInterval = setInterval(() => {
-            const speedDisplays = document.querySelectorAll('.upload-speed');
-            speedDisplays.forEach(display => {
-                if (uploadSpeed < 1) {
-                    display.textContent = `Upload speed: 0 B/s`;
+    }
+
+    // Follow an upload job the server accepted with 202 until it has finished
+    function waitForJob(accepted, progress) {
+        progress.showJob(accepted.job);
+        return new Promise((resolve, reject) => {
+            const settle = job => {
+                progress.showJob(job);
+                if (job.status === 'completed') {
+                    resolve(job);
+                } else if (job.status === 'failed') {
+                    reject(new Error(job.error || 'Processing failed on the server'));
                 } else {
-                    display.textContent = `Upload speed: ${formatFileSize(uploadSpeed)}`;
+                    return false;
                 }
-            });
+                return true;
+            };
+
+            const poll = async () => {
+                try {
+                    while (true) {
+                        const data = await jsonRequest('GET', accepted.status_url);
+                        if (settle(data.job)) return;
+                        await sleep(JOB_POLL_INTERVAL);
+                    }
+                } catch (err) {
+                    reject(err);
+                }
+            };
+
+            if (!window.EventSource) {
+                poll();
+                return;
+            }
+            const source = new EventSource(accepted.events_url);
+            source.onmessage = function(e) {
+                if (settle(JSON.parse(e.data))) {
+                    source.close();
+                }
+            };
+            source.onerror = function() {
+                // Stream cut off (e.g. by a proxy); carry on by polling
+                source.close();
+                poll();
+            };
+        });
+    }
+
+    async function jsonRequest(method, url, body, headers) {
+        const options = {
+            method: method,
+            credentials: 'same-origin',
+            headers: Object.assign({'X-Requested-With': 'XMLHttpRequest'}, headers)
+        };
+        if (body !== undefined) {
+            options.headers['Content-Type'] = 'application/json';
+            options.body = JSON.stringify(body);
+        }
+        const response = await fetch(url, options);
+        const data = await response.json().catch(() => ({}));
+        if (!response.ok) {
+            const err = new Error(data.error || response.statusText);
+            const retryAfter = parseInt(response.headers.get('Retry-After'), 10);
+            err.retryAfter = retryAfter > 0 ? retryAfter : null;
+            throw err;
+        }
+        return data;
+    }
+
+    function sleep(ms) {
+        return new Promise(resolve => setTimeout(resolve, ms));
+    }
+
+    // Aggregate byte progress across all selected files
+    function createProgressTracker(files) {
+        const totalBytes = files.reduce((sum, file) => sum + file.size, 0) || 1;
+        const loadedByFile = new Map();
+        let currentFile = null;
+        let lastLoaded = 0;
+        let lastTime = Date.now();
+
+        uploadedCount.textContent = `Uploading ${files.length} files`;
+
+        // Update speed display every 500ms for smoother updates
+        const timer = setInterval(() => {
+            const loaded = totalLoaded();
+            const now = Date.now();
+            const seconds = (now - lastTime) / 1000;
+            if (seconds > 0) {
+                uploadSpeed.textContent = formatSpeed((loaded - lastLoaded) / seconds);
+            }
+            lastLoaded = loaded;
+            lastTime = now;
         }, 500);
+
+        function totalLoaded() {
+            let sum = 0;
+            loadedByFile.forEach(value => { sum += value; });
+            return sum;
+        }
+
+        function setBar(bar, percent) {
+            bar.style.width = percent + '%';
+            bar.textContent = Math.round(percent) + '%';
+            bar.setAttribute('aria-valuenow', Math.round(percent));
+        }
+
+        return {
+            // Show a single file on the upper bar, or mirror the total for batches
+            setCurrent(file, label) {
+                currentFile = file;
+                currentFileName.textContent = label;
+            },
+            update(file, loaded) {
+                loadedByFile.set(file, loaded);
+                const totalPercent = Math.min(totalLoaded() / totalBytes * 100, 100);
+                setBar(totalProgressBar, totalPercent);
+                if (currentFile === null) {
+                    setBar(fileProgressBar, totalPercent);
+                } else if (currentFile === file) {
+                    setBar(fileProgressBar, file.size > 0 ? Math.min(loaded / file.size * 100, 100) : 100);
+                }
+            },
+            // Server-side progress of an upload job, on the upper bar
+            showJob(job) {
+                const percent = job.total_bytes > 0
+                    ? job.processed_bytes / job.total_bytes * 100
+                    : job.processed_files / Math.max(job.total_files, 1) * 100;
+                currentFile = null;
+                currentFileName.textContent = `Processing on server: ${job.processed_files} of ${job.total_files} files`;
+                setBar(fileProgressBar, Math.min(percent, 100));
+            },
+            stop() {
+                clearInterval(timer);
+            }
+        };
+    }
+
+    // Handle tab switching
+    filesTab.addEventListener('click', function() {
+        filesInput.value = '';
+        uploadButton.disabled = false;
+        uploadingFiles.classList.add('d-none');
+    });
+
+    folderTab.addEventListener('click', function() {
+        folderInput.value = '';
+        uploadButton.disabled = false;
+        uploadingFiles.classList.add('d-none');
     });
-    
-    // Helper function to format file size
-    function formatFileSize(bytes) {
-        if (bytes === 0) return '0 B/s';
-        
-        const k = 1024;
-        const sizes = ['B', 'KB', 'MB', 'GB'];
-        
-        // For very small values, display bytes directly
-        if (bytes < 1) return '0 B/s';
-        
-        const i = Math.floor(Math.log(bytes) / Math.log(k));
-        return parseFloat((bytes / Math.pow(k, i)).toFixed(2)) + ' ' + sizes[i] + '/s';
-    }
-    
+
+    // Format speed function
+    function formatSpeed(bytesPerSecond) {
+        if (bytesPerSecond < 0.1) {
+            return '0 KB/s';
+        } else if (bytesPerSecond >= 1073741824) {
+            return (bytesPerSecond / 1073741824).toFixed(2) + ' GB/s';
+        } else if (bytesPerSecond >= 1048576) {
+            return (bytesPerSecond / 1048576).toFixed(2) + ' MB/s';
+        } else {
+            return (bytesPerSecond / 1024).toFixed(2) + ' KB/s';
+        }
+    }
+
     // Helper function to show alerts
     function showAlert(type, message) {
         const alertDiv = document.createElement('div');
         alertDiv.classList.add('alert', `alert-${type}`, 'alert-dismissible', 'fade', 'show', 'mt-3');
         alertDiv.setAttribute('role', 'alert');
-        
-        alertDiv.innerHTML = `
-            ${message}
-            <button type="button" class="btn-close" data-bs-dismiss="alert" aria-label="Close"></button>
-        `;
-        
+
+        alertDiv.textContent = message;
+        const closeButton = document.createElement('button');
+        closeButton.type = 'button';
+        closeButton.classList.add('btn-close');
+        closeButton.setAttribute('data-bs-dismiss', 'alert');
+        closeButton.setAttribute('aria-label', 'Close');
+        alertDiv.appendChild(closeButton);
+
         // Find a good place to show the alert
-        const container = document.querySelector('.content') || document.body;
+        const container = document.querySelector('.content') || document.querySelector('main') || document.body;
         container.insertBefore(alertDiv, container.firstChild);
-        
+
         // Auto-dismiss after 5 seconds
         setTimeout(() => {
             alertDiv.classList.remove('show');
             setTimeout(() => alertDiv.remove(), 150);
         }, 5000);
     }
-}); 
\ No newline at end of file
+});
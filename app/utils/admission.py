@@ -0,0 +1,200 @@
+"""
+Admission control for uploads.
+
+Every upload request takes a slot before its body is read: at most
+UPLOAD_MAX_CONCURRENT_PER_USER per user and UPLOAD_MAX_CONCURRENT in total.
+Requests that bring new data also count their declared size as in-flight
+bytes, which must fit in the free space of UPLOAD_FOLDER (minus
+UPLOAD_MIN_FREE_SPACE) together with everything already being uploaded.
+Requests that don't fit are refused straight away with 429 (busy, retry
+later) or 507 (no space) instead of failing halfway through the body.
+
+The state lives in the process; each worker process of a multi-process
+server enforces the limits on its own.
+"""
+import shutil
+import threading
+import time
+from functools import wraps
+from typing import Callable
+from flask import current_app, g, jsonify, request, session
+
+class AdmissionRejected(Exception):
+    """Raised when an upload can't be admitted right now"""
+
+    def __init__(self, message: str, status_code: int, retry_after: int = None) -> None:
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+class DiskSpaceSampler:
+    """
+    Free space of the filesystem holding path, sampled at most once per
+    interval seconds instead of a statvfs call for every request
+    """
+
+    def __init__(self, path: str, interval: float = 2.0) -> None:
+        self.path = path
+        self.interval = interval
+        self._free = 0
+        self._sampled_at = None
+        self._lock = threading.Lock()
+
+    def free(self) -> tuple[int, bool]:
+        """
+        Returns:
+            tuple: (free bytes, whether a new sample was just taken)
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self._sampled_at is not None and now - self._sampled_at < self.interval:
+                return self._free, False
+            try:
+                self._free = shutil.disk_usage(self.path).free
+            except Exception as e:
+                print(f"Error getting free space for {self.path}: {e}")
+                self._free = 0
+            self._sampled_at = now
+            return self._free, True
+
+class UploadAdmission:
+    """Slots and in-flight bytes of the uploads currently being received"""
+
+    def __init__(self, sampler: DiskSpaceSampler, max_per_user: int = 6, max_total: int = 32,
+                 min_free_space: int = 0, retry_after: int = 5) -> None:
+        self.sampler = sampler
+        self.max_per_user = max_per_user
+        self.max_total = max_total
+        self.min_free_space = min_free_space
+        self.retry_after = retry_after
+        self._lock = threading.Lock()
+        self._per_user = {}
+        self._active = 0
+        self._inflight_bytes = 0
+        # Bytes of finished uploads the last disk sample can't have seen yet
+        self._settled_bytes = 0
+
+    def acquire(self, user_id: int, size: int = 0) -> tuple:
+        """
+        Admit an upload or raise AdmissionRejected
+
+        Args:
+            user_id: Uploading user
+            size: Bytes the request may add to storage (0 if none or unknown)
+
+        Returns:
+            tuple: Ticket to pass to release()
+        """
+        free, fresh = self.sampler.free()
+        with self._lock:
+            if fresh:
+                self._settled_bytes = 0
+            if self._per_user.get(user_id, 0) >= self.max_per_user:
+                raise AdmissionRejected('Too many uploads in progress for this user', 429, self.retry_after)
+            if self._active >= self.max_total:
+                raise AdmissionRejected('Server is busy with other uploads', 429, self.retry_after)
+            if size:
+                usable = free - self._settled_bytes - self.min_free_space
+                if size > usable - self._inflight_bytes:
+                    if size <= usable:
+                        # Fits once uploads in progress fail or are cancelled; worth retrying
+                        raise AdmissionRejected('Not enough disk space while other uploads are in progress',
+                                                507, self.retry_after)
+                    raise AdmissionRejected('Not enough disk space on the server', 507)
+
+            self._per_user[user_id] = self._per_user.get(user_id, 0) + 1
+            self._active += 1
+            self._inflight_bytes += size
+        return (user_id, size)
+
+    def release(self, ticket: tuple) -> None:
+        user_id, size = ticket
+        with self._lock:
+            count = self._per_user.get(user_id, 0) - 1
+            if count > 0:
+                self._per_user[user_id] = count
+            else:
+                self._per_user.pop(user_id, None)
+            self._active -= 1
+            self._inflight_bytes -= size
+            # Assume the data was stored until the next sample shows the truth
+            self._settled_bytes += size
+
+    def check_space(self, size: int) -> None:
+        """Raise AdmissionRejected if size bytes would not fit, without taking a slot"""
+        free, fresh = self.sampler.free()
+        with self._lock:
+            if fresh:
+                self._settled_bytes = 0
+            usable = free - self._settled_bytes - self.min_free_space
+            if size > usable - self._inflight_bytes:
+                raise AdmissionRejected('Not enough disk space on the server', 507,
+                                        self.retry_after if size <= usable else None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'active_uploads': self._active,
+                'users_uploading': len(self._per_user),
+                'inflight_bytes': self._inflight_bytes
+            }
+
+def init_admission(app) -> UploadAdmission:
+    """Create the app's upload admission controller from its configuration"""
+    sampler = DiskSpaceSampler(app.config['UPLOAD_FOLDER'], app.config.get('DISK_SAMPLE_INTERVAL', 2.0))
+    admission = UploadAdmission(
+        sampler,
+        max_per_user=app.config.get('UPLOAD_MAX_CONCURRENT_PER_USER', 6),
+        max_total=app.config.get('UPLOAD_MAX_CONCURRENT', 32),
+        min_free_space=app.config.get('UPLOAD_MIN_FREE_SPACE', 0),
+        retry_after=app.config.get('UPLOAD_RETRY_AFTER', 5)
+    )
+    app.extensions['upload_admission'] = admission
+    return admission
+
+def get_admission() -> UploadAdmission:
+    return current_app.extensions['upload_admission']
+
+def rejection_response(error: Exception):
+    """
+    JSON response refusing an upload whose body was not read. The connection
+    is closed so the unread body is not taken for the next request.
+
+    Args:
+        error: AdmissionRejected or UploadError (message, status_code, optional retry_after)
+    """
+    response = jsonify({'error': error.message})
+    response.status_code = error.status_code
+    retry_after = getattr(error, 'retry_after', None)
+    if retry_after:
+        response.headers['Retry-After'] = str(retry_after)
+    response.headers['Connection'] = 'close'
+    return response
+
+def upload_admission(count_bytes: bool = True) -> Callable:
+    """
+    Decorator admitting an upload request before the view reads its body.
+    Goes below the login decorator, which identifies the user.
+
+    Args:
+        count_bytes: Count Content-Length as new data; False for requests that
+                     write into space that was already allocated (session chunks)
+    """
+    def decorator(f: Callable) -> Callable:
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            user = getattr(g, 'user', None)
+            user_id = user.id if user is not None else session.get('user_id')
+            size = (request.content_length or 0) if count_bytes else 0
+            admission = get_admission()
+            try:
+                ticket = admission.acquire(user_id, size)
+            except AdmissionRejected as e:
+                return rejection_response(e)
+            try:
+                return f(*args, **kwargs)
+            finally:
+                admission.release(ticket)
+        return decorated_function
+    return decorator
@@ -0,0 +1,230 @@
+"""
+Bandwidth shaping for downloads and uploads.
+
+Four system settings cap transfer rates in bytes per second (0 for no
+limit): bandwidth_download_limit and bandwidth_upload_limit for the server
+as a whole, bandwidth_user_download_limit and bandwidth_user_upload_limit
+for each user. They are re-read at most every BANDWIDTH_REFRESH_INTERVAL
+seconds. Every streamed transfer carries a Throttle, limit or not, so a
+limit set on the settings page also slows down transfers already running
+(a folder archive that has been streaming for hours, say).
+
+Every limit is a token bucket. Transfers take their data in chunks of at
+most SHAPING_CHUNK bytes and wait for each chunk's tokens; since waiting
+transfers are granted tokens in the order they asked, active transfers
+share a limit evenly. A transfer waits for both its user's bucket and the
+global one.
+
+Downloads are shaped where their body is read (see FileRegion). The one
+exception is a file download that starts while no download limit is set:
+it is handed to sendfile() or the front-end server (DOWNLOAD_OFFLOAD),
+which the app can't slow down afterwards. Uploads are shaped by reading
+the request body no faster than allowed. Like upload admission, the
+buckets live in the process; each worker process of a multi-process
+server enforces the limits on its own.
+"""
+import threading
+import time
+from typing import BinaryIO, Callable, Iterable, Iterator
+from flask import current_app
+
+SHAPING_CHUNK = 64 * 1024  # Most bytes a transfer is granted at once
+LIMIT_SETTINGS = {
+    # (direction, per user) -> system setting
+    ('download', False): 'bandwidth_download_limit',
+    ('upload', False): 'bandwidth_upload_limit',
+    ('download', True): 'bandwidth_user_download_limit',
+    ('upload', True): 'bandwidth_user_upload_limit'
+}
+
+class TokenBucket:
+    """
+    rate bytes per second on average, in bursts of up to burst bytes.
+
+    Kept as the time the bucket has paid off all grants (GCRA): a grant of
+    size bytes moves that time size / rate seconds ahead, and the caller
+    waits until it is no more than burst / rate seconds in the future.
+    """
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self._paid_until = 0.0
+
+    def configure(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+
+    def reserve(self, size: int, now: float) -> float:
+        """Take size bytes' worth of tokens; returns how long to wait before using them"""
+        if self.rate <= 0:
+            return 0.0
+        self._paid_until = max(self._paid_until, now) + size / self.rate
+        return max(0.0, self._paid_until - self.burst / self.rate - now)
+
+    def idle(self, now: float) -> bool:
+        return self._paid_until <= now
+
+class BandwidthShaper:
+    """Token buckets for the configured limits"""
+
+    def __init__(self, app, refresh_interval: float = 5.0, burst_seconds: float = 0.5) -> None:
+        self.app = app
+        self.refresh_interval = refresh_interval
+        self.burst_seconds = burst_seconds
+        self._lock = threading.Lock()
+        self._limits = dict.fromkeys(LIMIT_SETTINGS, 0)
+        self._loaded_at = None
+        self._global = {}  # direction -> TokenBucket
+        self._per_user = {}  # (direction, user ID) -> TokenBucket
+
+    def limits(self) -> dict:
+        """(direction, per user) -> bytes per second, 0 for no limit"""
+        with self._lock:
+            now = time.monotonic()
+            if self._loaded_at is not None and now - self._loaded_at < self.refresh_interval:
+                return self._limits
+            self._loaded_at = now
+        limits = self._load_limits()
+        with self._lock:
+            self._limits = limits
+            # Buckets of transfers that are over
+            for key in [key for key, bucket in self._per_user.items() if bucket.idle(now)]:
+                del self._per_user[key]
+        return limits
+
+    def _load_limits(self) -> dict:
+        from app.models.system import SystemSetting
+
+        limits = dict.fromkeys(LIMIT_SETTINGS, 0)
+        try:
+            # Also called while a response is streamed, outside any request
+            with self.app.app_context():
+                settings = SystemSetting.query.filter(SystemSetting.key.in_(LIMIT_SETTINGS.values())).all()
+                values = {setting.key: setting.get_typed_value() for setting in settings}
+        except Exception as e:
+            print(f"Error loading bandwidth limits: {e}")
+            return self._limits
+        for key, name in LIMIT_SETTINGS.items():
+            try:
+                limits[key] = max(int(values.get(name) or 0), 0)
+            except (TypeError, ValueError):
+                pass
+        return limits
+
+    def throttle(self, user_id: int, direction: str) -> 'Throttle':
+        """
+        Throttle for a transfer, following the limits as they change
+
+        Args:
+            user_id: User the data is transferred for
+            direction: 'download' or 'upload'
+        """
+        return Throttle(self, user_id, direction)
+
+    def limited(self, user_id: int, direction: str) -> bool:
+        """Whether a limit applies to direction right now"""
+        limits = self.limits()
+        return bool(limits[(direction, False)] or limits[(direction, True)])
+
+    def wait(self, user_id: int, direction: str, size: int) -> None:
+        """Block until size bytes may be transferred"""
+        limits = self.limits()
+        now = time.monotonic()
+        delay = 0.0
+        with self._lock:
+            rate = limits[(direction, False)]
+            if rate:
+                delay = self._reserve(self._global, direction, rate, size, now)
+            rate = limits[(direction, True)]
+            if rate:
+                delay = max(delay, self._reserve(self._per_user, (direction, user_id), rate, size, now))
+        if delay > 0:
+            time.sleep(delay)
+
+    def _reserve(self, buckets: dict, key, rate: int, size: int, now: float) -> float:
+        burst = max(rate * self.burst_seconds, SHAPING_CHUNK)
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(rate, burst)
+        else:
+            # Limits may have changed since the bucket was made
+            bucket.configure(rate, burst)
+        return bucket.reserve(size, now)
+
+class Throttle:
+    """
+    Called by a transfer with the size of each chunk (at most SHAPING_CHUNK
+    while limited) before moving it; returns at once while no limit is set
+    """
+
+    def __init__(self, shaper: BandwidthShaper, user_id: int, direction: str) -> None:
+        self._shaper = shaper
+        self.user_id = user_id
+        self.direction = direction
+
+    def __call__(self, size: int) -> None:
+        self._shaper.wait(self.user_id, self.direction, size)
+
+    def limited(self) -> bool:
+        return self._shaper.limited(self.user_id, self.direction)
+
+def is_limited(throttle: Callable[[int], None]) -> bool:
+    """
+    Whether data must go through throttle in SHAPING_CHUNK pieces now.
+    Functions other than a Throttle count as always limited.
+    """
+    if throttle is None:
+        return False
+    limited = getattr(throttle, 'limited', None)
+    return limited is None or limited()
+
+class ShapedInput:
+    """Request body stream read no faster than a throttle allows"""
+
+    def __init__(self, stream: BinaryIO, throttle: Callable[[int], None]) -> None:
+        self._stream = stream
+        self._throttle = throttle
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            return b''.join(iter(lambda: self.read(SHAPING_CHUNK), b''))
+        if is_limited(self._throttle):
+            size = min(size, SHAPING_CHUNK)
+        data = self._stream.read(size)
+        if data:
+            self._throttle(len(data))
+        return data
+
+def shape_chunks(iterable: Iterable[bytes], throttle: Callable[[int], None]) -> Iterator[bytes]:
+    """The chunks of iterable, split to SHAPING_CHUNK and each let through by throttle"""
+    try:
+        for chunk in iterable:
+            if not is_limited(throttle):
+                yield chunk
+                continue
+            view = memoryview(chunk)
+            for start in range(0, len(view), SHAPING_CHUNK):
+                piece = view[start:start + SHAPING_CHUNK]
+                throttle(len(piece))
+                yield bytes(piece)
+    finally:
+        if hasattr(iterable, 'close'):
+            iterable.close()
+
+def init_bandwidth(app) -> BandwidthShaper:
+    shaper = BandwidthShaper(app, app.config.get('BANDWIDTH_REFRESH_INTERVAL', 5.0),
+                             app.config.get('BANDWIDTH_BURST_SECONDS', 0.5))
+    app.extensions['bandwidth'] = shaper
+    return shaper
+
+def get_bandwidth() -> BandwidthShaper:
+    return current_app.extensions['bandwidth']
+
+def download_throttle(user_id: int) -> Throttle:
+    """Throttle for a download sent to user_id"""
+    return get_bandwidth().throttle(user_id, 'download')
+
+def shaped_input(stream: BinaryIO, user_id: int) -> BinaryIO:
+    """The request body stream, read no faster than the upload limits allow"""
+    return ShapedInput(stream, get_bandwidth().throttle(user_id, 'upload'))
@@ -0,0 +1,371 @@
+import os
+import uuid
+import zlib
+from typing import Callable
+from flask import current_app
+from sqlalchemy import bindparam
+from sqlalchemy.exc import IntegrityError
+from app.models.user import db
+from app.models.file import Blob, File
+from app.models.system import SystemSetting
+from app.utils.storage import (STORED_DIGESTS, DigestVerifier, GroupSync, fsync_each, move_file, same_filesystem,
+                               sync_paths)
+from app.utils.compression import compress_data, compress_file, iter_stored
+from app.utils.packs import get_pack_store, pack_threshold
+from app.utils.upload_journal import get_journal
+
+HASH_BUFFER_SIZE = 1024 * 1024  # 1MB
+DURABILITY_MODES = ('none', 'fsync', 'group')
+
+def _blob_root() -> str:
+    return os.path.join(current_app.config['UPLOAD_FOLDER'], 'blobs')
+
+def blob_path(sha256: str) -> str:
+    """
+    Get the storage path for content with the given SHA-256. Two levels of
+    hex prefixes (65536 directories) keep every directory small no matter
+    how many files are stored.
+
+    Args:
+        sha256: Hex digest of the content
+
+    Returns:
+        str: UPLOAD_FOLDER/blobs/<hex 0-2>/<hex 2-4>/<digest>
+    """
+    return os.path.join(_blob_root(), sha256[:2], sha256[2:4], sha256)
+
+def new_temp_path() -> str:
+    """
+    Get a fresh path to write incoming data to before its digest is known.
+    It lives next to the blobs so it can be renamed into place.
+    """
+    temp_dir = os.path.join(_blob_root(), 'tmp')
+    os.makedirs(temp_dir, exist_ok=True)
+    return os.path.join(temp_dir, f'{uuid.uuid4().hex}.part')
+
+def staging_root(upload_folder: str, temp_path: str) -> str:
+    """
+    Pick where uploads are staged before they move into the blob store:
+    TEMP_UPLOAD_PATH if it is on the blob store's filesystem, otherwise
+    UPLOAD_FOLDER/.staging, so that move is always a rename and never a copy
+
+    Args:
+        upload_folder: UPLOAD_FOLDER
+        temp_path: TEMP_UPLOAD_PATH
+
+    Returns:
+        str: Staging directory
+    """
+    if temp_path and same_filesystem(temp_path, os.path.join(upload_folder, 'blobs')):
+        return temp_path
+    return os.path.join(upload_folder, '.staging')
+
+def staging_dir(name: str) -> str:
+    """Get (and create) a staging subdirectory on the blob store's filesystem"""
+    root = staging_root(current_app.config['UPLOAD_FOLDER'], current_app.config.get('TEMP_UPLOAD_PATH'))
+    path = os.path.join(root, name)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def durability_mode() -> str:
+    """The storage_durability system setting: none, fsync or group"""
+    setting = SystemSetting.query.filter_by(key='storage_durability').first()
+    mode = str(setting.get_typed_value() or '').strip().lower() if setting else ''
+    return mode if mode in DURABILITY_MODES else 'none'
+
+def file_sync() -> Callable[[list[int]], None]:
+    """
+    Get the function that makes stored files durable under the
+    storage_durability setting, to pass as StorageWriter's sync
+
+    Returns:
+        callable: None for 'none' (the OS writes the data back in its own
+                  time), fsync_each for 'fsync' (each file is flushed before
+                  it counts as stored), or the app's GroupSync for 'group'
+                  (files finished together share one flush, adding up to
+                  GROUP_SYNC_WINDOW of latency)
+    """
+    mode = durability_mode()
+    if mode == 'fsync':
+        return fsync_each
+    if mode == 'group':
+        group = current_app.extensions.get('group_sync')
+        if group is None:
+            group = current_app.extensions.setdefault(
+                'group_sync', GroupSync(current_app.config.get('GROUP_SYNC_WINDOW', 0.005))
+            )
+        return group.sync
+    return None
+
+def hash_file(path: str, expected_digests: dict = None, progress: Callable[[int], None] = None) -> tuple:
+    """
+    Compute the SHA-256 and CRC-32 of a file that was not hashed while it
+    was written, checking any client-supplied digests in the same pass
+
+    Args:
+        path: File to hash
+        expected_digests: hashlib name -> expected hex digest
+        progress: Called with the size of each block as it is hashed
+
+    Returns:
+        tuple: (hex SHA-256, CRC-32) of the file (raises DigestMismatch on a mismatch)
+    """
+    digests = DigestVerifier(expected_digests, STORED_DIGESTS)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_BUFFER_SIZE), b''):
+            digests.update(chunk)
+            if progress is not None:
+                progress(len(chunk))
+    digests.verify()
+    return digests.hexdigest('sha256'), int(digests.hexdigest('crc32'), 16)
+
+def place_blob(temp_path: str, path: str, codec: str = None,
+               sync: Callable[[list[int]], None] = None, pack: bool = True) -> tuple:
+    """
+    Move a fully written file into the blob store. Files up to
+    PACK_MAX_FILE_SIZE are appended to a pack segment instead of getting a
+    file of their own (see app.utils.packs), and the data is compressed with
+    codec if that makes it smaller (see app.utils.compression). The caller
+    makes the result durable with sync_paths([sync_target]).
+
+    Args:
+        temp_path: File containing the data, removed or moved by this call
+        path: blob_path of the data
+        codec: Compression to store the data with, if it pays off
+        sync: See file_sync
+        pack: Whether the data may go into a pack
+
+    Returns:
+        tuple: (path the data is stored at, offset in the pack or None,
+                codec or None, size on disk or None if stored raw in its
+                own file)
+    """
+    threshold = pack_threshold()
+    if pack and threshold > 0 and os.path.getsize(temp_path) <= threshold:
+        with open(temp_path, 'rb') as f:
+            data = f.read()
+        compressed = compress_data(data, codec) if codec is not None else None
+        if compressed is not None:
+            data = compressed
+        else:
+            codec = None
+        pack_path, offset = get_pack_store().append(data, sync)
+        os.remove(temp_path)
+        return pack_path, offset, codec, len(data)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if codec is not None:
+        stored_size = compress_file(temp_path, path, codec, sync)
+        if stored_size is not None:
+            return path, None, codec, stored_size
+    move_file(temp_path, path, sync)
+    return path, None, None, None
+
+def sync_target(path: str, offset: int) -> str:
+    """What to sync after place_blob: the pack segment, or the blob's directory entry"""
+    return path if offset is not None else os.path.dirname(path)
+
+def store_blob(temp_path: str, sha256: str, size: int, codec: str = None, pack: bool = True,
+               crc32: int = None) -> Blob:
+    """
+    Take ownership of a fully written file and return the blob holding its
+    content, with one reference added for the caller. If the content is
+    already stored, the new copy is discarded instead of kept twice.
+
+    Args:
+        temp_path: File containing the data, removed or moved by this call
+        sha256: Hex digest of the data
+        size: Size of the data in bytes
+        codec: Compression to store new content with (see choose_codec)
+        pack: Whether small content may be appended to a pack (see place_blob)
+        crc32: CRC-32 of the data, if it was computed while the data was written
+
+    Returns:
+        Blob: The (flushed, uncommitted) blob for the content
+    """
+    blob = Blob.query.filter_by(sha256=sha256).first()
+    if blob is not None and blob.crc32 is None:
+        blob.crc32 = crc32
+    if blob is not None and os.path.exists(blob.file_path):
+        os.remove(temp_path)
+        blob.add_reference()
+        return blob
+
+    # Until the caller commits, the file is only known to the journal;
+    # dead bytes left in a pack are reclaimed by compaction instead
+    sync = file_sync()
+    get_journal().track([blob_path(sha256)], sync)
+    path, offset, codec, stored_size = place_blob(temp_path, blob_path(sha256), codec, sync, pack)
+    sync_paths([sync_target(path, offset)], sync)
+
+    if blob is not None:
+        # Row survived but the data went missing, the new copy restores it
+        blob.file_path = path
+        blob.pack_offset = offset
+        blob.codec = codec
+        blob.stored_size = stored_size
+        blob.add_reference()
+        return blob
+
+    try:
+        with db.session.begin_nested():
+            blob = Blob(sha256=sha256, file_path=path, pack_offset=offset, size=size, codec=codec,
+                        stored_size=stored_size, crc32=crc32, ref_count=1)
+            db.session.add(blob)
+    except IntegrityError:
+        # Same content stored by a concurrent upload; both wrote identical data
+        blob = Blob.query.filter_by(sha256=sha256).first()
+        blob.add_reference()
+    return blob
+
+def _relocate_blobs(batch_size: int, dry_run: bool, stats: dict) -> None:
+    """Move blobs stored under an older layout to their blob_path"""
+    # Packed blobs live in pack segments, not at a path of their own
+    blob_ids = [row[0] for row in db.session.query(Blob.id).filter(Blob.pack_offset.is_(None)).order_by(Blob.id)]
+    for start in range(0, len(blob_ids), batch_size):
+        blobs = Blob.query.filter(Blob.id.in_(blob_ids[start:start + batch_size])).all()
+        blob_updates = []
+        moved = []
+        try:
+            for blob in blobs:
+                target = blob_path(blob.sha256)
+                if blob.file_path == target:
+                    continue
+                stats['blobs_moved'] += 1
+                if dry_run:
+                    continue
+                if os.path.exists(blob.file_path):
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    os.replace(blob.file_path, target)
+                    moved.append((blob.file_path, target))
+                blob_updates.append({'id': blob.id, 'file_path': target})
+
+            if blob_updates:
+                db.session.bulk_update_mappings(Blob, blob_updates)
+                db.session.execute(
+                    File.__table__.update()
+                    .where(File.__table__.c.blob_id == bindparam('b_id'))
+                    .values(file_path=bindparam('b_path')),
+                    [{'b_id': update['id'], 'b_path': update['file_path']} for update in blob_updates]
+                )
+                db.session.commit()
+        except Exception:
+            db.session.rollback()
+            for old_path, path in reversed(moved):
+                os.replace(path, old_path)
+            raise
+
+def _migrate_legacy_files(batch_size: int, dry_run: bool, stats: dict) -> None:
+    """Move files stored before the blob store (UPLOAD_FOLDER/<folder_id>/...) into blobs"""
+    file_ids = [row[0] for row in db.session.query(File.id).filter(File.blob_id.is_(None)).order_by(File.id)]
+    for start in range(0, len(file_ids), batch_size):
+        files = File.query.filter(File.id.in_(file_ids[start:start + batch_size])).all()
+        moved = []          # (legacy path, blob path) to undo if the batch fails
+        duplicates = []     # legacy copies to remove once the batch is committed
+        batch_blobs = {}
+        file_updates = []
+
+        try:
+            for file in files:
+                if not os.path.exists(file.file_path):
+                    stats['missing'] += 1
+                    continue
+                stats['files_migrated'] += 1
+                if dry_run:
+                    continue
+
+                crc32 = file.crc32
+                if file.sha256 is None or crc32 is None:
+                    sha256, crc32 = hash_file(file.file_path)
+                else:
+                    sha256 = file.sha256
+                blob = batch_blobs.get(sha256) or Blob.query.filter_by(sha256=sha256).first()
+                if blob is not None and os.path.exists(blob.file_path):
+                    blob.ref_count += 1
+                    if blob.crc32 is None:
+                        blob.crc32 = crc32
+                    duplicates.append(file.file_path)
+                    stats['duplicates'] += 1
+                else:
+                    path = blob_path(sha256)
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    move_file(file.file_path, path)
+                    moved.append((file.file_path, path))
+                    if blob is None:
+                        blob = Blob(sha256=sha256, file_path=path, size=os.path.getsize(path), crc32=crc32,
+                                    ref_count=1)
+                        db.session.add(blob)
+                    else:
+                        blob.file_path = path
+                        blob.crc32 = crc32
+                        blob.ref_count += 1
+                batch_blobs[sha256] = blob
+                file_updates.append((file.id, blob, sha256))
+
+            if file_updates:
+                db.session.flush()
+                db.session.bulk_update_mappings(File, [
+                    {'id': file_id, 'blob_id': blob.id, 'file_path': blob.file_path,
+                     'filename': sha256, 'sha256': sha256}
+                    for file_id, blob, sha256 in file_updates
+                ])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            for legacy_path, path in reversed(moved):
+                move_file(path, legacy_path)
+            raise
+
+        for legacy_path in duplicates:
+            try:
+                os.remove(legacy_path)
+            except Exception as e:
+                print(f"Error removing duplicate {legacy_path}: {e}")
+
+def _fill_crc32(batch_size: int, dry_run: bool, stats: dict) -> None:
+    """Compute the CRC-32 of blobs stored before it was taken at upload time"""
+    blob_ids = [row[0] for row in db.session.query(Blob.id).filter(Blob.crc32.is_(None)).order_by(Blob.id)]
+    for start in range(0, len(blob_ids), batch_size):
+        blobs = Blob.query.filter(Blob.id.in_(blob_ids[start:start + batch_size])).all()
+        crc_updates = []
+        for blob in blobs:
+            if not os.path.exists(blob.file_path):
+                stats['missing'] += 1
+                continue
+            stats['crcs_computed'] += 1
+            if dry_run:
+                continue
+            crc = 0
+            for chunk in iter_stored(blob.file_path, blob.codec, blob.region):
+                crc = zlib.crc32(chunk, crc)
+            crc_updates.append({'id': blob.id, 'crc32': crc})
+        if crc_updates:
+            db.session.bulk_update_mappings(Blob, crc_updates)
+        db.session.commit()
+
+def _remove_empty_dirs(root: str) -> None:
+    for dirpath, dirnames, filenames in os.walk(root, topdown=False):
+        if dirpath != root and not os.listdir(dirpath):
+            os.rmdir(dirpath)
+
+def migrate_storage_layout(batch_size: int = 500, dry_run: bool = False) -> dict:
+    """
+    Move everything already stored into the current sharded blob layout and
+    rewrite File/Blob paths in bulk, one batch per transaction. Safe to run
+    again; rows already in place are skipped.
+
+    Args:
+        batch_size: Rows handled per transaction
+        dry_run: Only count what would be moved
+
+    Returns:
+        dict: Counts of blobs_moved, files_migrated, duplicates, crcs_computed and missing files
+    """
+    stats = {'blobs_moved': 0, 'files_migrated': 0, 'duplicates': 0, 'crcs_computed': 0, 'missing': 0}
+    _relocate_blobs(batch_size, dry_run, stats)
+    _migrate_legacy_files(batch_size, dry_run, stats)
+    _fill_crc32(batch_size, dry_run, stats)
+    if not dry_run:
+        # Drop the per-folder directories and old blob shards left empty
+        _remove_empty_dirs(current_app.config['UPLOAD_FOLDER'])
+    return stats
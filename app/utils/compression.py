@@ -0,0 +1,244 @@
+"""
+Compression of stored files.
+
+Text-like files (COMPRESSIBLE_EXTENSIONS) can be kept compressed in the blob
+store. The storage_compression system setting picks the codec: gzip and lzma
+come with Python, zstd needs the optional zstandard package. A file is
+compressed when it is placed in the blob store and kept raw if that doesn't
+save at least MIN_SAVING of its size. Blob.codec records how a blob is
+stored; Blob.size and File.size stay the size of the original content.
+
+Readers go through open_stored(), which decompresses on the fly. Downloads
+of gzip and zstd blobs are sent as they are stored, with Content-Encoding,
+to clients that accept that encoding.
+"""
+import gzip
+import io
+import lzma
+import os
+import uuid
+import zlib
+from typing import BinaryIO, Callable, Iterator
+from urllib.parse import quote
+from flask import Response, request
+from werkzeug.utils import secure_filename
+from app.utils.bandwidth import shape_chunks
+from app.utils.downloads import CountingStream, FileRegion, send_region
+from app.utils.storage import COPY_BUFFER_SIZE, SizeLimitExceeded, StorageWriter
+
+try:
+    import zstandard
+except ImportError:  # Optional; zstd is unavailable without it
+    zstandard = None
+
+COMPRESSIBLE_EXTENSIONS = {
+    'txt', 'log', 'csv', 'tsv', 'json', 'xml', 'md', 'html', 'htm', 'css', 'js', 'ts',
+    'py', 'java', 'c', 'h', 'cpp', 'hpp', 'cs', 'go', 'rs', 'rb', 'php', 'sh', 'sql',
+    'yaml', 'yml', 'ini', 'cfg', 'conf', 'toml', 'svg'
+}
+MIN_SAVING = 0.1  # Keep files raw unless compression saves 10%
+
+class _Codec:
+    def __init__(self, compressor: Callable, decompressor: Callable, content_encoding: str = None) -> None:
+        self.compressor = compressor  # () -> object with compress() and flush()
+        self.decompressor = decompressor  # readable binary file -> reader of its decompressed content
+        self.content_encoding = content_encoding  # HTTP coding of the same format, if there is one
+
+CODECS = {
+    # wbits=31 writes the gzip container, which is also HTTP's gzip coding
+    'gzip': _Codec(lambda: zlib.compressobj(6, zlib.DEFLATED, 31),
+                   lambda f: gzip.GzipFile(fileobj=f, mode='rb'), 'gzip'),
+    'lzma': _Codec(lambda: lzma.LZMACompressor(preset=1),
+                   lambda f: lzma.LZMAFile(f, 'rb')),
+}
+if zstandard is not None:
+    CODECS['zstd'] = _Codec(lambda: zstandard.ZstdCompressor(level=3).compressobj(),
+                            lambda f: zstandard.ZstdDecompressor().stream_reader(f), 'zstd')
+
+class _DecompressedFile(io.RawIOBase):
+    """Decompressing reader that also closes the file it reads from"""
+
+    def __init__(self, reader, source: BinaryIO) -> None:
+        self._reader = reader
+        self._source = source
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        data = self._reader.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self) -> None:
+        if not self.closed:
+            try:
+                self._reader.close()
+            finally:
+                self._source.close()
+        super().close()
+
+def configured_codec() -> str:
+    """
+    The storage_compression system setting if it names an available codec,
+    otherwise None (files are stored raw)
+    """
+    from app.models.system import SystemSetting
+
+    setting = SystemSetting.query.filter_by(key='storage_compression').first()
+    codec = str(setting.get_typed_value() or '').strip().lower() if setting else ''
+    return codec if codec in CODECS else None
+
+def codec_chooser() -> Callable[[str], str]:
+    """
+    Read the storage_compression setting once and return a function mapping
+    a filename to the codec its content should be stored with (None for raw).
+    Use this instead of choose_codec when storing many files in one request.
+    """
+    codec = configured_codec()
+    if codec is None:
+        return lambda filename: None
+    return lambda filename: codec if is_compressible(filename) else None
+
+def choose_codec(filename: str) -> str:
+    """Codec to store filename's content with, or None to keep it raw"""
+    return codec_chooser()(filename)
+
+def is_compressible(filename: str) -> bool:
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in COMPRESSIBLE_EXTENSIONS
+
+def compress_file(src: str, dst: str, codec: str, sync: Callable[[list[int]], None] = None) -> int:
+    """
+    Compress src into dst (replacing it) and remove src, unless compression
+    doesn't pay off
+
+    Args:
+        src: File to compress
+        dst: Path of the compressed file
+        codec: Name of a codec in CODECS
+        sync: Passed on to StorageWriter to make dst durable
+
+    Returns:
+        int: Size of dst, or None if src was left as it is because the
+             compressed data would not be MIN_SAVING smaller
+    """
+    size = os.path.getsize(src)
+    compressor = CODECS[codec].compressor()
+    # Written beside dst, so the janitor finds it if the process dies (see move_file)
+    temp_path = f'{dst}.{uuid.uuid4().hex}.tmp'
+    writer = StorageWriter(temp_path, max_size=int(size * (1 - MIN_SAVING)), sync=sync)
+    try:
+        with open(src, 'rb') as f:
+            for chunk in iter(lambda: f.read(COPY_BUFFER_SIZE), b''):
+                writer.write(compressor.compress(chunk))
+        writer.write(compressor.flush())
+    except SizeLimitExceeded:
+        writer.abort()
+        return None
+    except BaseException:
+        writer.abort()
+        raise
+    writer.finish()
+    os.replace(temp_path, dst)
+    os.remove(src)
+    return writer.size
+
+def compress_data(data: bytes, codec: str) -> bytes:
+    """data compressed with codec, or None if that would not save MIN_SAVING"""
+    compressor = CODECS[codec].compressor()
+    compressed = compressor.compress(data) + compressor.flush()
+    return compressed if len(compressed) <= len(data) * (1 - MIN_SAVING) else None
+
+def open_stored(path: str, codec: str = None, region: tuple = None) -> BinaryIO:
+    """
+    Open stored data for reading its original content
+
+    Args:
+        path: Blob file or pack segment
+        codec: Compression the data is stored with
+        region: (offset, length) of the data in a pack segment
+    """
+    f = open(path, 'rb') if region is None else FileRegion(path, *region)
+    if codec is None:
+        return f
+    try:
+        return io.BufferedReader(_DecompressedFile(CODECS[codec].decompressor(f), f), COPY_BUFFER_SIZE)
+    except Exception:
+        f.close()
+        raise
+
+def iter_stored(path: str, codec: str = None, region: tuple = None,
+                chunk_size: int = COPY_BUFFER_SIZE) -> Iterator[bytes]:
+    """Original content of stored data, in chunks"""
+    with open_stored(path, codec, region) as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            yield chunk
+
+def stored_location(file) -> tuple:
+    """
+    Where and how a File's content is stored
+
+    Returns:
+        tuple: (path, codec, region), as taken by open_stored
+    """
+    blob = file.blob
+    if blob is None:
+        return file.file_path, None, None
+    # The blob's path is authoritative; pack compaction moves blobs around
+    return blob.file_path, blob.codec, blob.region
+
+def open_content(file) -> BinaryIO:
+    """Open a File's original content for reading"""
+    return open_stored(*stored_location(file))
+
+def iter_content(file, chunk_size: int = COPY_BUFFER_SIZE) -> Iterator[bytes]:
+    """A File's original content, in chunks"""
+    return iter_stored(*stored_location(file), chunk_size=chunk_size)
+
+def _accepts_encoding(coding: str) -> bool:
+    return bool(coding) and request.accept_encodings.quality(coding) > 0
+
+def _content_disposition(file, as_attachment: bool) -> str:
+    ascii_filename = secure_filename(file.original_filename) or 'download'
+    return (f"{'attachment' if as_attachment else 'inline'}; filename=\"{ascii_filename}\"; "
+            f"filename*=UTF-8''{quote(file.original_filename)}")
+
+def send_stored_file(file, mimetype: str, as_attachment: bool = False,
+                     on_close: Callable[[int], None] = None, throttle: Callable[[int], None] = None) -> Response:
+    """
+    Response with a File's content. Compressed content is sent as stored,
+    with Content-Encoding, if the client accepts the codec's encoding, and
+    decompressed while it is sent otherwise. Stored bytes go through the
+    download engine (see app.utils.downloads), packed content from its
+    region of the pack segment.
+
+    Args:
+        file: File to send
+        mimetype: Content-Type of the original content
+        as_attachment: Ask the browser to save the file instead of showing it
+        on_close: Called with the number of bytes sent (see send_region)
+        throttle: Bandwidth throttle for the body (see app.utils.bandwidth)
+    """
+    path, codec, region = stored_location(file)
+    disposition = _content_disposition(file, as_attachment)
+    content_encoding = CODECS[codec].content_encoding if codec is not None else None
+    if codec is None or _accepts_encoding(content_encoding):
+        # The stored bytes as they are; an ETag tells the encodings apart
+        etag = None
+        if file.sha256:
+            etag = f'{file.sha256}-{codec}' if codec is not None else file.sha256
+        # Only raw files are offloaded: front-end servers drop Content-Encoding
+        response = send_region(path, region, mimetype, disposition, etag, file.updated_at,
+                               on_close, offload=codec is None, throttle=throttle)
+        if codec is not None:
+            response.headers['Content-Encoding'] = content_encoding
+    else:
+        body = iter_stored(path, codec, region)
+        if throttle is not None:
+            body = shape_chunks(body, throttle)
+        response = Response(CountingStream(body, on_close), mimetype=mimetype, direct_passthrough=True)
+        response.content_length = file.size
+        response.headers['Content-Disposition'] = disposition
+    if codec is not None:
+        response.vary.add('Accept-Encoding')
+    return response
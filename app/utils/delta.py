@@ -0,0 +1,240 @@
+"""
+rsync-style delta transfer for updating a stored file.
+
+The server publishes a signature of the current content: for every
+block_size block an Adler-32 checksum (cheap, and can be rolled one byte at
+a time) and an MD5 (to confirm a weak match). The client slides a window
+over its new version, and wherever the window matches a block it sends a
+reference to that block instead of the bytes. The delta is a binary stream:
+
+    b'HCD1' <u32 block_size>                 header
+    b'C' <u64 first block> <u32 block count> copy blocks from the base file
+    b'D' <u32 length> <length bytes>         literal data
+    b'E'                                     end of stream
+
+All integers are big endian. The server replays the stream against the base
+file in a single pass; the result is checked against the whole-file SHA-256
+the client declares, so a weak/strong collision can't go unnoticed.
+"""
+import hashlib
+import struct
+import zlib
+from typing import BinaryIO, Iterable, Iterator, Union
+
+DELTA_MAGIC = b'HCD1'
+DEFAULT_BLOCK_SIZE = 64 * 1024
+MIN_BLOCK_SIZE = 1024
+MAX_BLOCK_SIZE = 8 * 1024 * 1024
+READ_SIZE = 1024 * 1024
+LITERAL_FLUSH_SIZE = 1024 * 1024  # Largest literal instruction compute_delta emits
+
+_ADLER_MOD = 65521
+
+def roll_checksum(checksum: int, out_byte: int, in_byte: int, block_size: int) -> int:
+    """
+    Move an Adler-32 window one byte forward
+
+    Args:
+        checksum: Adler-32 of the current window
+        out_byte: Byte leaving the window (its first byte)
+        in_byte: Byte entering the window
+        block_size: Window length
+
+    Returns:
+        int: Adler-32 of the shifted window, equal to zlib.adler32 of it
+    """
+    a = checksum & 0xffff
+    b = checksum >> 16
+    a = (a - out_byte + in_byte) % _ADLER_MOD
+    b = (b - block_size * out_byte + a - 1) % _ADLER_MOD
+    return (b << 16) | a
+
+def strong_checksum(data: bytes) -> str:
+    return hashlib.md5(data).hexdigest()
+
+def compute_signature(source: Union[str, BinaryIO], block_size: int = DEFAULT_BLOCK_SIZE) -> dict:
+    """
+    Build the block signature of a stored file
+
+    Args:
+        source: Path of the file to describe, or a binary stream of its content
+        block_size: Block length in bytes
+
+    Returns:
+        dict: block_size, size, sha256 of the whole file and blocks as
+              [adler32, md5 hex] pairs
+    """
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            return compute_signature(f, block_size)
+
+    blocks = []
+    size = 0
+    sha256 = hashlib.sha256()
+    for block in iter(lambda: source.read(block_size), b''):
+        blocks.append([zlib.adler32(block), strong_checksum(block)])
+        sha256.update(block)
+        size += len(block)
+    return {'block_size': block_size, 'size': size, 'sha256': sha256.hexdigest(), 'blocks': blocks}
+
+def compute_delta(stream: BinaryIO, signature: dict) -> Iterator[tuple]:
+    """
+    Compare new content against a signature (client side)
+
+    Args:
+        stream: New version of the file
+        signature: Result of compute_signature for the base version
+
+    Yields:
+        tuple: ('copy', first_block, count) or ('data', bytes)
+    """
+    block_size = signature['block_size']
+    base_size = signature['size']
+    blocks = {}
+    for index, (weak, strong) in enumerate(signature['blocks']):
+        blocks.setdefault(weak, []).append((strong, index))
+
+    def find_block(window: bytes, weak: int):
+        candidates = blocks.get(weak)
+        if not candidates:
+            return None
+        strong = strong_checksum(window)
+        for candidate, index in candidates:
+            length = min(block_size, base_size - index * block_size)
+            if candidate == strong and length == len(window):
+                return index
+        return None
+
+    pending_copy = None
+    buf = bytearray()
+    start = 0  # Window start in buf; buf[:start] is unmatched literal data
+    weak = None
+    eof = False
+
+    while True:
+        # Keep one byte beyond the window so it can be rolled
+        if not eof and len(buf) - start <= block_size:
+            chunk = stream.read(READ_SIZE)
+            if chunk:
+                buf += chunk
+            else:
+                eof = True
+            continue
+
+        window_len = min(block_size, len(buf) - start)
+        if window_len == 0:
+            break
+        window = bytes(buf[start:start + window_len])
+        if weak is None:
+            weak = zlib.adler32(window)
+
+        index = find_block(window, weak)
+        if index is not None:
+            if start:
+                if pending_copy:
+                    yield ('copy',) + pending_copy
+                    pending_copy = None
+                yield ('data', bytes(buf[:start]))
+            if pending_copy and pending_copy[0] + pending_copy[1] == index:
+                pending_copy = (pending_copy[0], pending_copy[1] + 1)
+            else:
+                if pending_copy:
+                    yield ('copy',) + pending_copy
+                pending_copy = (index, 1)
+            del buf[:start + window_len]
+            start = 0
+            weak = None
+            continue
+
+        if start + block_size >= len(buf):
+            # End of input and the last window matched nothing: rest is literal
+            start = len(buf)
+            break
+
+        weak = roll_checksum(weak, buf[start], buf[start + block_size], block_size)
+        start += 1
+        if start >= LITERAL_FLUSH_SIZE:
+            if pending_copy:
+                yield ('copy',) + pending_copy
+                pending_copy = None
+            yield ('data', bytes(buf[:start]))
+            del buf[:start]
+            start = 0
+
+    if pending_copy:
+        yield ('copy',) + pending_copy
+    if start:
+        yield ('data', bytes(buf[:start]))
+
+def encode_delta(instructions: Iterable[tuple], block_size: int) -> Iterator[bytes]:
+    """Serialize compute_delta output to the delta stream format"""
+    yield DELTA_MAGIC + struct.pack('>I', block_size)
+    for instruction in instructions:
+        if instruction[0] == 'copy':
+            yield b'C' + struct.pack('>QI', instruction[1], instruction[2])
+        else:
+            data = instruction[1]
+            yield b'D' + struct.pack('>I', len(data))
+            yield data
+    yield b'E'
+
+def _read_exact(stream: BinaryIO, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            raise ValueError('Unexpected end of delta stream')
+        data += chunk
+    return bytes(data)
+
+def apply_delta(base: BinaryIO, stream: BinaryIO, out) -> int:
+    """
+    Rebuild the new version from the base file and a delta stream
+
+    Args:
+        base: Base version, opened for binary reading
+        stream: Delta stream (see module docstring)
+        out: Object with a write(bytes) method receiving the new content
+
+    Returns:
+        int: Number of literal bytes that were transferred in the delta
+    """
+    if _read_exact(stream, 4) != DELTA_MAGIC:
+        raise ValueError('Not a delta stream')
+    block_size, = struct.unpack('>I', _read_exact(stream, 4))
+    if not MIN_BLOCK_SIZE <= block_size <= MAX_BLOCK_SIZE:
+        raise ValueError(f'Invalid block size {block_size}')
+
+    base.seek(0, 2)
+    base_size = base.tell()
+
+    literal_bytes = 0
+    while True:
+        op = _read_exact(stream, 1)
+        if op == b'E':
+            return literal_bytes
+        if op == b'C':
+            first, count = struct.unpack('>QI', _read_exact(stream, 12))
+            offset = first * block_size
+            if count == 0 or (first + count - 1) * block_size >= base_size:
+                raise ValueError(f'Copy of blocks {first}+{count} is beyond the base file')
+            # Only the base file's last block may be short
+            remaining = min(count * block_size, base_size - offset)
+            base.seek(offset)
+            while remaining > 0:
+                data = base.read(min(READ_SIZE, remaining))
+                if not data:
+                    raise ValueError('Base file changed while applying delta')
+                out.write(data)
+                remaining -= len(data)
+        elif op == b'D':
+            length, = struct.unpack('>I', _read_exact(stream, 4))
+            while length > 0:
+                data = stream.read(min(READ_SIZE, length))
+                if not data:
+                    raise ValueError('Unexpected end of delta stream')
+                out.write(data)
+                literal_bytes += len(data)
+                length -= len(data)
+        else:
+            raise ValueError(f'Unknown delta instruction {op!r}')
@@ -0,0 +1,259 @@
+"""
+Download engine.
+
+Stored bytes (a blob file, or a file's region of a pack segment) are sent
+as a FileRegion handed to the server's wsgi.file_wrapper. Servers that
+support it (gunicorn) see the region's descriptor, positioned at its
+start, and send it with sendfile() straight from the page cache; others
+read it in DOWNLOAD_BLOCK_SIZE blocks, which FileRegion serves with
+pread(). Either way the kernel is told the region is read sequentially
+and asked to read ahead of it.
+
+Range requests are answered by opening just the requested part as its own
+region, so partial downloads take the same path as whole ones.
+
+Behind a front-end server, whole files can be left to it entirely
+(DOWNLOAD_OFFLOAD): the app answers with an X-Accel-Redirect (Nginx) or
+X-Sendfile (Apache, lighttpd) header naming the file, and the front end
+sends it, so the worker is free as soon as the headers are out.
+"""
+import io
+import os
+from datetime import datetime
+from typing import Callable, Iterable
+from urllib.parse import quote
+from flask import Response, current_app, request
+from werkzeug.wsgi import wrap_file
+from app.utils.bandwidth import SHAPING_CHUNK, is_limited
+
+DOWNLOAD_BLOCK_SIZE = 1024 * 1024  # 1MB reads when the server doesn't use sendfile()
+READAHEAD_SIZE = 8 * 1024 * 1024  # Data the kernel is asked to read ahead of the client
+OFFLOAD_HEADERS = {'x-accel-redirect': 'X-Accel-Redirect', 'x-sendfile': 'X-Sendfile'}
+
+class FileRegion(io.RawIOBase):
+    """
+    Read-only file over length bytes of path starting at offset, counting
+    what is read from it.
+
+    The descriptor is kept positioned at the current position inside the
+    file, so a file_wrapper that uses sendfile() with the response's
+    Content-Length (the region's length) sends exactly the region. Such a
+    server never reads through this object; a region whose descriptor was
+    handed out is counted as sent in full. A region whose throttle (see
+    app.utils.bandwidth) is limited when the server asks for the descriptor
+    doesn't hand it out, so every byte goes through the throttle; reads
+    follow limits set while the region is being sent.
+    """
+
+    def __init__(self, path: str, offset: int = 0, length: int = None,
+                 on_close: Callable[[int], None] = None, throttle: Callable[[int], None] = None) -> None:
+        """
+        Args:
+            path: File to read from
+            offset: Start of the region
+            length: Size of the region, by default up to the end of the file
+            on_close: Called with the number of bytes sent once the region is closed
+            throttle: Called with the size of each read before it is made
+        """
+        self._fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        try:
+            if length is None:
+                length = os.fstat(self._fd).st_size - offset
+            os.lseek(self._fd, offset, os.SEEK_SET)
+        except BaseException:
+            os.close(self._fd)
+            raise
+        self.offset = offset
+        self.length = length
+        self.bytes_sent = 0
+        self._on_close = on_close
+        self._throttle = throttle
+        self._position = 0
+        self._prefetched = 0
+        self._handed_out = False
+        self._advise(getattr(os, 'POSIX_FADV_SEQUENTIAL', None), 0, length)
+        self._prefetch()
+
+    def _advise(self, advice: int, start: int, length: int) -> None:
+        if advice is None or length <= 0:
+            return
+        try:
+            os.posix_fadvise(self._fd, self.offset + start, length, advice)
+        except OSError:
+            # Only a hint; some filesystems don't take it
+            pass
+
+    def _prefetch(self) -> None:
+        # Keep READAHEAD_SIZE of the region queued for reading ahead of the client
+        if self._prefetched - self._position > READAHEAD_SIZE // 2:
+            return
+        end = min(self._position + READAHEAD_SIZE, self.length)
+        self._advise(getattr(os, 'POSIX_FADV_WILLNEED', None), self._prefetched, end - self._prefetched)
+        self._prefetched = max(self._prefetched, end)
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def fileno(self) -> int:
+        if is_limited(self._throttle):
+            # Servers then fall back to reading, instead of sendfile() past the throttle
+            raise io.UnsupportedOperation('throttled region is only readable')
+        self._handed_out = True
+        return self._fd
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, pos: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            pos += self._position
+        elif whence == os.SEEK_END:
+            pos += self.length
+        self._position = min(max(pos, 0), self.length)
+        os.lseek(self._fd, self.offset + self._position, os.SEEK_SET)
+        return self._position
+
+    def readinto(self, buffer) -> int:
+        size = min(len(buffer), self.length - self._position)
+        if size <= 0:
+            return 0
+        if is_limited(self._throttle):
+            size = min(size, SHAPING_CHUNK)
+        if self._throttle is not None:
+            self._throttle(size)
+        if hasattr(os, 'pread'):
+            data = os.pread(self._fd, size, self.offset + self._position)
+            self._position += len(data)
+            os.lseek(self._fd, self.offset + self._position, os.SEEK_SET)
+        else:
+            # Windows has no pread; the descriptor is already at the position
+            data = os.read(self._fd, size)
+            self._position += len(data)
+        buffer[:len(data)] = data
+        self.bytes_sent += len(data)
+        self._prefetch()
+        return len(data)
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        os.close(self._fd)
+        super().close()
+        if self._handed_out and not self.bytes_sent:
+            # Sent by the server with sendfile()
+            self.bytes_sent = self.length
+        if self._on_close is not None:
+            self._on_close(self.bytes_sent)
+
+class CountingStream:
+    """
+    WSGI body over an iterable of chunks, counting the bytes the server
+    takes from it. For bodies that are not a FileRegion.
+    """
+
+    def __init__(self, iterable: Iterable[bytes], on_close: Callable[[int], None] = None) -> None:
+        self.bytes_sent = 0
+        self._iterable = iterable
+        self._on_close = on_close
+        self._closed = False
+
+    def __iter__(self):
+        for chunk in self._iterable:
+            self.bytes_sent += len(chunk)
+            yield chunk
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            if hasattr(self._iterable, 'close'):
+                self._iterable.close()
+        finally:
+            if self._on_close is not None:
+                self._on_close(self.bytes_sent)
+
+def offload_target(path: str) -> tuple:
+    """
+    Header handing path to the front-end server, per the DOWNLOAD_OFFLOAD
+    setting
+
+    Returns:
+        tuple: (header name, value), or None if downloads are not offloaded
+               or path is outside UPLOAD_FOLDER
+    """
+    config = current_app.config
+    header = OFFLOAD_HEADERS.get(str(config.get('DOWNLOAD_OFFLOAD') or '').strip().lower())
+    if header is None:
+        return None
+    path = os.path.abspath(path)
+    if header == 'X-Sendfile':
+        return header, path
+    relative = os.path.relpath(path, os.path.abspath(config['UPLOAD_FOLDER']))
+    if relative == os.pardir or relative.startswith(os.pardir + os.sep):
+        return None
+    location = config.get('DOWNLOAD_OFFLOAD_LOCATION', '/protected-files/').rstrip('/')
+    return header, f"{location}/{quote(relative.replace(os.sep, '/'))}"
+
+def send_region(path: str, region: tuple, mimetype: str, disposition: str, etag: str = None,
+                last_modified: datetime = None, on_close: Callable[[int], None] = None,
+                offload: bool = True, throttle: Callable[[int], None] = None) -> Response:
+    """
+    Response with stored bytes, answering conditional and Range requests
+
+    Args:
+        path: File holding the bytes
+        region: (offset, length) of the bytes in path, None for the whole file
+        mimetype: Content-Type of the response
+        disposition: Content-Disposition of the response
+        etag: Strong ETag of the bytes, if known
+        last_modified: When the content last changed, if known
+        on_close: Called once with the number of bytes sent: when the body is
+                  closed, right away with 0 for responses without a body, or
+                  with None when the front-end server sends the file
+        offload: Whether a whole file may be left to the front-end server
+                 (see offload_target); it passes on only some of the headers
+        throttle: Bandwidth throttle for the body (see app.utils.bandwidth);
+                  files are not offloaded while it is limited
+
+    Returns:
+        Response: 200 or 206 with the (partial) bytes, or 304/412 without a body
+    """
+    offset, length = region if region is not None else (0, os.path.getsize(path))
+    response = Response(mimetype=mimetype, direct_passthrough=True)
+    response.headers['Content-Disposition'] = disposition
+    response.content_length = length
+    response.cache_control.no_cache = True
+    if etag is not None:
+        response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+
+    target = offload_target(path) if offload and region is None and not is_limited(throttle) else None
+    if target is not None:
+        # The front-end server sends the file and answers Range itself
+        response.headers[target[0]] = target[1]
+        response = response.make_conditional(request.environ)
+        if response.status_code != 200:
+            response.headers.pop(target[0], None)
+        if on_close is not None:
+            on_close(None if response.status_code == 200 else 0)
+        return response
+
+    # Evaluate the request's conditions and Range first; the body is then
+    # opened over just the part being sent (raises 416 for bad ranges)
+    response = response.make_conditional(request.environ, accept_ranges=True, complete_length=length)
+    if response.status_code == 206:
+        offset += response.content_range.start
+        length = response.content_range.stop - response.content_range.start
+    elif response.status_code != 200 or request.method == 'HEAD':
+        if on_close is not None:
+            on_close(0)
+        return response
+
+    response.response = wrap_file(request.environ, FileRegion(path, offset, length, on_close, throttle),
+                                  DOWNLOAD_BLOCK_SIZE)
+    return response
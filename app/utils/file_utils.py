@@ -8,21 +8,25 @@
 from werkzeug.utils import secure_filename
 import uuid
 
-def get_file_hash(file_path: str) -> str:
+def get_file_hash(file_path: str, algorithm: str = 'md5') -> str:
     """
-    Calculate MD5 hash of a file
+    Calculate the hash of a file
+    
+    Uploads store their SHA-256 when they are written (File.sha256), so this
+    is only needed for files that were never hashed.
     
     Args:
         file_path: Path to the file
+        algorithm: hashlib algorithm name
         
     Returns:
-        str: MD5 hash of the file
+        str: Hex digest of the file
     """
-    hash_md5 = hashlib.md5()
+    hasher = hashlib.new(algorithm)
     with open(file_path, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
 
 def get_mime_type(file_path: str) -> str:
     """
@@ -37,6 +41,80 @@ def get_mime_type(file_path: str) -> str:
     mime_type, _ = mimetypes.guess_type(file_path)
     return mime_type or 'application/octet-stream'
 
+def allowed_file_checker():
+    """
+    Read the allowed_file_types system setting once and return a filename check.
+    Use this instead of allowed_file when checking many files in one request.
+
+    Returns:
+        callable: Function taking a filename and returning True if it may be uploaded
+    """
+    from app.models.system import SystemSetting
+
+    # Get allowed file types from system settings
+    allowed_types_setting = SystemSetting.query.filter_by(key='allowed_file_types').first()
+    if allowed_types_setting:
+        allowed_types = allowed_types_setting.get_typed_value()
+        if allowed_types == '*':
+            return lambda filename: True
+
+        allowed_extensions = set(allowed_types.split(','))
+        return lambda filename: '.' in filename and \
+            filename.rsplit('.', 1)[1].lower() in allowed_extensions
+
+    # Default allowed extensions if setting not found
+    return lambda filename: '.' in filename
+
+def allowed_file(filename: str) -> bool:
+    """
+    Check a filename against the allowed_file_types system setting
+
+    Args:
+        filename: Name of the file
+
+    Returns:
+        bool: True if the file type may be uploaded
+    """
+    return allowed_file_checker()(filename)
+
+def get_file_type(filename: str) -> str:
+    """
+    Categorize a file by its MIME type and extension
+
+    Args:
+        filename: Name of the file
+
+    Returns:
+        str: File category (image, video, document, archive, ...)
+    """
+    extension = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+    mime_type, _ = mimetypes.guess_type(filename)
+
+    # Categorize files
+    if mime_type:
+        if mime_type.startswith('image/'):
+            return 'image'
+        elif mime_type.startswith('video/'):
+            return 'video'
+        elif mime_type.startswith('audio/'):
+            return 'audio'
+        elif mime_type.startswith('text/'):
+            return 'document'
+        elif mime_type == 'application/pdf':
+            return 'document'
+        elif 'spreadsheet' in mime_type or 'excel' in mime_type:
+            return 'spreadsheet'
+        elif 'presentation' in mime_type or 'powerpoint' in mime_type:
+            return 'presentation'
+        elif mime_type.startswith('application/'):
+            return 'application'
+
+    # Based on extension
+    if extension in ['zip', 'rar', '7z', 'tar', 'gz']:
+        return 'archive'
+
+    return 'other'
+
 def create_unique_filename(original_filename: str) -> str:
     """
     Create a unique filename to avoid conflicts
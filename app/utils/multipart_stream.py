@@ -0,0 +1,95 @@
+from typing import BinaryIO, Iterator
+from werkzeug.datastructures import Headers
+from werkzeug.sansio.multipart import MultipartDecoder, NeedData, Field, File, Data, Epilogue
+
+class StreamedPart:
+    """
+    One part of a multipart body. The part's data must be consumed (or is
+    skipped automatically) before the parser moves on to the next part.
+    """
+
+    def __init__(self, parser: 'MultipartStreamParser', name: str, filename: str = None,
+                 headers: Headers = None) -> None:
+        self._parser = parser
+        self.name = name
+        self.filename = filename
+        self.headers = headers or Headers()
+        self._done = False
+
+    @property
+    def content_type(self) -> str:
+        return self.headers.get('Content-Type', 'application/octet-stream')
+
+    def __iter__(self) -> Iterator[bytes]:
+        """Yield the part's body in pieces as they arrive from the client"""
+        while not self._done:
+            event = self._parser._next_event()
+            if not isinstance(event, Data):
+                raise ValueError('Malformed multipart body')
+            self._done = not event.more_data
+            if event.data:
+                yield event.data
+
+    def read_text(self, max_size: int = 1024 * 1024) -> str:
+        """Read a (small) form field value completely"""
+        value = bytearray()
+        for data in self:
+            value.extend(data)
+            if len(value) > max_size:
+                raise ValueError(f'Form field {self.name} too large')
+        return value.decode('utf-8', 'replace')
+
+    def drain(self) -> None:
+        """Skip whatever is left of this part"""
+        for _ in self:
+            pass
+
+class MultipartStreamParser:
+    """
+    Incremental multipart/form-data parser that reads the request stream
+    on demand, instead of spooling every file to a temporary file first
+    the way request.files does.
+
+    Usage:
+        for part in MultipartStreamParser(request.stream, boundary):
+            if part.filename is None:
+                value = part.read_text()
+            else:
+                for data in part:
+                    out.write(data)
+    """
+
+    def __init__(self, stream: BinaryIO, boundary: bytes, read_size: int = 1024 * 1024) -> None:
+        self._stream = stream
+        self._decoder = MultipartDecoder(boundary)
+        self._read_size = read_size
+        self._eof = False
+
+    def _next_event(self):
+        while True:
+            event = self._decoder.next_event()
+            if not isinstance(event, NeedData):
+                return event
+            if self._eof:
+                raise ValueError('Unexpected end of multipart body')
+            data = self._stream.read(self._read_size)
+            if data:
+                self._decoder.receive_data(data)
+            else:
+                self._eof = True
+                self._decoder.receive_data(None)
+
+    def __iter__(self) -> Iterator[StreamedPart]:
+        while True:
+            event = self._next_event()
+            if isinstance(event, (Field, File)):
+                part = StreamedPart(
+                    self,
+                    name=event.name,
+                    filename=event.filename if isinstance(event, File) else None,
+                    headers=event.headers
+                )
+                yield part
+                part.drain()
+            elif isinstance(event, Epilogue):
+                return
@@ -0,0 +1,175 @@
+"""
+Pack storage for small files.
+
+Folder uploads bring thousands of tiny files; stored one file each, every
+one costs an inode, a directory entry and a seek to read or back up. Blobs
+of up to PACK_MAX_FILE_SIZE bytes are instead appended to a pack: a segment
+file under UPLOAD_FOLDER/packs that grows to PACK_SEGMENT_SIZE before the
+next one is started. The Blob row holds the segment (file_path) and the
+offset of the data; stored_size is its length.
+
+Each process appends to its own segments, <pid>-<start time>-<number>.pack,
+so no locking across processes is needed. Segments are never modified in
+place. Deleted blobs leave dead bytes behind; the janitor rewrites the live
+blobs of sealed segments that are mostly dead into the current segment and
+removes segments nothing refers to anymore.
+"""
+import glob
+import os
+import threading
+import time
+from typing import Callable
+from flask import current_app
+from sqlalchemy import bindparam, func
+from app.models.user import db
+from app.models.file import Blob, File
+from app.utils.downloads import FileRegion
+from app.utils.storage import sync_paths, write_at
+from app.utils.upload_journal import ENTRY_MAX_AGE, is_running, process_tag
+
+PACK_SUFFIX = '.pack'
+
+class PackStore:
+    """This process's current segment, which small blobs are appended to"""
+
+    def __init__(self, directory: str, segment_size: int = 256 * 1024 * 1024) -> None:
+        self.directory = directory
+        self.segment_size = segment_size
+        self.path = None
+        self._tag = process_tag()
+        self._lock = threading.Lock()
+        self._number = 0
+        self._fd = None
+        self._end = 0
+
+    def append(self, data: bytes, sync: Callable[[list[int]], None] = None) -> tuple:
+        """
+        Append data to the current segment. The data itself is not synced;
+        callers pass the returned path to sync_paths once they are done.
+
+        Args:
+            data: Bytes to store
+            sync: Makes a newly started segment's directory entry durable
+
+        Returns:
+            tuple: (segment path, offset of data in it)
+        """
+        with self._lock:
+            if self._fd is None or (self._end and self._end + len(data) > self.segment_size):
+                self._start_segment(sync)
+            offset = self._end
+            write_at(self._fd, data, offset)
+            self._end += len(data)
+            return self.path, offset
+
+    def _start_segment(self, sync: Callable[[list[int]], None]) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        os.makedirs(self.directory, exist_ok=True)
+        self._number += 1
+        self.path = os.path.join(self.directory, f'{self._tag}-{self._number:06d}{PACK_SUFFIX}')
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666)
+        self._end = 0
+        sync_paths([self.directory], sync)
+
+def init_pack_store(app) -> PackStore:
+    store = PackStore(os.path.join(app.config['UPLOAD_FOLDER'], 'packs'),
+                      app.config.get('PACK_SEGMENT_SIZE', 256 * 1024 * 1024))
+    app.extensions['pack_store'] = store
+    return store
+
+def get_pack_store() -> PackStore:
+    return current_app.extensions['pack_store']
+
+def pack_threshold() -> int:
+    """Largest blob that is packed; 0 if packing is off"""
+    return current_app.config.get('PACK_MAX_FILE_SIZE', 64 * 1024)
+
+def sealed_segments(directory: str) -> list[str]:
+    """
+    Segments no process appends to anymore: those of processes that are
+    gone, and all but the newest of each running process
+    """
+    owners = {}
+    for path in glob.glob(os.path.join(directory, '*' + PACK_SUFFIX)):
+        tag, _, number = os.path.basename(path)[:-len(PACK_SUFFIX)].rpartition('-')
+        if number.isdigit():
+            owners.setdefault(tag, []).append((int(number), path))
+
+    sealed = []
+    for tag, segments in owners.items():
+        segments.sort()
+        if is_running(tag):
+            segments.pop()
+        sealed.extend(path for _, path in segments)
+    return sealed
+
+def _rewrite_segment(store: PackStore, path: str, sync: Callable[[list[int]], None]) -> None:
+    """Move the live blobs of a segment to the current one and drop the segment"""
+    rows = db.session.query(Blob.id, Blob.pack_offset, Blob.stored_size).filter(
+        Blob.file_path == path,
+        Blob.pack_offset.isnot(None)
+    ).all()
+    blob_updates = []
+    written = set()
+    for blob_id, offset, length in rows:
+        with FileRegion(path, offset, length) as region:
+            new_path, new_offset = store.append(region.read(), sync)
+        written.add(new_path)
+        blob_updates.append({'b_id': blob_id, 'b_old': path, 'b_path': new_path, 'b_offset': new_offset})
+    sync_paths(written, sync)
+
+    if blob_updates:
+        # Blobs released in the meantime are gone and simply not updated
+        db.session.execute(
+            Blob.__table__.update()
+            .where(Blob.__table__.c.id == bindparam('b_id'))
+            .where(Blob.__table__.c.file_path == bindparam('b_old'))
+            .values(file_path=bindparam('b_path'), pack_offset=bindparam('b_offset')),
+            blob_updates
+        )
+        db.session.execute(
+            File.__table__.update()
+            .where(File.__table__.c.blob_id == bindparam('b_id'))
+            .values(file_path=bindparam('b_path')),
+            [{'b_id': update['b_id'], 'b_path': update['b_path']} for update in blob_updates]
+        )
+    db.session.commit()
+    if Blob.query.filter_by(file_path=path).first() is None:
+        os.remove(path)
+
+def compact_packs(stats: dict) -> None:
+    """
+    Remove sealed segments without live blobs and rewrite those whose live
+    data is less than PACK_COMPACT_RATIO of their size. Segments written to
+    within ENTRY_MAX_AGE are left alone, since a transaction that appended
+    to them may not have committed yet.
+    """
+    from app.utils.blob_store import file_sync
+
+    store = get_pack_store()
+    ratio = current_app.config.get('PACK_COMPACT_RATIO', 0.5)
+    live = {}  # segment -> (blobs, bytes)
+    rows = db.session.query(Blob.file_path, func.count(Blob.id), func.sum(Blob.stored_size)).filter(
+        Blob.pack_offset.isnot(None)
+    ).group_by(Blob.file_path)
+    for path, count, used in rows:
+        live[path] = (count, used or 0)
+    sync = file_sync()
+    cutoff = time.time() - ENTRY_MAX_AGE
+
+    for path in sealed_segments(store.directory):
+        if os.path.getmtime(path) > cutoff:
+            continue
+        count, used = live.get(path, (0, 0))
+        if not count:
+            os.remove(path)
+            stats['packs_removed'] += 1
+        elif used < os.path.getsize(path) * ratio:
+            try:
+                _rewrite_segment(store, path, sync)
+                stats['packs_compacted'] += 1
+            except Exception as e:
+                db.session.rollback()
+                print(f"Error compacting pack {path}: {e}")
@@ -0,0 +1,160 @@
+from datetime import datetime, timedelta
+from sqlalchemy import inspect
+from app.models.user import db, User
+from app.models.upload import QuotaReservation
+
+# Reservations of single requests; one still held after this long belongs to
+# a request that died without releasing it
+DEFAULT_RESERVATION_TTL = timedelta(hours=12)
+
+class QuotaExceeded(Exception):
+    """Raised when a user's quota cannot cover the requested bytes"""
+
+    def __init__(self, user_id: int, size: int) -> None:
+        super().__init__(f'Quota of user {user_id} cannot cover {size} bytes')
+        self.user_id = user_id
+        self.size = size
+
+def _expire_usage(user: User) -> None:
+    # The counters were changed in SQL; reload them on next access
+    db.session.expire(user, ['storage_used', 'storage_reserved'])
+
+def _reservation_id(reservation: QuotaReservation) -> str:
+    # Read from the identity key: refreshing the object fails once
+    # expire_reservations has deleted its row
+    state = inspect(reservation)
+    if state.identity is None:
+        db.session.flush()
+    return state.identity[0]
+
+def _take_reservation(reservation: QuotaReservation) -> tuple:
+    """Delete a reservation's row; returns (user ID, size), or None if it was already released"""
+    reservation_id = _reservation_id(reservation)
+    row = db.session.query(QuotaReservation.user_id, QuotaReservation.size).filter_by(id=reservation_id).first()
+    if row is None:
+        return None
+    deleted = QuotaReservation.query.filter_by(id=reservation_id).delete(synchronize_session=False)
+    return tuple(row) if deleted else None
+
+def available_quota(user: User) -> int:
+    """Bytes the user can still store, counting reservations of other uploads"""
+    return max(user.storage_quota - user.storage_used - user.storage_reserved, 0)
+
+def reserve_quota(user: User, size: int, ttl: timedelta = DEFAULT_RESERVATION_TTL,
+                  partial: bool = False) -> QuotaReservation:
+    """
+    Set aside quota for an upload before any data is written.
+
+    The check and the increment are a single conditional UPDATE, so
+    concurrent uploads of the same user can't both pass the check and
+    overshoot the quota. The caller should commit right away so other
+    requests see the reservation.
+
+    Args:
+        user: Uploading user
+        size: Bytes to reserve
+        ttl: How long the reservation may live, None to keep it until released
+        partial: Reserve whatever is left if less than size is available
+
+    Returns:
+        QuotaReservation: The new reservation (raises QuotaExceeded if nothing could be reserved)
+    """
+    users = User.__table__
+    amount = size
+    for _ in range(3):
+        if partial:
+            amount = min(size, available_quota(user))
+            if amount <= 0:
+                break
+        result = db.session.execute(
+            users.update()
+            .where(users.c.id == user.id)
+            .where(users.c.storage_used + users.c.storage_reserved + amount <= users.c.storage_quota)
+            .values(storage_reserved=users.c.storage_reserved + amount)
+        )
+        _expire_usage(user)
+        if result.rowcount:
+            reservation = QuotaReservation(
+                user_id=user.id,
+                size=amount,
+                expires_at=datetime.utcnow() + ttl if ttl else None
+            )
+            db.session.add(reservation)
+            return reservation
+        if not partial:
+            break
+        # Another upload reserved space since it was read; try again
+    raise QuotaExceeded(user.id, size)
+
+def charge_quota(user: User, size: int) -> None:
+    """
+    Add size bytes to the user's usage if the quota allows it, in one
+    conditional UPDATE. Used where no reservation was taken up front.
+    Negative sizes (a file that shrank) are always applied.
+    """
+    users = User.__table__
+    query = users.update().where(users.c.id == user.id)
+    if size > 0:
+        query = query.where(users.c.storage_used + users.c.storage_reserved + size <= users.c.storage_quota)
+    result = db.session.execute(query.values(storage_used=users.c.storage_used + size))
+    _expire_usage(user)
+    if not result.rowcount:
+        raise QuotaExceeded(user.id, size)
+
+def commit_reservation(user: User, reservation: QuotaReservation, used: int) -> None:
+    """
+    Turn a reservation into usage once the upload is recorded. Unused bytes
+    go back to the user. Runs in the caller's transaction so the usage is
+    committed together with the File rows.
+
+    Args:
+        user: Owner of the reservation
+        reservation: Reservation taken for the upload
+        used: Bytes actually stored
+    """
+    taken = _take_reservation(reservation)
+    if taken is None:
+        # Expired and released in the meantime, charge the quota directly
+        charge_quota(user, used)
+        return
+    size = taken[1]
+    users = User.__table__
+    db.session.execute(
+        users.update()
+        .where(users.c.id == user.id)
+        .values(storage_reserved=users.c.storage_reserved - size,
+                storage_used=users.c.storage_used + used)
+    )
+    _expire_usage(user)
+
+def release_reservation(reservation: QuotaReservation) -> None:
+    """Give reserved bytes back after a failed or cancelled upload. The caller commits."""
+    taken = _take_reservation(reservation)
+    if taken is None:
+        return
+    user_id, size = taken
+    users = User.__table__
+    db.session.execute(
+        users.update()
+        .where(users.c.id == user_id)
+        .values(storage_reserved=users.c.storage_reserved - size)
+    )
+    user = User.query.get(user_id)
+    if user is not None:
+        _expire_usage(user)
+
+def expire_reservations() -> int:
+    """
+    Release reservations left behind by requests that never finished
+
+    Returns:
+        int: Number of reservations released
+    """
+    expired = QuotaReservation.query.filter(
+        QuotaReservation.expires_at.isnot(None),
+        QuotaReservation.expires_at <= datetime.utcnow()
+    ).all()
+    for reservation in expired:
+        release_reservation(reservation)
+    db.session.commit()
+    return len(expired)
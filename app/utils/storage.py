@@ -0,0 +1,502 @@
+import os
+import base64
+import binascii
+import ctypes
+import errno
+import hashlib
+import shutil
+import sys
+import threading
+import time
+import uuid
+import zlib
+from typing import Callable
+
+# Digest header algorithm tokens (RFC 3230 / RFC 9530) mapped to hashlib names
+DIGEST_ALGORITHMS = {
+    'md5': 'md5',
+    'sha': 'sha1',
+    'sha-1': 'sha1',
+    'sha-256': 'sha256',
+    'sha-512': 'sha512',
+}
+STORED_DIGESTS = ('sha256', 'crc32')  # Computed for every upload while it is written
+
+class SizeLimitExceeded(Exception):
+    """Raised by StorageWriter when more bytes arrive than the writer allows"""
+
+    def __init__(self, limit: int) -> None:
+        super().__init__(f'Size limit of {limit} bytes exceeded')
+        self.limit = limit
+
+class DigestMismatch(Exception):
+    """Raised when stored data does not match a digest the client sent"""
+
+    def __init__(self, algorithm: str, expected: str, actual: str) -> None:
+        super().__init__(f'{algorithm} checksum mismatch: expected {expected}, got {actual}')
+        self.algorithm = algorithm
+        self.expected = expected
+        self.actual = actual
+
+def _decode_digest(value: str, algorithm: str) -> str:
+    value = value.strip().strip(':')
+    digest_size = hashlib.new(algorithm).digest_size
+    # Some clients send hex instead of base64
+    if len(value) == digest_size * 2:
+        try:
+            bytes.fromhex(value)
+            return value.lower()
+        except ValueError:
+            pass
+    try:
+        raw = base64.b64decode(value, validate=True)
+    except (binascii.Error, ValueError):
+        raise ValueError(f'Invalid {algorithm} digest: {value}')
+    if len(raw) != digest_size:
+        raise ValueError(f'Invalid {algorithm} digest: {value}')
+    return raw.hex()
+
+def parse_digest_headers(headers) -> dict:
+    """
+    Collect the digests a client declared for a body
+
+    Understands Digest (RFC 3230), Content-Digest (RFC 9530) and Content-MD5.
+    Unknown algorithms are ignored; malformed values raise ValueError.
+
+    Args:
+        headers: Request, response or multipart part headers
+
+    Returns:
+        dict: hashlib algorithm name -> expected lowercase hex digest
+    """
+    expected = {}
+    for header in ('Digest', 'Content-Digest'):
+        value = headers.get(header)
+        if not value:
+            continue
+        for item in value.split(','):
+            token, sep, encoded = item.strip().partition('=')
+            algorithm = DIGEST_ALGORITHMS.get(token.strip().lower())
+            if sep and algorithm:
+                expected[algorithm] = _decode_digest(encoded, algorithm)
+
+    content_md5 = headers.get('Content-MD5')
+    if content_md5:
+        expected['md5'] = _decode_digest(content_md5, 'md5')
+    return expected
+
+class Crc32:
+    """
+    CRC-32 with the interface of a hashlib object. Kept with stored content
+    because ZIP headers need it (see app.utils.zip_stream).
+    """
+    name = 'crc32'
+
+    def __init__(self) -> None:
+        self.value = 0
+
+    def update(self, data: bytes) -> None:
+        self.value = zlib.crc32(data, self.value)
+
+    def digest(self) -> bytes:
+        return self.value.to_bytes(4, 'big')
+
+    def hexdigest(self) -> str:
+        return f'{self.value:08x}'
+
+def new_hasher(name: str):
+    """hashlib object for name, also accepting 'crc32'"""
+    return Crc32() if name == 'crc32' else hashlib.new(name)
+
+class DigestVerifier:
+    """Hash data as it passes through and check it against expected digests"""
+
+    def __init__(self, expected: dict = None, hash_algorithms: tuple = ()) -> None:
+        self.expected = expected or {}
+        self._hashers = {name: new_hasher(name) for name in set(hash_algorithms) | set(self.expected)}
+
+    def update(self, data: bytes) -> None:
+        for hasher in self._hashers.values():
+            hasher.update(data)
+
+    def hexdigest(self, name: str) -> str:
+        return self._hashers[name].hexdigest()
+
+    def verify(self) -> None:
+        for name, expected in self.expected.items():
+            actual = self.hexdigest(name)
+            if actual != expected:
+                raise DigestMismatch(name, expected, actual)
+
+def allocate(fd: int, size: int) -> bool:
+    """
+    Reserve disk blocks for the first size bytes of an open file, so they are
+    laid out in one go instead of extent by extent as writes arrive. Returns
+    False where posix_fallocate is unavailable or not supported by the
+    filesystem.
+    """
+    if size <= 0 or not hasattr(os, 'posix_fallocate'):
+        return False
+    try:
+        os.posix_fallocate(fd, 0, size)
+        return True
+    except OSError as e:
+        if e.errno in (errno.EINVAL, errno.EOPNOTSUPP, getattr(errno, 'ENOTSUP', errno.EOPNOTSUPP)):
+            return False
+        raise
+
+def preallocate(fd: int, size: int) -> None:
+    """
+    Reserve size bytes for an open file so positional writes never have to
+    grow it. Falls back to a sparse file where posix_fallocate is unavailable.
+    """
+    if size > 0 and not allocate(fd, size):
+        os.ftruncate(fd, size)
+
+def write_at(fd: int, data: bytes, offset: int) -> None:
+    """Write all of data at offset without touching the shared file position"""
+    view = memoryview(data)
+    while view:
+        if hasattr(os, 'pwrite'):
+            written = os.pwrite(fd, view, offset)
+        else:
+            # Windows has no pwrite; the descriptor is private to the caller
+            os.lseek(fd, offset, os.SEEK_SET)
+            written = os.write(fd, view)
+        view = view[written:]
+        offset += written
+
+# Errors meaning the kernel can't copy between these two files, not that the copy failed
+_NO_KERNEL_COPY = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, getattr(errno, 'ENOTSUP', errno.EOPNOTSUPP)}
+COPY_BUFFER_SIZE = 1024 * 1024  # 1MB
+
+def filesystem_id(path: str) -> int:
+    """Device ID of the filesystem holding path, or the nearest existing parent"""
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return os.stat(path).st_dev
+
+def same_filesystem(path: str, other: str) -> bool:
+    """Whether a file can be renamed from one path to the other"""
+    return filesystem_id(path) == filesystem_id(other)
+
+def copy_file(src: str, dst: str) -> None:
+    """
+    Copy src to dst inside the kernel: copy_file_range (which shares extents
+    on filesystems with reflinks and copies server-side on NFS), then
+    sendfile, then a buffered copy where neither works for the two files.
+    """
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        src_fd, dst_fd = fsrc.fileno(), fdst.fileno()
+        size = os.fstat(src_fd).st_size
+        offset = 0
+
+        if hasattr(os, 'copy_file_range'):
+            try:
+                while offset < size:
+                    copied = os.copy_file_range(src_fd, dst_fd, size - offset, offset, offset)
+                    if not copied:
+                        break
+                    offset += copied
+                return
+            except OSError as e:
+                if e.errno not in _NO_KERNEL_COPY:
+                    raise
+
+        if hasattr(os, 'sendfile'):
+            try:
+                # sendfile writes at the destination's file position
+                os.lseek(dst_fd, offset, os.SEEK_SET)
+                while offset < size:
+                    copied = os.sendfile(dst_fd, src_fd, offset, size - offset)
+                    if not copied:
+                        break
+                    offset += copied
+                return
+            except OSError as e:
+                if e.errno not in _NO_KERNEL_COPY:
+                    raise
+
+        fsrc.seek(offset)
+        fdst.seek(offset)
+        shutil.copyfileobj(fsrc, fdst, COPY_BUFFER_SIZE)
+
+def move_file(src: str, dst: str, sync: Callable[[list[int]], None] = None) -> None:
+    """
+    Move src to dst, replacing dst. On the same filesystem this is a single
+    atomic rename. Across filesystems the data is copied with copy_file()
+    to a temporary name beside dst and renamed into place, so dst never
+    holds a partial file, and src is removed afterwards. The copy is flushed
+    with sync (see sync_paths) before the rename, if given.
+    """
+    try:
+        os.replace(src, dst)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+
+    temp_path = f'{dst}.{uuid.uuid4().hex}.tmp'
+    try:
+        copy_file(src, temp_path)
+        sync_paths([temp_path], sync)
+        os.replace(temp_path, dst)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    os.remove(src)
+
+def fsync_each(fds: list[int]) -> None:
+    """Flush each open file to stable storage"""
+    for fd in fds:
+        os.fsync(fd)
+
+def sync_paths(paths: list[str], sync: Callable[[list[int]], None]) -> None:
+    """
+    Flush files, or directories whose entries changed (files created or
+    renamed into them), to stable storage with sync (see fsync_each and
+    GroupSync). Does nothing if sync is None; directories are skipped on
+    Windows, where they can't be opened.
+    """
+    if sync is None:
+        return
+    fds = []
+    try:
+        for path in set(paths):
+            if os.path.isdir(path):
+                if os.name == 'nt':
+                    continue
+                fds.append(os.open(path, os.O_RDONLY))
+            else:
+                fds.append(os.open(path, os.O_RDWR | getattr(os, 'O_BINARY', 0)))
+        sync(fds)
+    finally:
+        for fd in fds:
+            os.close(fd)
+
+def _load_syncfs():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        return ctypes.CDLL(None, use_errno=True).syncfs
+    except (OSError, AttributeError):
+        return None
+
+class GroupSync:
+    """
+    Group commit for fsync. Files finished at about the same time are made
+    durable together: a single thread collects the requests arriving within
+    window seconds, then flushes each filesystem involved with one syncfs
+    (Linux) instead of an fsync per file, whose journal commits would
+    otherwise queue up behind each other. Where syncfs is unavailable, or
+    only one file of a filesystem is waiting, the files are fsynced.
+
+    Usage:
+        group = GroupSync(window=0.005)
+        group.sync([fd])  # blocks until fd's data is on disk
+    """
+
+    def __init__(self, window: float = 0.005) -> None:
+        self.window = window
+        self._syncfs = _load_syncfs()
+        self._condition = threading.Condition()
+        self._pending = []
+        self._thread = None
+
+    def sync(self, fds: list[int]) -> None:
+        """Wait until the open files are flushed, raising OSError if that failed"""
+        requests = [{'fd': fd, 'done': threading.Event(), 'error': None} for fd in fds]
+        if not requests:
+            return
+        with self._condition:
+            self._pending.extend(requests)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='group-sync', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        for request in requests:
+            request['done'].wait()
+        for request in requests:
+            if request['error'] is not None:
+                raise request['error']
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+            # Let other writers finishing now join the batch
+            time.sleep(self.window)
+            with self._condition:
+                batch, self._pending = self._pending, []
+            try:
+                self._flush(batch)
+            except Exception as e:
+                print(f"Error syncing files: {e}")
+                for request in batch:
+                    if not request['done'].is_set():
+                        request['error'] = e
+                        request['done'].set()
+
+    def _flush(self, batch: list[dict]) -> None:
+        by_device = {}
+        for request in batch:
+            try:
+                by_device.setdefault(os.fstat(request['fd']).st_dev, []).append(request)
+            except OSError as e:
+                request['error'] = e
+                request['done'].set()
+
+        for requests in by_device.values():
+            if self._syncfs is not None and len(requests) > 1:
+                if self._syncfs(requests[0]['fd']) == 0:
+                    for request in requests:
+                        request['done'].set()
+                    continue
+                # Fall back to syncing the files one by one
+            for request in requests:
+                try:
+                    os.fsync(request['fd'])
+                except OSError as e:
+                    request['error'] = e
+                request['done'].set()
+
+WRITE_BLOCK_SIZE = 1024 * 1024  # 1MB; data reaches the disk in whole aligned blocks
+
+class StorageWriter:
+    """
+    Write an incoming byte stream to its final storage path in a single pass.
+
+    Size limits and (optional) digests are checked as the data arrives, so an
+    oversized file is rejected as soon as it crosses the limit and no second
+    read of the stored file is needed. If expected_digests are given they are
+    verified when the with-block ends; on a mismatch the file is removed and
+    DigestMismatch is raised.
+
+    Incoming chunks are gathered into WRITE_BLOCK_SIZE blocks, so the disk
+    sees large writes at aligned offsets whatever size the chunks are. When
+    the size is known up front (expected_size) the file's blocks are
+    allocated before the first write, which keeps large files from being
+    fragmented; the file is trimmed if less data arrives. With sync (see
+    fsync_each and GroupSync) the data is on stable storage once finish()
+    returns.
+
+    Usage:
+        with StorageWriter(save_path, max_size=limit) as writer:
+            for data in part:
+                writer.write(data)
+        size = writer.size
+    """
+
+    def __init__(self, path: str, max_size: int = None, hash_algorithms: tuple = (),
+                 expected_digests: dict = None, expected_size: int = None,
+                 sync: Callable[[list[int]], None] = None) -> None:
+        self.path = path
+        self.max_size = max_size
+        self.size = 0
+        self._digests = DigestVerifier(expected_digests, hash_algorithms)
+        self._sync = sync
+        self._buffer = bytearray()
+        self._allocated = 0
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o666)
+        if expected_size:
+            try:
+                if allocate(self._fd, expected_size):
+                    self._allocated = expected_size
+            except OSError:
+                self.abort()
+                raise
+
+    def write(self, data: bytes) -> None:
+        if self.max_size is not None and self.size + len(data) > self.max_size:
+            raise SizeLimitExceeded(self.max_size)
+        self._digests.update(data)
+        self.size += len(data)
+
+        view = memoryview(data)
+        while view:
+            if not self._buffer and len(view) >= WRITE_BLOCK_SIZE:
+                # Whole blocks go straight to the file without a copy
+                whole = len(view) - len(view) % WRITE_BLOCK_SIZE
+                self._write_all(view[:whole])
+                view = view[whole:]
+                continue
+            room = WRITE_BLOCK_SIZE - len(self._buffer)
+            self._buffer += view[:room]
+            view = view[room:]
+            if len(self._buffer) == WRITE_BLOCK_SIZE:
+                self._flush_buffer()
+
+    def hexdigest(self, name: str) -> str:
+        return self._digests.hexdigest(name)
+
+    def _write_all(self, data) -> None:
+        with memoryview(data) as view:
+            while view:
+                written = os.write(self._fd, view)
+                view = view[written:]
+
+    def _flush_buffer(self) -> None:
+        if self._buffer:
+            self._write_all(self._buffer)
+            self._buffer.clear()
+
+    def _complete(self) -> None:
+        # Write what is left and give back blocks allocated beyond the data
+        self._flush_buffer()
+        if self._allocated > self.size:
+            os.ftruncate(self._fd, self.size)
+            self._allocated = 0
+
+    def close(self) -> int:
+        """Finish writing and return the number of bytes stored"""
+        if self._fd is not None:
+            try:
+                self._complete()
+            finally:
+                os.close(self._fd)
+                self._fd = None
+        return self.size
+
+    def finish(self) -> int:
+        """
+        Close the file and check the expected digests, removing it on a
+        mismatch. The file is synced before it is closed if the writer was
+        given a sync function.
+        """
+        try:
+            self._complete()
+            self._digests.verify()
+            if self._sync is not None:
+                self._sync([self._fd])
+        except Exception:
+            self.abort()
+            raise
+        return self.close()
+
+    def abort(self) -> None:
+        """Discard the partially written file"""
+        try:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+        finally:
+            try:
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+            except Exception as e:
+                print(f"Error removing partial file {self.path}: {e}")
+
+    def __enter__(self) -> 'StorageWriter':
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is None:
+            self.finish()
+        else:
+            self.abort()
@@ -104,6 +104,9 @@ def collect_metrics(self):
             
             # Clean up expired trash items if enabled
             self.cleanup_trash()
+            
+            # Discard abandoned resumable upload sessions
+            self.cleanup_upload_sessions()
     
     def cleanup_trash(self):
         """
@@ -125,14 +128,9 @@ def cleanup_trash(self):
             File.expiry_date <= now
         ).all()
         
-        # Delete expired files
+        # Delete expired files (shared blobs are kept while still referenced)
         for file in expired_files:
-            try:
-                if os.path.exists(file.file_path):
-                    os.remove(file.file_path)
-            except Exception as e:
-                print(f"Error deleting file {file.file_path}: {e}")
-            db.session.delete(file)
+            file.permanently_delete()
         
         # Get expired folders
         expired_folders = Folder.query.filter(
@@ -157,6 +155,29 @@ def cleanup_trash(self):
             db.session.add(activity)
             db.session.commit()
     
+    def cleanup_upload_sessions(self):
+        """
+        Abort expired upload sessions and remove their staging files, release
+        quota reservations of uploads that never finished and reclaim files
+        they left behind
+        """
+        # Import here to avoid circular imports
+        from app.utils.uploads import cleanup_expired_upload_sessions
+        from app.utils.quota import expire_reservations
+        from app.utils.upload_journal import run_janitor
+        
+        removed = cleanup_expired_upload_sessions()
+        if removed:
+            print(f"Removed {removed} expired upload sessions")
+        
+        released = expire_reservations()
+        if released:
+            print(f"Released {released} expired quota reservations")
+        
+        reclaimed = run_janitor()
+        if any(reclaimed.values()):
+            print(f"Upload janitor: {reclaimed}")
+    
     def monitoring_thread(self):
         """
         Background thread for periodic monitoring
@@ -1,9 +1,14 @@
 import time
 import io
-from flask import request, g, Response
-from typing import Callable
+import threading
+from datetime import datetime
+from flask import request, g, Response, current_app
+from typing import Callable, Iterable
 from functools import wraps
 from werkzeug.datastructures import FileStorage
+from app.models.user import db
+from app.models.activity import Activity
+from app.utils.downloads import CountingStream
 
 class TransferSpeedTracker:
     """
@@ -105,20 +110,30 @@ def close(self) -> None:
 
 class TrackableResponse:
     """
-    Response wrapper that tracks bytes sent
+    Response wrapper that tracks bytes sent. The body is counted while the
+    server sends it and the tracker stopped when it is closed; it is never
+    read into memory.
     """
     
-    def __init__(self, response: Response, tracker: TransferSpeedTracker) -> None:
+    def __init__(self, response: Response, tracker: TransferSpeedTracker,
+                 on_stop: Callable[[dict], None] = None) -> None:
         self.response = response
         self.tracker = tracker
         
-        # Wrap the response data to track bytes
-        original_data = self.response.data
-        self.response.data = original_data
-        self.tracker.update(len(original_data))
+        def stop(bytes_sent: int) -> None:
+            tracker.update(bytes_sent)
+            metrics = tracker.stop()
+            if on_stop is not None:
+                on_stop(metrics)
+        
+        # Wrap the response body to track bytes
+        self.response.response = CountingStream(self.response.response, stop)
     
     def __getattr__(self, name):
         return getattr(self.response, name)
+    
+    def __call__(self, environ, start_response):
+        return self.response(environ, start_response)
 
 def track_upload() -> Callable:
     """Decorator to track file upload speed and time"""
@@ -159,13 +174,125 @@ def decorated_function(*args, **kwargs):
             # Get the response
             response = f(*args, **kwargs)
             
-            # Wrap the response to track bytes sent
-            trackable_response = TrackableResponse(response, tracker)
-            
-            # Get metrics
-            metrics = tracker.stop()
-            g.download_metrics = metrics
-            
-            return trackable_response
+            # Wrap the response to track bytes sent; metrics are known once it is sent
+            return TrackableResponse(response, tracker)
         return decorated_function
-    return decorator 
\ No newline at end of file
+    return decorator
+
+class TransferLog:
+    """
+    Activities of finished transfers, inserted in batches by a background
+    thread. A download's metrics are only known once the server has sent
+    the body, after the request is over, so they are not written there.
+    """
+    
+    def __init__(self, app, interval: float = 2.0) -> None:
+        self.app = app
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._pending = []
+        self._thread = None
+    
+    def record(self, values: dict) -> None:
+        """Queue an Activity, given as column values"""
+        with self._lock:
+            self._pending.append(values)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='transfer-log', daemon=True)
+                self._thread.start()
+    
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+    
+    def flush(self) -> int:
+        """Insert the queued activities now; returns how many were written"""
+        with self._lock:
+            batch, self._pending = self._pending, []
+        if not batch:
+            return 0
+        with self.app.app_context():
+            try:
+                db.session.execute(Activity.__table__.insert(), batch)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                print(f"Error recording {len(batch)} transfers: {e}")
+                return 0
+            finally:
+                db.session.remove()
+        return len(batch)
+
+def init_transfer_log(app) -> TransferLog:
+    log = TransferLog(app, interval=app.config.get('TRANSFER_LOG_INTERVAL', 2.0))
+    app.extensions['transfer_log'] = log
+    return log
+
+def get_transfer_log() -> TransferLog:
+    return current_app.extensions['transfer_log']
+
+class DownloadTracker:
+    """
+    Records a download's Activity once its body is closed, with the true
+    duration, the bytes sent and whether the transfer completed.
+    
+    Usage:
+        tracker = DownloadTracker(user_id, 'download', file.original_filename, file.size, file.file_type)
+        response = tracker.watch(send_stored_file(file, mime_type, on_close=tracker.finish))
+    """
+    
+    def __init__(self, user_id: int, action: str, target: str, file_size: int = None,
+                 file_type: str = None, details: str = None) -> None:
+        self.start_time = time.time()
+        self.expected = None
+        self._log = get_transfer_log()
+        self._values = {
+            'user_id': user_id,
+            'action': action,
+            'target': target,
+            'details': details,
+            'file_size': file_size,
+            'file_type': file_type,
+            'timestamp': datetime.utcnow()
+        }
+        self._done = False
+        self._ended = None
+    
+    def watch(self, response: Response) -> Response:
+        """Note the length of the body the response is meant to send"""
+        self.expected = response.content_length
+        return response
+    
+    def stream(self, iterable: Iterable[bytes]) -> CountingStream:
+        """
+        Body over iterable for a response whose length isn't known up
+        front, recorded once it is closed. The download is complete if the
+        server took it to its end.
+        """
+        self._ended = False
+        
+        def chunks():
+            yield from iterable
+            self._ended = True
+        
+        return CountingStream(chunks(), on_close=self.finish)
+    
+    def finish(self, bytes_sent: int) -> None:
+        """
+        on_close callback of the response body (see send_region). bytes_sent
+        is None when the front-end server sent the file.
+        """
+        if self._done:
+            return
+        self._done = True
+        # Rows are inserted together, so each has every column
+        values = dict(self._values, bytes_sent=bytes_sent, duration=None, transfer_speed=None, completed=None)
+        if bytes_sent is not None:
+            duration = max(time.time() - self.start_time, 0.0001)  # avoid division by zero
+            values.update(duration=duration, transfer_speed=bytes_sent / duration)
+            if self.expected is not None:
+                values['completed'] = bytes_sent >= self.expected
+            elif self._ended is not None:
+                values['completed'] = self._ended
+        self._log.record(values) 
\ No newline at end of file
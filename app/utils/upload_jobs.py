@@ -0,0 +1,245 @@
+"""
+Background finalization of uploads.
+
+A client that sends `Prefer: respond-async` gets 202 and a job ID as soon as
+its data has been received; storing the files, hashing and writing their
+records then happens in a worker thread. Progress is kept in memory while
+the job runs, so polling and event streams don't hit the database, and the
+UploadJob row records the outcome once the job is done.
+
+Jobs run in the process that accepted the upload; one that was running when
+the server stopped stays in the processing state.
+"""
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Iterator
+from flask import Response, current_app, jsonify, request, stream_with_context, url_for
+from app.models.user import db
+from app.models.upload import UploadJob
+
+class JobProgress:
+    """Live progress of a running job, shared with the requests reporting it"""
+
+    def __init__(self, files: list[dict]) -> None:
+        self._lock = threading.Lock()
+        self.files = [dict(file, status='pending') for file in files]
+        self.status = 'queued'
+        self.processed_files = 0
+        self.processed_bytes = 0
+
+    def start(self) -> None:
+        with self._lock:
+            self.status = 'processing'
+            for file in self.files:
+                file['status'] = 'processing'
+
+    def add_bytes(self, size: int) -> None:
+        """Account for size bytes of work (hashed or stored) on the current file"""
+        with self._lock:
+            self.processed_bytes += size
+
+    def file_done(self, index: int, count_bytes: bool = True, **info) -> None:
+        """
+        Mark file number index as stored
+
+        Args:
+            index: Position of the file in the job's file list
+            count_bytes: Add the file's size to the processed bytes
+            info: Extra details to report for the file (e.g. its file ID)
+        """
+        with self._lock:
+            file = self.files[index]
+            if file['status'] == 'done':
+                return
+            file.update(info, status='done')
+            self.processed_files += 1
+            if count_bytes:
+                self.processed_bytes += file.get('size') or 0
+
+    def fail(self) -> None:
+        # Jobs record their files in one transaction, so none of them was kept
+        with self._lock:
+            for file in self.files:
+                file['status'] = 'failed'
+            self.status = 'failed'
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'status': self.status,
+                'processed_files': self.processed_files,
+                'processed_bytes': self.processed_bytes,
+                'files': [dict(file) for file in self.files]
+            }
+
+class UploadJobRunner:
+    """Thread pool running upload jobs, and the progress of those in flight"""
+
+    def __init__(self, app, workers: int = 2) -> None:
+        self.app = app
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='upload-job')
+        self._lock = threading.Lock()
+        self._progress = {}
+
+    def submit(self, job: UploadJob, func: Callable, *args) -> None:
+        """
+        Run func(progress, *args) for a committed job. func runs in its own
+        app context and database session; it must load what it needs by ID
+        and commit its own work, reporting through the JobProgress it gets.
+        """
+        progress = JobProgress(job.get_files())
+        with self._lock:
+            self._progress[job.id] = progress
+        self._executor.submit(self._run, job.id, progress, func, args)
+
+    def progress(self, job_id: str) -> dict:
+        """Live progress of a job that is still running, or None"""
+        with self._lock:
+            progress = self._progress.get(job_id)
+        return progress.snapshot() if progress is not None else None
+
+    def _run(self, job_id: str, progress: JobProgress, func: Callable, args: tuple) -> None:
+        with self.app.app_context():
+            try:
+                UploadJob.query.filter_by(id=job_id).update({'status': 'processing'})
+                db.session.commit()
+                progress.start()
+                try:
+                    func(progress, *args)
+                    status, error = 'completed', None
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"Error in upload job {job_id}: {e}")
+                    status, error = 'failed', getattr(e, 'message', None) or str(e)
+                    progress.fail()
+
+                state = progress.snapshot()
+                UploadJob.query.filter_by(id=job_id).update({
+                    'status': status,
+                    'error': error,
+                    'processed_files': state['processed_files'],
+                    'processed_bytes': state['processed_bytes'],
+                    'files': json.dumps(state['files']),
+                    'finished_at': datetime.utcnow()
+                })
+                db.session.commit()
+            except Exception as e:
+                print(f"Error running upload job {job_id}: {e}")
+                db.session.rollback()
+            finally:
+                with self._lock:
+                    self._progress.pop(job_id, None)
+                db.session.remove()
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait)
+
+def init_upload_jobs(app) -> UploadJobRunner:
+    """Create the app's upload job runner from its configuration"""
+    runner = UploadJobRunner(app, workers=app.config.get('UPLOAD_JOB_WORKERS', 2))
+    app.extensions['upload_jobs'] = runner
+    return runner
+
+def get_job_runner() -> UploadJobRunner:
+    return current_app.extensions['upload_jobs']
+
+def prefers_async() -> bool:
+    """Whether the client asked for 202 and a job instead of waiting (RFC 7240)"""
+    return 'respond-async' in request.headers.get('Prefer', '').lower()
+
+def create_upload_job(user_id: int, kind: str, files: list[dict]) -> UploadJob:
+    """
+    Add a queued job for files ({name, size} each). The caller commits
+    before submitting it.
+    """
+    job = UploadJob(
+        user_id=user_id,
+        kind=kind,
+        status='queued',
+        total_files=len(files),
+        total_bytes=sum(file.get('size') or 0 for file in files)
+    )
+    job.set_files([dict(file, status='pending') for file in files])
+    db.session.add(job)
+    return job
+
+def get_upload_job(job_id: str, user_id: int) -> UploadJob:
+    """Look up a job owned by user_id, or None"""
+    return UploadJob.query.filter_by(id=job_id, user_id=user_id).first()
+
+def job_status(job: UploadJob) -> dict:
+    """The job's state, with live progress while it is running"""
+    data = job.to_dict()
+    if not job.is_finished():
+        live = get_job_runner().progress(job.id)
+        if live is not None:
+            data.update(live)
+    return data
+
+def job_accepted_response(job: UploadJob, endpoint_prefix: str, **extra):
+    """
+    202 response for a queued job, pointing to where its progress is reported
+
+    Args:
+        job: Queued job
+        endpoint_prefix: Endpoint prefix of the blueprint's job routes, e.g.
+                         'files.upload_job' for files.upload_job_status/_events
+        extra: Additional fields for the JSON body
+    """
+    status_url = url_for(f'{endpoint_prefix}_status', job_id=job.id)
+    response = jsonify(dict(
+        extra,
+        success=True,
+        job=job_status(job),
+        status_url=status_url,
+        events_url=url_for(f'{endpoint_prefix}_events', job_id=job.id)
+    ))
+    response.status_code = 202
+    response.headers['Location'] = status_url
+    response.headers['Preference-Applied'] = 'respond-async'
+    return response
+
+def job_events_response(job: UploadJob) -> Response:
+    """text/event-stream response following job until it has finished"""
+    return Response(
+        stream_with_context(job_events(job)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+def job_events(job: UploadJob, interval: float = 0.5) -> Iterator[str]:
+    """
+    Server-sent events with the job's state whenever it changes, ending
+    once the job has finished. Meant to be wrapped in stream_with_context.
+
+    Args:
+        job: Job to follow, already checked to belong to the user
+    """
+    runner = get_job_runner()
+    job_id = job.id
+    data = job_status(job)
+    last = None
+    while True:
+        if data != last:
+            yield f'data: {json.dumps(data)}\n\n'
+            last = data
+        if job is None or job.is_finished():
+            return
+        time.sleep(interval)
+        live = runner.progress(job_id)
+        if live is not None:
+            data = dict(data, **live)
+        else:
+            # Finished, or left behind by a restarted server; end the read
+            # transaction so the worker's commit is visible
+            db.session.rollback()
+            job = UploadJob.query.get(job_id)
+            if job is None:
+                return
+            data = job.to_dict()
+            if not job.is_finished():
+                yield f'data: {json.dumps(data)}\n\n'
+                return
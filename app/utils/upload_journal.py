@@ -0,0 +1,284 @@
+"""
+Write-ahead journal and janitor for upload storage.
+
+Uploaded files are moved into the blob store before the transaction that
+records them commits. If the process dies in between (or the transaction
+fails), the blob files are left without Blob rows and nothing refers to
+them. Before such a move the journal lists the target paths; the entry is
+closed when the database session commits.
+
+Each process appends to its own file, UPLOAD_FOLDER/.journal/<pid>-<start
+time>.journal, so the janitor can tell the journals of processes that are
+gone from those still in use. For every entry left open by a dead process,
+or open in this process for longer than any upload transaction takes, the
+janitor keeps the files that made it into the database (the upload
+completed) and deletes the rest.
+
+The janitor also sweeps temp files that outlived any upload, staging files
+of sessions that no longer exist, and jobs interrupted by a restart, and
+compacts pack segments (see app.utils.packs). It runs at startup and with
+the system monitor.
+"""
+import glob
+import json
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Callable
+import psutil
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from app.models.user import db
+from app.models.file import Blob
+from app.models.upload import UploadSession, UploadJob
+from app.utils.storage import sync_paths
+
+JOURNAL_SUFFIX = '.journal'
+COMPACT_AFTER = 1000  # Closed entries before the journal file is rewritten
+ENTRY_MAX_AGE = 3600  # Seconds; an entry open this long lost its transaction
+RECENT_FILE_AGE = 900  # Seconds; younger files may belong to an upload in progress
+STAGING_GRACE = 3600  # Seconds a staging file may exist before its session is committed
+
+def process_tag(pid: int = None) -> str:
+    """Identifies a process (this one by default) across PID reuse: <pid>-<start time>"""
+    process = psutil.Process(pid)
+    return f'{process.pid}-{int(process.create_time())}'
+
+def is_running(tag: str) -> bool:
+    """Whether the process a process_tag() was taken from is still running"""
+    pid, _, started = tag.partition('-')
+    try:
+        return process_tag(int(pid)) == f'{pid}-{started}'
+    except (psutil.Error, ValueError):
+        return False
+
+class UploadJournal:
+    """This process's journal of blob files whose rows are not committed yet"""
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        self.path = os.path.join(directory, process_tag() + JOURNAL_SUFFIX)
+        self._lock = threading.Lock()
+        self._open = {}  # entry ID -> record
+        self._closed = 0
+        self._file = None
+
+    def begin(self, paths: list[str], sync: Callable[[list[int]], None] = None) -> str:
+        """
+        Record that paths are about to be created; returns the entry ID. With
+        sync (see app.utils.storage.sync_paths) the entry is on disk before
+        this returns, so it survives a power failure along with the files.
+        """
+        record = {'id': uuid.uuid4().hex, 'time': time.time(), 'paths': paths}
+        with self._lock:
+            created = self._file is None
+            self._append(record)
+            if sync is not None:
+                sync([self._file.fileno()])
+                if created:
+                    sync_paths([self.directory], sync)
+            self._open[record['id']] = record
+        return record['id']
+
+    def end(self, entry_id: str) -> None:
+        """Close an entry once its files are committed or cleaned up"""
+        with self._lock:
+            if self._open.pop(entry_id, None) is None:
+                return
+            self._closed += 1
+            if not self._open or self._closed >= COMPACT_AFTER:
+                self._compact()
+            else:
+                self._append({'id': entry_id, 'end': True})
+
+    def track(self, paths: list[str], sync: Callable[[list[int]], None] = None) -> None:
+        """
+        Journal paths until the current database session commits. On a
+        rollback the entry stays open and the janitor settles it later.
+        """
+        if not paths:
+            return
+        entry_id = self.begin(paths, sync)
+        db.session.info.setdefault('upload_journal', []).append((self, entry_id))
+
+    def stale_entries(self, max_age: float = ENTRY_MAX_AGE) -> list[dict]:
+        cutoff = time.time() - max_age
+        with self._lock:
+            return [record for record in self._open.values() if record['time'] <= cutoff]
+
+    def _append(self, record: dict) -> None:
+        if self._file is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._file = open(self.path, 'a', encoding='utf-8')
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+
+    def _compact(self) -> None:
+        # Rewrite the file with only the open entries, or drop it if there are none
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._closed = 0
+        if not self._open:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            return
+        temp_path = f'{self.path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            for record in self._open.values():
+                f.write(json.dumps(record) + '\n')
+        os.replace(temp_path, self.path)
+
+@event.listens_for(Session, 'after_commit')
+def _end_journal_entries(session) -> None:
+    if session.in_nested_transaction():
+        # A savepoint; the files are recorded once the outer transaction commits
+        return
+    for journal, entry_id in session.info.pop('upload_journal', []):
+        journal.end(entry_id)
+
+@event.listens_for(Session, 'after_rollback')
+def _keep_journal_entries(session) -> None:
+    if session.in_nested_transaction():
+        return
+    # The files were not recorded; a later commit in this session must not close the entries
+    session.info.pop('upload_journal', None)
+
+def read_journal(path: str) -> list[dict]:
+    """Entries of a journal file that were never closed"""
+    entries = {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Torn last line of a process that died mid-write
+                continue
+            if record.get('end'):
+                entries.pop(record['id'], None)
+            else:
+                entries[record['id']] = record
+    return list(entries.values())
+
+def init_upload_journal(app) -> UploadJournal:
+    journal = UploadJournal(os.path.join(app.config['UPLOAD_FOLDER'], '.journal'))
+    app.extensions['upload_journal'] = journal
+    return journal
+
+def get_journal() -> UploadJournal:
+    return current_app.extensions['upload_journal']
+
+def _settle_paths(paths: list[str]) -> tuple[bool, int]:
+    """
+    Delete the files of an abandoned entry that no Blob row refers to
+
+    Returns:
+        tuple: (whether the entry is settled, number of files deleted)
+    """
+    settled = True
+    removed = 0
+    now = time.time()
+    for path in paths:
+        # Partial copies of a cross-device move (see move_file)
+        for temp_path in glob.glob(glob.escape(path) + '.*.tmp'):
+            os.remove(temp_path)
+            removed += 1
+        if not os.path.exists(path) or Blob.query.filter_by(file_path=path).first() is not None:
+            continue
+        if now - os.path.getmtime(path) < RECENT_FILE_AGE:
+            # Same content may be being stored by another upload right now
+            settled = False
+            continue
+        os.remove(path)
+        removed += 1
+    return settled, removed
+
+def recover_journals(stats: dict) -> None:
+    """Settle entries of dead processes' journals and this process's stale entries"""
+    journal = get_journal()
+    for path in glob.glob(os.path.join(journal.directory, '*' + JOURNAL_SUFFIX)):
+        if path == journal.path or is_running(os.path.basename(path)[:-len(JOURNAL_SUFFIX)]):
+            continue
+        settled = True
+        for record in read_journal(path):
+            done, removed = _settle_paths(record['paths'])
+            settled = settled and done
+            stats['orphan_blobs'] += removed
+        if settled:
+            os.remove(path)
+
+    for record in journal.stale_entries():
+        done, removed = _settle_paths(record['paths'])
+        stats['orphan_blobs'] += removed
+        if done:
+            journal.end(record['id'])
+
+def _sweep(directory: str, max_age: float, keep: set = frozenset()) -> int:
+    if not os.path.isdir(directory):
+        return 0
+    cutoff = time.time() - max_age
+    removed = 0
+    for entry in os.scandir(directory):
+        if entry.is_file() and entry.path not in keep and entry.stat().st_mtime <= cutoff:
+            try:
+                os.remove(entry.path)
+                removed += 1
+            except Exception as e:
+                print(f"Error removing stale file {entry.path}: {e}")
+    return removed
+
+def sweep_temp_files(stats: dict) -> None:
+    """Remove temp files no upload is writing anymore and orphaned staging files"""
+    config = current_app.config
+    max_age = config.get('UPLOAD_TEMP_MAX_AGE_HOURS', 6) * 3600
+    stats['temp_files'] += _sweep(os.path.join(config['UPLOAD_FOLDER'], 'blobs', 'tmp'), max_age)
+
+    # Staging files belong to a session until it is completed or aborted
+    live = {row[0] for row in db.session.query(UploadSession.staging_path).filter(
+        UploadSession.status.in_(('active', 'finalizing'))
+    )}
+    for root in (config.get('TEMP_UPLOAD_PATH'), os.path.join(config['UPLOAD_FOLDER'], '.staging')):
+        if root:
+            stats['staging_files'] += _sweep(os.path.join(root, 'sessions'), STAGING_GRACE, live)
+
+def fail_interrupted_jobs(stats: dict) -> None:
+    """Mark jobs that have not finished long after they were accepted as failed"""
+    from app.utils.upload_jobs import get_job_runner
+    runner = get_job_runner()
+    cutoff = datetime.utcnow() - timedelta(hours=current_app.config.get('UPLOAD_JOB_TIMEOUT_HOURS', 6))
+    jobs = UploadJob.query.filter(
+        UploadJob.status.in_(('queued', 'processing')),
+        UploadJob.created_at <= cutoff
+    ).all()
+    for job in jobs:
+        if runner.progress(job.id) is not None:
+            continue
+        job.status = 'failed'
+        job.error = 'Interrupted by a server restart'
+        job.finished_at = datetime.utcnow()
+        stats['interrupted_jobs'] += 1
+    db.session.commit()
+
+def run_janitor() -> dict:
+    """
+    Reclaim storage left behind by uploads that never finished. Needs an
+    app context.
+
+    Returns:
+        dict: Counts of orphan_blobs, temp_files and staging_files removed,
+              interrupted_jobs failed, and packs_removed and packs_compacted
+    """
+    from app.utils.packs import compact_packs
+
+    stats = {'orphan_blobs': 0, 'temp_files': 0, 'staging_files': 0, 'interrupted_jobs': 0,
+             'packs_removed': 0, 'packs_compacted': 0}
+    for step in (recover_journals, sweep_temp_files, fail_interrupted_jobs, compact_packs):
+        try:
+            step(stats)
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error in upload janitor ({step.__name__}): {e}")
+    return stats
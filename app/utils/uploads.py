@@ -0,0 +1,1127 @@
+import os
+import uuid
+from datetime import datetime, timedelta
+from typing import BinaryIO, Callable
+from flask import current_app
+from app.models.user import db, User
+from app.models.file import File, Folder, Blob
+from app.models.activity import Activity
+from app.models.system import SystemSetting
+from sqlalchemy import bindparam
+from sqlalchemy.exc import IntegrityError
+from app.models.upload import UploadSession, UploadChunk, QuotaReservation, UploadJob
+from app.utils.file_utils import allowed_file, allowed_file_checker, get_file_type
+from app.utils.storage import (STORED_DIGESTS, StorageWriter, SizeLimitExceeded, DigestVerifier, DigestMismatch,
+                               parse_digest_headers, preallocate, write_at, move_file, sync_paths)
+from app.utils.blob_store import (blob_path, file_sync, hash_file, new_temp_path, place_blob, staging_dir,
+                                  store_blob, sync_target)
+from app.utils.compression import choose_codec, codec_chooser, iter_content, iter_stored
+from app.utils.delta import apply_delta
+from app.utils.admission import AdmissionRejected, get_admission
+from app.utils.quota import (QuotaExceeded, available_quota, reserve_quota, charge_quota,
+                             commit_reservation, release_reservation)
+from app.utils.upload_jobs import JobProgress, create_upload_job, get_job_runner
+from app.utils.upload_journal import get_journal
+
+COPY_BUFFER_SIZE = 1024 * 1024  # 1MB
+MULTIPART_OVERHEAD_ALLOWANCE = 1024 * 1024  # Boundaries and part headers around the file data
+
+class UploadError(Exception):
+    """
+    Raised when an upload request cannot be processed. Routes turn it into
+    a JSON error response with the given status code.
+    """
+
+    def __init__(self, message: str, status_code: int = 400) -> None:
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+def get_max_upload_size(default: int = 2000 * 1024 * 1024 * 1024) -> int:
+    """
+    Get the per-file upload limit from system settings
+
+    Args:
+        default: Limit used when the setting is missing (2TB)
+
+    Returns:
+        int: Maximum file size in bytes
+    """
+    max_size_setting = SystemSetting.query.filter_by(key='max_upload_size').first()
+    return int(max_size_setting.value) if max_size_setting else default
+
+def declared_digests(headers) -> dict:
+    """
+    Get the digests a client declared in Digest/Content-Digest/Content-MD5
+    headers, rejecting malformed values
+
+    Returns:
+        dict: hashlib algorithm name -> expected hex digest
+    """
+    try:
+        return parse_digest_headers(headers)
+    except ValueError as e:
+        raise UploadError(str(e))
+
+def parse_declared_sizes(value: str) -> list[int]:
+    """
+    Parse the X-File-Sizes header, in which clients list the size of every
+    file in a multipart upload (comma-separated, in order)
+
+    Returns:
+        list: File sizes in bytes (empty if the header is missing)
+    """
+    if not value:
+        return []
+    try:
+        sizes = [int(size) for size in value.split(',')]
+    except ValueError:
+        raise UploadError('Invalid X-File-Sizes header')
+    if any(size < 0 for size in sizes):
+        raise UploadError('Invalid X-File-Sizes header')
+    return sizes
+
+def check_upload_request(user: User, content_length: int, declared_sizes: list[int], max_size: int,
+                         single_file: bool = False) -> None:
+    """
+    Refuse a multipart upload that can't succeed before any of its body is read
+
+    Uses the exact file sizes the client declared if there are any, and
+    otherwise the Content-Length less an allowance for the multipart framing.
+
+    Args:
+        user: Uploading user
+        content_length: Declared length of the request body (None if unknown)
+        declared_sizes: Result of parse_declared_sizes
+        max_size: Per-file size limit
+        single_file: The request carries exactly one file (API uploads)
+    """
+    available = available_quota(user)
+    if declared_sizes:
+        if any(size > max_size for size in declared_sizes):
+            raise UploadError('File too large', 413)
+        if sum(declared_sizes) > available:
+            raise UploadError('Not enough storage space', 507)
+        return
+
+    if not content_length:
+        return
+    payload = content_length - MULTIPART_OVERHEAD_ALLOWANCE
+    if single_file and payload > max_size:
+        raise UploadError('File too large', 413)
+    if payload > available:
+        raise UploadError('Not enough storage space', 507)
+
+def get_upload_root_folder(user_id: int, folder_id: int = None) -> Folder:
+    """
+    Get the folder an upload targets, falling back to the user's root folder
+
+    Args:
+        user_id: ID of the uploading user
+        folder_id: Requested target folder ID
+
+    Returns:
+        Folder: Target folder (the root folder is created if missing)
+    """
+    current_folder = None
+    if folder_id:
+        current_folder = Folder.query.filter_by(id=folder_id, user_id=user_id).first()
+    if not current_folder:
+        current_folder = Folder.query.filter_by(user_id=user_id, parent_id=None).first()
+        if not current_folder:
+            current_folder = Folder(name='root', user_id=user_id)
+            db.session.add(current_folder)
+            db.session.commit()
+    return current_folder
+
+def resolve_upload_folder(base_folder: Folder, relative_path: str, user_id: int,
+                          created_folders: dict) -> tuple[Folder, str]:
+    """
+    Resolve the folder of a file inside a folder upload, creating missing folders
+
+    Args:
+        base_folder: Folder the upload was started in
+        relative_path: Path of the file relative to base_folder (e.g. "a/b/c.txt")
+        user_id: ID of the uploading user
+        created_folders: Cache of already resolved paths, shared across one request
+
+    Returns:
+        tuple: (parent folder, bare filename)
+    """
+    if '/' not in relative_path:
+        return base_folder, os.path.basename(relative_path)
+
+    # Split path into folder parts
+    path_parts = relative_path.split('/')
+    filename = path_parts.pop()  # Last part is the filename
+
+    parent_folder = base_folder
+    current_path = ""
+    for folder_name in path_parts:
+        if not folder_name:  # Skip empty folder names
+            continue
+
+        # Build current path for folder tracking
+        current_path = os.path.join(current_path, folder_name) if current_path else folder_name
+
+        # Check if we've already resolved this folder
+        if current_path in created_folders:
+            parent_folder = created_folders[current_path]
+            continue
+
+        existing_folder = Folder.query.filter_by(
+            name=folder_name,
+            parent_id=parent_folder.id,
+            user_id=user_id,
+            is_deleted=False
+        ).first()
+
+        if existing_folder:
+            parent_folder = existing_folder
+        else:
+            new_folder = Folder(
+                name=folder_name,
+                parent_id=parent_folder.id,
+                user_id=user_id
+            )
+            db.session.add(new_folder)
+            db.session.flush()  # Get the ID without committing
+            parent_folder = new_folder
+
+        created_folders[current_path] = parent_folder
+
+    return parent_folder, filename
+
+def unique_upload_filename(filename: str, folder_id: int, user_id: int) -> str:
+    """
+    Add a timestamp to filename if the folder already contains a file with that name
+
+    Args:
+        filename: Desired display filename
+        folder_id: Target folder ID
+        user_id: Owner of the folder
+
+    Returns:
+        str: Filename that does not clash with existing files
+    """
+    existing_file = File.query.filter_by(
+        original_filename=filename,
+        folder_id=folder_id,
+        user_id=user_id,
+        is_deleted=False
+    ).first()
+
+    if existing_file:
+        name_parts = os.path.splitext(filename)
+        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+        filename = f"{name_parts[0]}_{timestamp}{name_parts[1]}"
+    return filename
+
+def record_uploaded_file(user: User, folder: Folder, filename: str, blob: Blob,
+                         action: str = 'upload', details: str = None,
+                         reservation: QuotaReservation = None) -> File:
+    """
+    Add the File row, storage accounting and activity for a stored upload.
+    The caller is responsible for committing the session.
+
+    Args:
+        user: Uploading user
+        folder: Folder the file is placed in
+        filename: Display filename
+        blob: Blob holding the content, with a reference taken for this file
+        reservation: Quota reserved for the upload; without one the quota is
+                     charged directly (raises QuotaExceeded if it is full)
+
+    Returns:
+        File: The new (uncommitted) file record
+    """
+    file_type = get_file_type(filename)
+    file_size = blob.size
+
+    # Update user storage quota
+    if reservation is not None:
+        commit_reservation(user, reservation, file_size)
+    else:
+        charge_quota(user, file_size)
+
+    new_file = File(
+        filename=blob.sha256,
+        original_filename=filename,
+        file_path=blob.file_path,
+        size=file_size,
+        file_type=file_type,
+        user_id=user.id,
+        folder_id=folder.id,
+        blob=blob,
+        sha256=blob.sha256
+    )
+    db.session.add(new_file)
+
+    activity = Activity(
+        user_id=user.id,
+        action=action,
+        target=filename,
+        details=details or f'Uploaded to folder {folder.name}',
+        file_size=file_size,
+        file_type=file_type
+    )
+    db.session.add(activity)
+    return new_file
+
+class _PendingFolder:
+    """A folder created by an upload batch that has not been inserted yet"""
+
+    def __init__(self, name: str, parent, depth: int) -> None:
+        self.name = name
+        self.parent = parent  # Folder ID or another _PendingFolder
+        self.depth = depth
+        self.id = None
+
+class UploadBatch:
+    """
+    Metadata of one multipart upload, resolved in memory and written in bulk.
+
+    The user's folders are loaded with one query when the batch is created,
+    so resolving a relative path ("a/b/c.txt") is a dict lookup, and the names
+    already used in a target folder are read once per folder. Folder, Blob,
+    File and Activity rows for every stored file are inserted together by
+    flush() in a handful of statements instead of several per file. File data
+    is still written while the request streams in; flush() only moves the
+    finished temp files into the blob store.
+
+    Usage:
+        batch = UploadBatch(user, base_folder)
+        folder, filename = batch.resolve(relative_path, is_folder_upload)
+        ... stream the part to a temp file ...
+        batch.add_file(folder, filename, temp_path, sha256, size, crc32)
+        batch.flush(reservation)
+        db.session.commit()
+    """
+
+    def __init__(self, user: User, base_folder: Folder) -> None:
+        self.user = user
+        self.base_folder = base_folder
+        self.allowed_file = allowed_file_checker()
+        self.pending_bytes = 0  # Size of added files, not yet charged to the quota
+        self._folder_names = {base_folder.id: base_folder.name}
+        self._children = {}  # (parent ID or _PendingFolder, name) -> folder ID or _PendingFolder
+        self._new_folders = []
+        self._used_names = {}  # folder ID or _PendingFolder -> names taken in that folder
+        self._files = []
+        self._crc32 = {}  # sha256 -> CRC-32 taken while the file was written
+
+        rows = db.session.query(Folder.id, Folder.parent_id, Folder.name).filter_by(
+            user_id=user.id,
+            is_deleted=False
+        )
+        for folder_id, parent_id, name in rows:
+            self._folder_names[folder_id] = name
+            # Keep the first folder if several share a name, like a query would
+            self._children.setdefault((parent_id, name), folder_id)
+
+    def resolve(self, relative_path: str, is_folder_upload: bool = True) -> tuple:
+        """
+        Find the target folder of a file, creating missing folders in memory
+
+        Args:
+            relative_path: Path relative to the base folder (e.g. "a/b/c.txt")
+            is_folder_upload: Whether directory parts of the path are kept
+
+        Returns:
+            tuple: (folder ID or pending folder, bare filename)
+        """
+        parent = self.base_folder.id
+        if not is_folder_upload or '/' not in relative_path:
+            return parent, os.path.basename(relative_path)
+
+        path_parts = relative_path.split('/')
+        filename = path_parts.pop()
+        depth = 0
+        for folder_name in path_parts:
+            if not folder_name:  # Skip empty folder names
+                continue
+            depth += 1
+            child = self._children.get((parent, folder_name))
+            if child is None:
+                child = _PendingFolder(folder_name, parent, depth)
+                self._new_folders.append(child)
+                self._children[(parent, folder_name)] = child
+            parent = child
+        return parent, filename
+
+    def unique_filename(self, folder, filename: str) -> str:
+        """
+        Add a timestamp to filename if the folder already contains a file with
+        that name, counting files added earlier in this batch
+        """
+        used = self._used_names.get(folder)
+        if used is None:
+            used = set()
+            if not isinstance(folder, _PendingFolder):
+                rows = db.session.query(File.original_filename).filter_by(
+                    folder_id=folder,
+                    user_id=self.user.id,
+                    is_deleted=False
+                )
+                used.update(row[0] for row in rows)
+            self._used_names[folder] = used
+
+        if filename in used:
+            name_parts = os.path.splitext(filename)
+            timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+            candidate = f"{name_parts[0]}_{timestamp}{name_parts[1]}"
+            counter = 1
+            while candidate in used:
+                candidate = f"{name_parts[0]}_{timestamp}_{counter}{name_parts[1]}"
+                counter += 1
+            filename = candidate
+        used.add(filename)
+        return filename
+
+    def add_file(self, folder, filename: str, temp_path: str, sha256: str, size: int, crc32: int = None) -> None:
+        """Queue a fully written temp file to be stored and recorded by flush()"""
+        self._files.append((folder, filename, temp_path, sha256, size))
+        if crc32 is not None:
+            self._crc32[sha256] = crc32
+        self.pending_bytes += size
+
+    def __len__(self) -> int:
+        return len(self._files)
+
+    def describe(self) -> list[dict]:
+        """Name and size of every queued file, in the order flush() reports them"""
+        return [{'name': filename, 'size': size} for _, filename, _, _, size in self._files]
+
+    def _insert_folders(self) -> None:
+        # One batch per depth, so every parent has its ID before its children
+        levels = {}
+        for folder in self._new_folders:
+            levels.setdefault(folder.depth, []).append(folder)
+        for depth in sorted(levels):
+            rows = []
+            for pending in levels[depth]:
+                parent_id = pending.parent.id if isinstance(pending.parent, _PendingFolder) else pending.parent
+                rows.append(Folder(name=pending.name, parent_id=parent_id, user_id=self.user.id))
+            db.session.add_all(rows)
+            db.session.flush()
+            for pending, row in zip(levels[depth], rows):
+                pending.id = row.id
+                self._folder_names[row.id] = row.name
+
+    def _store_blobs(self, on_stored: Callable[[int], None] = None) -> dict:
+        """Move the temp files into the blob store; returns sha256 -> (blob ID, path)"""
+        references = {}
+        temp_paths = {}
+        sizes = {}
+        codecs = {}
+        indexes = {}
+        choose_codec = codec_chooser()
+        for index, (_, filename, temp_path, sha256, size) in enumerate(self._files):
+            references[sha256] = references.get(sha256, 0) + 1
+            indexes.setdefault(sha256, []).append(index)
+            if sha256 in temp_paths:
+                # Same content twice in one upload, only one copy is kept
+                os.remove(temp_path)
+            else:
+                temp_paths[sha256] = temp_path
+                sizes[sha256] = size
+                codecs[sha256] = choose_codec(filename)
+
+        existing = {}
+        digests = list(references)
+        for start in range(0, len(digests), 500):
+            query = db.session.query(Blob.id, Blob.sha256, Blob.file_path).filter(
+                Blob.sha256.in_(digests[start:start + 500])
+            )
+            for blob_id, sha256, path in query:
+                existing[sha256] = (blob_id, path)
+
+        # Journal the blob files about to be created until the batch is committed
+        sync = file_sync()
+        new_paths = [
+            blob_path(sha256) for sha256 in temp_paths
+            if sha256 not in existing or not os.path.exists(existing[sha256][1])
+        ]
+        get_journal().track(new_paths, sync)
+
+        stored = {}
+        new_rows = []
+        ref_updates = []
+        restored = []
+        written = set()
+        for sha256, temp_path in temp_paths.items():
+            blob = existing.get(sha256)
+            if blob is not None and os.path.exists(blob[1]):
+                os.remove(temp_path)
+                stored[sha256] = blob
+                ref_updates.append({'b_id': blob[0], 'refs': references[sha256]})
+            else:
+                path, offset, codec, stored_size = place_blob(temp_path, blob_path(sha256), codecs[sha256], sync)
+                written.add(sync_target(path, offset))
+                if blob is not None:
+                    # Row survived but the data went missing, the new copy restores it
+                    stored[sha256] = (blob[0], path)
+                    ref_updates.append({'b_id': blob[0], 'refs': references[sha256]})
+                    restored.append({'b_id': blob[0], 'b_path': path, 'b_offset': offset,
+                                     'b_codec': codec, 'b_stored_size': stored_size})
+                else:
+                    new_rows.append({'sha256': sha256, 'file_path': path, 'pack_offset': offset,
+                                     'size': sizes[sha256], 'codec': codec, 'stored_size': stored_size,
+                                     'crc32': self._crc32.get(sha256), 'ref_count': references[sha256], 'created_at': datetime.utcnow()})
+            if on_stored is not None:
+                for index in indexes[sha256]:
+                    on_stored(index)
+        sync_paths(written, sync)
+
+        if ref_updates:
+            # Increment in SQL so concurrent uploads of the same content don't lose counts
+            db.session.execute(
+                Blob.__table__.update()
+                .where(Blob.__table__.c.id == bindparam('b_id'))
+                .values(ref_count=Blob.__table__.c.ref_count + bindparam('refs')),
+                ref_updates
+            )
+        if restored:
+            db.session.execute(
+                Blob.__table__.update()
+                .where(Blob.__table__.c.id == bindparam('b_id'))
+                .values(file_path=bindparam('b_path'), pack_offset=bindparam('b_offset'),
+                        codec=bindparam('b_codec'), stored_size=bindparam('b_stored_size')),
+                restored
+            )
+
+        if new_rows:
+            try:
+                with db.session.begin_nested():
+                    db.session.execute(Blob.__table__.insert(), new_rows)
+            except IntegrityError:
+                # Some content was stored by a concurrent upload meanwhile;
+                # take references one by one (our copies become orphans or
+                # dead bytes in a pack, reclaimed by the janitor)
+                for row in new_rows:
+                    blob = Blob.query.filter_by(sha256=row['sha256']).first()
+                    if blob is None:
+                        db.session.add(Blob(**row))
+                    else:
+                        Blob.query.filter_by(id=blob.id).update(
+                            {Blob.ref_count: Blob.ref_count + row['ref_count']}, synchronize_session=False)
+                db.session.flush()
+            new_digests = [row['sha256'] for row in new_rows]
+            for start in range(0, len(new_digests), 500):
+                query = db.session.query(Blob.id, Blob.sha256, Blob.file_path).filter(
+                    Blob.sha256.in_(new_digests[start:start + 500])
+                )
+                for blob_id, sha256, path in query:
+                    stored[sha256] = (blob_id, path)
+        return stored
+
+    def flush(self, reservation: QuotaReservation = None, on_stored: Callable[[int], None] = None) -> int:
+        """
+        Store every queued file and insert all rows for the batch. The caller
+        is responsible for committing the session.
+
+        Args:
+            reservation: Quota reserved for the request, settled here; without
+                         one the quota is charged directly
+            on_stored: Called with a file's position in the batch once its
+                       content is in the blob store
+
+        Returns:
+            int: Number of files recorded
+        """
+        if not self._files:
+            if reservation is not None:
+                release_reservation(reservation)
+            return 0
+
+        # Charge the quota first so nothing is stored if it fails
+        if reservation is not None:
+            commit_reservation(self.user, reservation, self.pending_bytes)
+        else:
+            charge_quota(self.user, self.pending_bytes)
+
+        self._insert_folders()
+        blobs = self._store_blobs(on_stored)
+
+        file_rows = []
+        activity_rows = []
+        now = datetime.utcnow()
+        for folder, filename, _, sha256, size in self._files:
+            folder_id = folder.id if isinstance(folder, _PendingFolder) else folder
+            blob_id, path = blobs[sha256]
+            file_type = get_file_type(filename)
+            file_rows.append({
+                'filename': sha256,
+                'original_filename': filename,
+                'file_path': path,
+                'size': size,
+                'file_type': file_type,
+                'user_id': self.user.id,
+                'folder_id': folder_id,
+                'blob_id': blob_id,
+                'sha256': sha256,
+                'created_at': now,
+                'updated_at': now,
+                'is_deleted': False
+            })
+            activity_rows.append({
+                'user_id': self.user.id,
+                'action': 'upload',
+                'target': filename,
+                'details': f'Uploaded to folder {self._folder_names[folder_id]}',
+                'file_size': size,
+                'file_type': file_type,
+                'timestamp': now
+            })
+
+        db.session.execute(File.__table__.insert(), file_rows)
+        db.session.execute(Activity.__table__.insert(), activity_rows)
+
+        count = len(self._files)
+        self._files = []
+        self._crc32 = {}
+        self.pending_bytes = 0
+        return count
+
+    def discard(self) -> None:
+        """Remove the temp files of queued files that were not stored"""
+        for _, _, temp_path, _, _ in self._files:
+            try:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+            except Exception as e:
+                print(f"Error removing temp file {temp_path}: {e}")
+        self._files = []
+        self._crc32 = {}
+        self.pending_bytes = 0
+
+def find_owned_blob(user_id: int, sha256: str, size: int) -> Blob:
+    """
+    Find stored content matching a client-computed hash among the user's own
+    files. Only the user's files are considered, so a hash can't be used to
+    probe for (or claim) content uploaded by someone else.
+
+    Returns:
+        Blob: The matching blob, or None
+    """
+    blob = Blob.query.join(File, File.blob_id == Blob.id).filter(
+        File.user_id == user_id,
+        Blob.sha256 == sha256,
+        Blob.size == size
+    ).first()
+    if blob is None or not os.path.exists(blob.file_path):
+        return None
+    return blob
+
+def instant_upload(user: User, folder_id: int, entries: list[dict]) -> list[dict]:
+    """
+    Add files whose content the user already has stored without transferring
+    it again. Entries without a matching blob are reported back so the client
+    uploads them normally.
+
+    Args:
+        user: Uploading user
+        folder_id: Target folder (root folder if None)
+        entries: Dicts with filename, size, sha256 and relative_path (folder uploads)
+
+    Returns:
+        list: One {'instant': bool, 'file'/'error': ...} result per entry, in order
+    """
+    base_folder = get_upload_root_folder(user.id, folder_id)
+    created_folders = {}
+    max_size = get_max_upload_size()
+    results = []
+
+    for entry in entries:
+        filename = entry.get('filename')
+        relative_path = entry.get('relative_path')
+        size = entry.get('size')
+        sha256 = str(entry.get('sha256') or '').lower()
+        if not filename or not isinstance(size, int) or len(sha256) != 64:
+            results.append({'instant': False, 'error': 'Invalid entry'})
+            continue
+
+        blob = find_owned_blob(user.id, sha256, size)
+        if blob is None:
+            results.append({'instant': False})
+            continue
+
+        basename = os.path.basename(relative_path or filename)
+        if not allowed_file(basename):
+            results.append({'instant': False, 'error': f'File type not allowed: {basename}'})
+            continue
+        if size > max_size:
+            results.append({'instant': False, 'error': f'File too large: {basename}'})
+            continue
+
+        if relative_path:
+            parent_folder, filename = resolve_upload_folder(base_folder, relative_path, user.id, created_folders)
+        else:
+            parent_folder, filename = base_folder, basename
+        filename = unique_upload_filename(filename, parent_folder.id, user.id)
+
+        try:
+            with db.session.begin_nested():
+                blob.add_reference()
+                new_file = record_uploaded_file(user, parent_folder, filename, blob,
+                                                details=f'Uploaded to folder {parent_folder.name} (content already stored)')
+        except QuotaExceeded:
+            results.append({'instant': False, 'error': 'Not enough storage space'})
+            continue
+        results.append({'instant': True, 'file': new_file.to_dict()})
+
+    db.session.commit()
+    return results
+
+def apply_delta_upload(file: File, user: User, stream: BinaryIO, base_sha256: str,
+                       expected_digests: dict = None) -> tuple[File, int]:
+    """
+    Replace a file's content with a new version rebuilt from a delta stream
+    (see app.utils.delta) against its current content
+
+    Args:
+        file: File being updated, owned by user
+        user: Uploading user
+        stream: Request body holding the delta stream
+        base_sha256: SHA-256 of the version the client computed the delta against
+        expected_digests: Digests the client declared for the new version, which
+                          must include its SHA-256
+
+    Returns:
+        tuple: (updated File, number of literal bytes transferred)
+    """
+    if not base_sha256:
+        raise UploadError('base_sha256 is required')
+    if not (expected_digests or {}).get('sha256'):
+        # Blocks are matched by checksums; only the client's digest shows the
+        # rebuilt file is the version it has
+        raise UploadError('A Digest: sha-256=... header for the new version is required')
+    if not file.sha256 or base_sha256.lower() != file.sha256:
+        raise UploadError('File changed since its signature was taken', 412)
+
+    old_size = file.size
+    remaining_quota = available_quota(user) + old_size
+    max_size = get_max_upload_size()
+
+    base_path = file.file_path
+    if file.codec is not None or file.region is not None:
+        # The delta reads the base at arbitrary offsets; give it the plain content
+        base_path = new_temp_path()
+        with open(base_path, 'wb') as out:
+            for chunk in iter_content(file):
+                out.write(chunk)
+
+    try:
+        with open(base_path, 'rb') as base, \
+                StorageWriter(new_temp_path(), max_size=min(max_size, remaining_quota),
+                              hash_algorithms=STORED_DIGESTS, expected_digests=expected_digests,
+                              sync=file_sync()) as writer:
+            literal_bytes = apply_delta(base, stream, writer)
+    except SizeLimitExceeded:
+        if max_size <= remaining_quota:
+            raise UploadError('File too large', 413)
+        raise UploadError('Not enough storage space', 507)
+    except DigestMismatch as e:
+        raise UploadError(str(e))
+    except ValueError as e:
+        raise UploadError(f'Invalid delta: {e}')
+    finally:
+        if base_path != file.file_path:
+            os.remove(base_path)
+
+    # Another upload may have used the quota while the delta was applied
+    try:
+        charge_quota(user, writer.size - old_size)
+    except QuotaExceeded:
+        os.remove(writer.path)
+        raise UploadError('Not enough storage space', 507)
+
+    blob = store_blob(writer.path, writer.hexdigest('sha256'), writer.size, choose_codec(file.original_filename),
+                      crc32=int(writer.hexdigest('crc32'), 16))
+
+    # Drop the old content: shared blobs keep their other references, files
+    # stored before the blob store are only referenced by this row
+    if file.blob is not None:
+        file.blob.release()
+    else:
+        try:
+            if os.path.exists(file.file_path):
+                os.remove(file.file_path)
+        except Exception as e:
+            print(f"Error deleting file {file.file_path}: {e}")
+
+    file.blob = blob
+    file.filename = blob.sha256
+    file.file_path = blob.file_path
+    file.sha256 = blob.sha256
+    file.size = blob.size
+    file.updated_at = datetime.utcnow()
+
+    activity = Activity(
+        user_id=user.id,
+        action='upload',
+        target=file.original_filename,
+        details=f'Updated by delta upload ({literal_bytes} of {blob.size} bytes transferred)',
+        file_size=blob.size,
+        file_type=file.file_type
+    )
+    db.session.add(activity)
+    db.session.commit()
+    return file, literal_bytes
+
+def _session_staging_dir() -> str:
+    # Next to the blob store, so finalizing a session renames its file
+    return staging_dir('sessions')
+
+def get_upload_session(session_id: str, user_id: int) -> UploadSession:
+    """Look up an upload session owned by user_id, or None"""
+    return UploadSession.query.filter_by(id=session_id, user_id=user_id).first()
+
+def create_upload_session(user: User, folder_id: int, filename: str, total_size: int,
+                          relative_path: str = None) -> UploadSession:
+    """
+    Validate an upload up front and open a resumable session for it
+
+    Args:
+        user: Uploading user
+        folder_id: Target folder ID, as an int or numeric string (root folder if None)
+        filename: Name of the file, or its path for folder uploads
+        total_size: Declared size of the whole file in bytes, an int
+        relative_path: Path relative to the target folder for folder uploads
+
+    Returns:
+        UploadSession: The new session with a preallocated staging file
+    """
+    # Values come straight from the client's JSON
+    if not filename or not isinstance(filename, str):
+        raise UploadError('Filename is required')
+    if relative_path is not None and not isinstance(relative_path, str):
+        raise UploadError('relative_path must be a string')
+    if not isinstance(total_size, int) or isinstance(total_size, bool) or total_size < 0:
+        raise UploadError('File size is required')
+    if folder_id in (None, ''):
+        folder_id = None
+    elif isinstance(folder_id, str) and folder_id.isdigit():
+        folder_id = int(folder_id)
+    elif not isinstance(folder_id, int) or isinstance(folder_id, bool):
+        raise UploadError('Invalid folder_id')
+
+    basename = os.path.basename(relative_path or filename)
+    if not allowed_file(basename):
+        raise UploadError(f'File type not allowed: {basename}')
+    if total_size > get_max_upload_size():
+        raise UploadError(f'File too large: {basename}', 413)
+    try:
+        get_admission().check_space(total_size)
+    except AdmissionRejected as e:
+        raise UploadError(e.message, e.status_code)
+
+    folder = get_upload_root_folder(user.id, folder_id)
+
+    upload_session = UploadSession(
+        id=uuid.uuid4().hex,
+        user_id=user.id,
+        folder_id=folder.id,
+        filename=basename,
+        relative_path=relative_path,
+        total_size=total_size,
+        chunk_size=current_app.config.get('UPLOAD_CHUNK_SIZE', 8 * 1024 * 1024),
+        received_size=0,
+        status='active'
+    )
+    upload_session.staging_path = os.path.join(_session_staging_dir(), f'{upload_session.id}.part')
+    upload_session.touch(current_app.config.get('UPLOAD_SESSION_TTL_HOURS', 24))
+
+    # Reserve the whole file up front so chunks can be written at their
+    # offsets in any order
+    fd = os.open(upload_session.staging_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0))
+    try:
+        preallocate(fd, total_size)
+    except OSError as e:
+        os.close(fd)
+        os.remove(upload_session.staging_path)
+        raise UploadError(f'Not enough disk space: {e}', 507)
+    os.close(fd)
+
+    # The quota is held for the session's lifetime, so parallel sessions
+    # can't together exceed it
+    try:
+        upload_session.reservation = reserve_quota(user, total_size, ttl=None)
+    except QuotaExceeded:
+        db.session.rollback()
+        os.remove(upload_session.staging_path)
+        raise UploadError('Not enough storage space', 507)
+
+    db.session.add(upload_session)
+    db.session.commit()
+    return upload_session
+
+def write_upload_chunk(upload_session: UploadSession, index: int, stream: BinaryIO,
+                       content_length: int, expected_digests: dict = None) -> UploadSession:
+    """
+    Write chunk number index at its offset in the session's staging file
+
+    Chunks may arrive in any order and concurrently on separate connections;
+    each request writes its own byte range with positional writes. Re-sending
+    a chunk the server already has is accepted and ignored, so clients can
+    safely retry after a dropped connection.
+
+    Args:
+        upload_session: Active session
+        index: Zero-based chunk number
+        stream: Request body stream
+        content_length: Declared length of the request body
+        expected_digests: Digests the client sent for the chunk, verified as it is written
+
+    Returns:
+        UploadSession: The updated session
+    """
+    if upload_session.status != 'active':
+        raise UploadError('Upload session is not active', 409)
+    if index < 0 or index >= upload_session.total_chunks:
+        raise UploadError('Chunk index out of range')
+
+    expected = upload_session.chunk_length(index)
+    if content_length != expected:
+        raise UploadError(f'Chunk {index} must be {expected} bytes')
+
+    # Already stored (client retried after losing our response)
+    if upload_session.has_chunk(index):
+        return upload_session
+
+    offset = index * upload_session.chunk_size
+    written = 0
+    digests = DigestVerifier(expected_digests)
+    fd = os.open(upload_session.staging_path, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        while written < expected:
+            buf = stream.read(min(COPY_BUFFER_SIZE, expected - written))
+            if not buf:
+                break
+            write_at(fd, buf, offset + written)
+            digests.update(buf)
+            written += len(buf)
+    finally:
+        os.close(fd)
+
+    # A dropped connection or corrupted chunk is not recorded; its range is
+    # simply overwritten when the chunk is sent again
+    if written != expected:
+        raise UploadError(f'Incomplete chunk {index}')
+    try:
+        digests.verify()
+    except DigestMismatch as e:
+        raise UploadError(f'Chunk {index}: {e}')
+
+    db.session.add(UploadChunk(session_id=upload_session.id, index=index, size=written))
+    try:
+        db.session.flush()
+    except IntegrityError:
+        # Another connection stored the same chunk at the same time
+        db.session.rollback()
+        return UploadSession.query.get(upload_session.id)
+
+    # Increment in SQL so concurrent chunk requests don't overwrite each other
+    UploadSession.query.filter_by(id=upload_session.id).update(
+        {UploadSession.received_size: UploadSession.received_size + written},
+        synchronize_session=False
+    )
+    upload_session.touch(current_app.config.get('UPLOAD_SESSION_TTL_HOURS', 24))
+    db.session.commit()
+    db.session.refresh(upload_session)
+    return upload_session
+
+def _check_finalizable(upload_session: UploadSession) -> None:
+    if upload_session.status == 'finalizing':
+        raise UploadError('Upload session is already being finalized', 409)
+    if upload_session.status != 'active':
+        raise UploadError('Upload session is not active', 409)
+    if not upload_session.is_complete():
+        raise UploadError(f'Upload incomplete: {upload_session.received_size} of '
+                          f'{upload_session.total_size} bytes received', 409)
+
+def finalize_upload_session(upload_session: UploadSession, user: User,
+                            expected_digests: dict = None, progress: Callable[[int], None] = None) -> File:
+    """
+    Move a fully received staging file into storage and create its File record
+
+    Args:
+        upload_session: Session whose chunks have all been received
+        user: Owner of the session
+        expected_digests: Digests the client sent for the whole file
+        progress: Called with the number of bytes hashed as hashing proceeds
+
+    Returns:
+        File: The stored file
+    """
+    if upload_session.status == 'completed' and upload_session.file_id:
+        return File.query.get(upload_session.file_id)
+    if upload_session.status != 'finalizing':
+        # Sessions handed to a job were checked when it was queued
+        _check_finalizable(upload_session)
+
+    base_folder = get_upload_root_folder(user.id, upload_session.folder_id)
+    parent_folder, filename = resolve_upload_folder(
+        base_folder, upload_session.relative_path or upload_session.filename, user.id, {}
+    )
+    filename = unique_upload_filename(filename, parent_folder.id, user.id)
+
+    # Chunks arrived out of order, so the content is hashed in one pass here
+    try:
+        sha256, crc32 = hash_file(upload_session.staging_path, expected_digests, progress)
+    except DigestMismatch as e:
+        raise UploadError(str(e))
+    # Chunks were written without syncing; flush the file before it is stored
+    sync_paths([upload_session.staging_path], file_sync())
+
+    try:
+        # The session stops referring to its reservation before it is settled
+        reservation = upload_session.reservation
+        upload_session.reservation = None
+        db.session.flush()
+        # Not packed, so a failed commit can give the data back to the session below
+        blob = store_blob(upload_session.staging_path, sha256, upload_session.total_size, choose_codec(filename),
+                          pack=False, crc32=crc32)
+        new_file = record_uploaded_file(user, parent_folder, filename, blob, reservation=reservation)
+        db.session.flush()
+        upload_session.status = 'completed'
+        upload_session.file_id = new_file.id
+        UploadChunk.query.filter_by(session_id=upload_session.id).delete(synchronize_session=False)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        # Put the data back so the client can retry finalizing, unless an
+        # existing blob already owns that path
+        path = blob_path(sha256)
+        if (not os.path.exists(upload_session.staging_path) and os.path.exists(path)
+                and not Blob.query.filter_by(sha256=sha256).first()):
+            if os.path.getsize(path) == upload_session.total_size:
+                move_file(path, upload_session.staging_path)
+            else:
+                # It was compressed on the way in
+                with open(upload_session.staging_path, 'wb') as out:
+                    for chunk in iter_stored(path, choose_codec(filename)):
+                        out.write(chunk)
+                os.remove(path)
+        if isinstance(e, QuotaExceeded):
+            # Only sessions without a reservation are charged here
+            raise UploadError('Not enough storage space', 507)
+        raise
+    return new_file
+
+def queue_upload_session(upload_session: UploadSession, user: User,
+                         expected_digests: dict = None) -> UploadJob:
+    """
+    Hand a fully received session to a background job that hashes and
+    records it. The session is marked as finalizing in a conditional UPDATE,
+    so a repeated complete request can't start a second job for it.
+
+    Returns:
+        UploadJob: The queued job
+    """
+    _check_finalizable(upload_session)
+    sessions = UploadSession.__table__
+    result = db.session.execute(
+        sessions.update()
+        .where(sessions.c.id == upload_session.id)
+        .where(sessions.c.status == 'active')
+        .values(status='finalizing')
+    )
+    if not result.rowcount:
+        db.session.rollback()
+        raise UploadError('Upload session is already being finalized', 409)
+
+    job = create_upload_job(user.id, 'session', [{'name': upload_session.filename,
+                                                  'size': upload_session.total_size}])
+    db.session.flush()
+    upload_session.job_id = job.id
+    db.session.commit()
+    get_job_runner().submit(job, _finish_upload_session, upload_session.id, user.id, expected_digests)
+    return job
+
+def _finish_upload_session(progress: JobProgress, session_id: str, user_id: int,
+                           expected_digests: dict) -> None:
+    upload_session = UploadSession.query.get(session_id)
+    user = User.query.get(user_id)
+    try:
+        new_file = finalize_upload_session(upload_session, user, expected_digests, progress.add_bytes)
+    except Exception:
+        db.session.rollback()
+        # Let the client retry completing the session
+        UploadSession.query.filter_by(id=session_id, status='finalizing').update({'status': 'active'})
+        db.session.commit()
+        raise
+    progress.file_done(0, count_bytes=False, file_id=new_file.id)
+
+def queue_upload_batch(batch: UploadBatch, user: User, reservation: QuotaReservation = None) -> UploadJob:
+    """
+    Hand the files of a received multipart upload to a background job that
+    stores and records them. The batch must not be used by the request
+    afterwards.
+
+    Returns:
+        UploadJob: The queued job
+    """
+    job = create_upload_job(user.id, 'multipart', batch.describe())
+    db.session.commit()
+    get_job_runner().submit(job, _finish_upload_batch, batch, user.id,
+                            reservation.id if reservation is not None else None)
+    return job
+
+def _finish_upload_batch(progress: JobProgress, batch: UploadBatch, user_id: int, reservation_id: str) -> None:
+    # The batch was built in the request's session; work in this thread's own
+    batch.user = User.query.get(user_id)
+    reservation = QuotaReservation.query.get(reservation_id) if reservation_id else None
+    try:
+        batch.flush(reservation, on_stored=progress.file_done)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        batch.discard()
+        if reservation is not None:
+            release_reservation(reservation)
+            db.session.commit()
+        raise
+
+def abort_upload_session(upload_session: UploadSession) -> None:
+    """Cancel a session and remove its staging file"""
+    try:
+        if os.path.exists(upload_session.staging_path):
+            os.remove(upload_session.staging_path)
+    except Exception as e:
+        print(f"Error removing staging file {upload_session.staging_path}: {e}")
+    upload_session.status = 'aborted'
+    reservation = upload_session.reservation
+    if reservation is not None:
+        upload_session.reservation = None
+        db.session.flush()
+        release_reservation(reservation)
+    UploadChunk.query.filter_by(session_id=upload_session.id).delete(synchronize_session=False)
+    db.session.commit()
+
+def cleanup_expired_upload_sessions() -> int:
+    """
+    Abort sessions that have seen no activity before their expiry time.
+    Sessions being finalized belong to their job; like the job itself (see
+    fail_interrupted_jobs), one is only given up UPLOAD_JOB_TIMEOUT_HOURS
+    after it was queued, and not while its job is still running here.
+
+    Returns:
+        int: Number of sessions cleaned up
+    """
+    now = datetime.utcnow()
+    expired = UploadSession.query.filter(
+        UploadSession.status == 'active',
+        UploadSession.expires_at <= now
+    ).all()
+    runner = get_job_runner()
+    cutoff = now - timedelta(hours=current_app.config.get('UPLOAD_JOB_TIMEOUT_HOURS', 6))
+    stuck = UploadSession.query.filter(
+        UploadSession.status == 'finalizing',
+        UploadSession.updated_at <= cutoff
+    )
+    expired.extend(upload_session for upload_session in stuck
+                   if upload_session.job_id is None or runner.progress(upload_session.job_id) is None)
+    for upload_session in expired:
+        abort_upload_session(upload_session)
+    return len(expired)
@@ -0,0 +1,169 @@
+"""
+Concurrent disk writes for multi-file uploads.
+
+A multipart body arrives as one stream, so its parts are parsed one after
+another on the request thread. Writing and hashing them doesn't have to wait
+for that: each part gets a PipelinedWriter whose data is handed to a shared
+pool of UPLOAD_WRITE_WORKERS threads, one task at a time per file so its
+bytes stay in order. While the request thread parses the next file, earlier
+ones are still being written, and the writes of several files reach the
+disks at the same time. hashlib and file writes release the GIL, so the
+workers run in parallel.
+
+Data waiting for a worker is bounded by UPLOAD_WRITE_BUFFER bytes across all
+requests; a request thread that gets ahead of the disks waits for room.
+"""
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+from flask import current_app
+from app.utils.storage import StorageWriter, SizeLimitExceeded
+
+_FINISH = object()
+_ABORT = object()
+
+class PipelinedWriter:
+    """
+    StorageWriter fed from the request thread and written by the pipeline.
+
+    write() checks the size limit right away and raises SizeLimitExceeded on
+    the request thread, like StorageWriter. Write errors, and DigestMismatch
+    from finish(), surface through wait() and error once the file is done.
+
+    Usage:
+        writer = pipeline.open(path, max_size=limit, hash_algorithms=STORED_DIGESTS)
+        try:
+            for data in part:
+                writer.write(data)
+        except Exception:
+            writer.abort()
+            raise
+        writer.finish()
+        ... more parts ...
+        writer.wait()
+        if writer.error is None:
+            sha256 = writer.hexdigest('sha256')
+    """
+
+    def __init__(self, pipeline: 'WritePipeline', path: str, max_size: int = None,
+                 hash_algorithms: tuple = (), expected_digests: dict = None,
+                 expected_size: int = None, sync: Callable[[list[int]], None] = None) -> None:
+        self.path = path
+        self.max_size = max_size
+        self.size = 0
+        self.error = None
+        self._pipeline = pipeline
+        self._writer = StorageWriter(path, hash_algorithms=hash_algorithms, expected_digests=expected_digests,
+                                     expected_size=expected_size, sync=sync)
+        self._lock = threading.Lock()
+        self._queue = deque()
+        self._scheduled = False
+        self._done = threading.Event()
+
+    def write(self, data: bytes) -> None:
+        if self.error is not None:
+            # Stop reading into a file that can no longer be stored
+            raise self.error
+        if self.max_size is not None and self.size + len(data) > self.max_size:
+            raise SizeLimitExceeded(self.max_size)
+        self.size += len(data)
+        self._pipeline._reserve(len(data))
+        self._enqueue(data)
+
+    def finish(self) -> None:
+        """Close the file and verify its digests once the queued data is written"""
+        self._enqueue(_FINISH)
+
+    def abort(self) -> None:
+        """Discard the file once the queued data is out of the way"""
+        self._enqueue(_ABORT)
+
+    def wait(self, timeout: float = None) -> bool:
+        """Block until finish() or abort() has been carried out"""
+        return self._done.wait(timeout)
+
+    def hexdigest(self, name: str) -> str:
+        return self._writer.hexdigest(name)
+
+    def _enqueue(self, item) -> None:
+        with self._lock:
+            self._queue.append(item)
+            if self._scheduled:
+                return
+            self._scheduled = True
+        self._pipeline._executor.submit(self._drain)
+
+    def _drain(self) -> None:
+        while True:
+            with self._lock:
+                if not self._queue:
+                    self._scheduled = False
+                    return
+                item = self._queue.popleft()
+
+            if item is _FINISH or item is _ABORT:
+                try:
+                    if item is _ABORT:
+                        self._writer.abort()
+                    elif self.error is None:
+                        self._writer.finish()
+                except Exception as e:
+                    self.error = e
+                self._done.set()
+                continue
+
+            try:
+                if self.error is None:
+                    self._writer.write(item)
+            except Exception as e:
+                self.error = e
+                self._writer.abort()
+            finally:
+                self._pipeline._release(len(item))
+
+class WritePipeline:
+    """Thread pool writing upload data, with a bound on the data it buffers"""
+
+    def __init__(self, workers: int = 4, max_buffered: int = 64 * 1024 * 1024) -> None:
+        self.max_buffered = max_buffered
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='upload-write')
+        self._buffered = 0
+        self._condition = threading.Condition()
+
+    def open(self, path: str, max_size: int = None, hash_algorithms: tuple = (),
+             expected_digests: dict = None, expected_size: int = None,
+             sync: Callable[[list[int]], None] = None) -> PipelinedWriter:
+        """
+        Create path and return a writer feeding it through the pipeline.
+        expected_size and sync are passed on to StorageWriter.
+        """
+        return PipelinedWriter(self, path, max_size=max_size, hash_algorithms=hash_algorithms,
+                               expected_digests=expected_digests, expected_size=expected_size, sync=sync)
+
+    def _reserve(self, size: int) -> None:
+        with self._condition:
+            # Always let one block through, however large, so nothing stalls
+            while self._buffered and self._buffered + size > self.max_buffered:
+                self._condition.wait()
+            self._buffered += size
+
+    def _release(self, size: int) -> None:
+        with self._condition:
+            self._buffered -= size
+            self._condition.notify_all()
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait)
+
+def init_write_pipeline(app) -> WritePipeline:
+    """Create the app's upload write pipeline from its configuration"""
+    pipeline = WritePipeline(
+        workers=app.config.get('UPLOAD_WRITE_WORKERS', 4),
+        max_buffered=app.config.get('UPLOAD_WRITE_BUFFER', 64 * 1024 * 1024)
+    )
+    app.extensions['upload_write_pipeline'] = pipeline
+    return pipeline
+
+def get_write_pipeline() -> WritePipeline:
+    return current_app.extensions['upload_write_pipeline']
@@ -0,0 +1,420 @@
+"""
+Streamed ZIP archives for folder downloads.
+
+The archive is written as it is sent, so sizes and CRCs follow each entry's
+data in a data descriptor (ZIP64 ones for entries that may reach 4GB).
+Entries of types that are compressed already (images, video, audio,
+archives, office documents; see should_deflate) are stored as they are,
+everything else is deflated.
+
+Deflating is done by a shared pool of ZIP_COMPRESS_WORKERS threads. An
+entry's data is split into blocks that are compressed independently, each
+primed with the 32KB before it so the ratio stays close to that of a single
+stream, and ending on a sync flush so the pieces join into one deflate
+stream. zlib releases the GIL, so the blocks of one large file or of many
+small ones are compressed on several cores at once while the archive is
+sent in order. Each download keeps at most ZIP_COMPRESS_AHEAD blocks in
+flight.
+
+A StoredArchive is the other kind: nothing is compressed, so the offset of
+every header and every byte of content follows from the members' names,
+sizes and CRCs before anything is read. It has an exact Content-Length and
+any byte range of it can be produced on its own (send_archive), so
+download managers can resume it or fetch parts of it in parallel. CRCs are
+computed while uploads are written and kept in Blob.crc32; content stored
+before that is read once to compute it (flask migrate-storage does this for
+everything ahead of time).
+"""
+import hashlib
+import os
+import struct
+import zlib
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from typing import BinaryIO, Callable, Iterable, Iterator
+from flask import Response, current_app, request
+from app.models.file import File
+from app.utils.bandwidth import shape_chunks
+from app.utils.compression import is_compressible, iter_content, open_stored, stored_location
+from app.utils.downloads import CountingStream
+from app.utils.file_utils import get_file_type
+
+ZIP_BLOCK_SIZE = 1024 * 1024  # Data compressed by one task
+DEFLATE_LEVEL = 6
+DEFLATE_WINDOW = 32 * 1024  # Back-references reach this far, so blocks are primed with it
+# Last block of an entry's deflate stream: an empty final block with fixed codes
+FINAL_BLOCK = b'\x03\x00'
+
+STORED_TYPES = {'image', 'video', 'audio', 'archive'}
+COMPRESSED_EXTENSIONS = {
+    'zip', 'rar', '7z', 'gz', 'tgz', 'bz2', 'xz', 'zst', 'lz4', 'lzma', 'br', 'cab', 'dmg',
+    'docx', 'xlsx', 'pptx', 'odt', 'ods', 'odp', 'epub', 'jar', 'apk', 'pdf', 'woff', 'woff2'
+}
+UNCOMPRESSED_MEDIA = {'bmp', 'tif', 'tiff', 'wav', 'aiff', 'psd', 'ico'}
+
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP_MAX_ENTRIES = 0xFFFF
+LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+DATA_DESCRIPTOR = struct.Struct('<4s3L')
+DATA_DESCRIPTOR64 = struct.Struct('<4sL2Q')
+CENTRAL_HEADER = struct.Struct('<4s6H3L5H2L')
+END_RECORD = struct.Struct('<4s4H2LH')
+END_RECORD64 = struct.Struct('<4sQ2H2L4Q')
+END_LOCATOR64 = struct.Struct('<4sLQL')
+
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+METHOD_STORED = 0
+METHOD_DEFLATED = 8
+FILE_ATTRIBUTES = 0o100644 << 16  # Regular file, rw-r--r--
+
+def should_deflate(filename: str) -> bool:
+    """Whether filename's content is worth deflating, False for already compressed types"""
+    if is_compressible(filename):
+        return True
+    extension = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+    if extension in UNCOMPRESSED_MEDIA:
+        return True
+    if extension in COMPRESSED_EXTENSIONS:
+        return False
+    return get_file_type(filename) not in STORED_TYPES
+
+def dos_datetime(modified: datetime) -> tuple:
+    """(time, date) fields of a ZIP header"""
+    if modified is None or modified.year < 1980:
+        return 0, (1 << 5) | 1  # 1980-01-01 00:00
+    return ((modified.hour << 11) | (modified.minute << 5) | (modified.second // 2),
+            ((modified.year - 1980) << 9) | (modified.month << 5) | modified.day)
+
+def local_header(name: bytes, method: int, flags: int, modified: tuple, crc: int,
+                 compressed_size: int, size: int, zip64: bool) -> bytes:
+    """Local file header; with zip64 the sizes go in a ZIP64 extra field"""
+    extra = b''
+    if zip64:
+        extra = struct.pack('<2H2Q', 1, 16, size, compressed_size)
+        size = compressed_size = ZIP64_LIMIT
+    return LOCAL_HEADER.pack(b'PK\x03\x04', 45 if zip64 else 20, flags, method, *modified,
+                             crc, compressed_size, size, len(name), len(extra)) + name + extra
+
+def data_descriptor(crc: int, compressed_size: int, size: int, zip64: bool) -> bytes:
+    if zip64:
+        return DATA_DESCRIPTOR64.pack(b'PK\x07\x08', crc, compressed_size, size)
+    return DATA_DESCRIPTOR.pack(b'PK\x07\x08', crc, compressed_size, size)
+
+def central_header(name: bytes, method: int, flags: int, modified: tuple, crc: int,
+                   compressed_size: int, size: int, offset: int) -> bytes:
+    """Central directory record; values that don't fit 32 bits go in a ZIP64 extra field"""
+    extra = [value for value in (size, compressed_size, offset) if value >= ZIP64_LIMIT]
+    extra_field = struct.pack(f'<2H{len(extra)}Q', 1, 8 * len(extra), *extra) if extra else b''
+    version = 45 if extra else 20
+    return CENTRAL_HEADER.pack(b'PK\x01\x02', (3 << 8) | version, version, flags, method, *modified, crc,
+                               min(compressed_size, ZIP64_LIMIT), min(size, ZIP64_LIMIT),
+                               len(name), len(extra_field), 0, 0, 0, FILE_ATTRIBUTES,
+                               min(offset, ZIP64_LIMIT)) + name + extra_field
+
+def end_records(count: int, directory_offset: int, directory_size: int) -> bytes:
+    """End of central directory, preceded by its ZIP64 version when needed"""
+    records = b''
+    if count >= ZIP_MAX_ENTRIES or directory_offset >= ZIP64_LIMIT or directory_size >= ZIP64_LIMIT:
+        end64_offset = directory_offset + directory_size
+        records = (END_RECORD64.pack(b'PK\x06\x06', END_RECORD64.size - 12, (3 << 8) | 45, 45, 0, 0,
+                                     count, count, directory_size, directory_offset) +
+                   END_LOCATOR64.pack(b'PK\x06\x07', 0, end64_offset, 1))
+    return records + END_RECORD.pack(b'PK\x05\x06', 0, 0, min(count, ZIP_MAX_ENTRIES),
+                                     min(count, ZIP_MAX_ENTRIES), min(directory_size, ZIP64_LIMIT),
+                                     min(directory_offset, ZIP64_LIMIT), 0)
+
+def _deflate_block(data: bytes, primer: bytes, level: int) -> bytes:
+    """Raw deflate of data that may refer back into primer, ending on a byte boundary"""
+    if primer:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=primer)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+class ZipEntry:
+    """
+    A file to put in a streamed archive
+
+    Args:
+        arcname: Path in the archive
+        chunks: Iterable of the file's content; closed once it has been read
+        size: Size of the content, None if unknown (the entry is then written as ZIP64)
+        modified: Modification time shown by unzip tools
+        deflate: Whether to compress it, by default should_deflate(arcname)
+    """
+
+    def __init__(self, arcname: str, chunks: Iterable[bytes], size: int = None,
+                 modified: datetime = None, deflate: bool = None) -> None:
+        self.arcname = arcname
+        self.chunks = chunks
+        self.size = size
+        self.modified = modified
+        self.deflate = should_deflate(arcname) if deflate is None else deflate
+
+class _Member:
+    """An entry as it is written, for its data descriptor and central directory record"""
+
+    def __init__(self, entry: ZipEntry) -> None:
+        self.name = entry.arcname.replace(os.sep, '/').encode('utf-8')
+        self.method = METHOD_DEFLATED if entry.deflate else METHOD_STORED
+        self.modified = dos_datetime(entry.modified)
+        # Deflate may grow incompressible data a little
+        self.zip64 = entry.size is None or entry.size * (1.05 if entry.deflate else 1) >= ZIP64_LIMIT
+        self.crc = 0
+        self.size = 0
+        self.compressed_size = 0
+        self.offset = 0
+
+    def local_header(self) -> bytes:
+        return local_header(self.name, self.method, FLAG_DATA_DESCRIPTOR | FLAG_UTF8, self.modified,
+                            0, 0, 0, self.zip64)
+
+    def data_descriptor(self) -> bytes:
+        if not self.zip64 and max(self.size, self.compressed_size) >= ZIP64_LIMIT:
+            raise ValueError(f"{self.name.decode('utf-8')} is larger than its declared size")
+        return data_descriptor(self.crc, self.compressed_size, self.size, self.zip64)
+
+    def central_header(self) -> bytes:
+        return central_header(self.name, self.method, FLAG_DATA_DESCRIPTOR | FLAG_UTF8, self.modified,
+                              self.crc, self.compressed_size, self.size, self.offset)
+
+class ZipStreamer:
+    """Thread pool deflating the entries of streamed archives"""
+
+    def __init__(self, workers: int = None, ahead: int = 16, level: int = DEFLATE_LEVEL) -> None:
+        self.ahead = max(ahead, 1)
+        self.level = level
+        self._executor = ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 2,
+                                            thread_name_prefix='zip-compress')
+
+    def stream(self, entries: Iterable[ZipEntry]) -> Iterator[bytes]:
+        """
+        The archive of entries, in chunks. Entries are read one after another
+        as the archive is consumed; closing the iterator early closes the
+        entry being read and drops the blocks compressed ahead.
+        """
+        # Output in order: (kind, bytes or Future, member)
+        pending = deque()
+        members = []
+        position = 0
+
+        def drain(keep: int) -> Iterator[bytes]:
+            nonlocal position
+            while len(pending) > keep:
+                kind, data, member = pending.popleft()
+                if isinstance(data, Future):
+                    data = data.result()
+                if kind == 'header':
+                    member.offset = position
+                    members.append(member)
+                elif kind == 'data':
+                    member.compressed_size += len(data)
+                else:
+                    data = member.data_descriptor()
+                position += len(data)
+                if data:
+                    yield data
+
+        try:
+            for entry in entries:
+                member = _Member(entry)
+                pending.append(('header', member.local_header(), member))
+                primer = b''
+                try:
+                    for chunk in entry.chunks:
+                        member.crc = zlib.crc32(chunk, member.crc)
+                        member.size += len(chunk)
+                        if entry.deflate:
+                            for start in range(0, len(chunk), ZIP_BLOCK_SIZE):
+                                block = chunk[start:start + ZIP_BLOCK_SIZE]
+                                pending.append(('data', self._executor.submit(
+                                    _deflate_block, block, primer, self.level), member))
+                                primer = (primer[len(block):] + block)[-DEFLATE_WINDOW:]
+                        else:
+                            pending.append(('data', chunk, member))
+                        yield from drain(self.ahead)
+                finally:
+                    if hasattr(entry.chunks, 'close'):
+                        entry.chunks.close()
+                if entry.deflate:
+                    pending.append(('data', FINAL_BLOCK, member))
+                pending.append(('descriptor', b'', member))
+            yield from drain(0)
+
+            directory_offset = position
+            directory_size = 0
+            for member in members:
+                record = member.central_header()
+                directory_size += len(record)
+                yield record
+            yield end_records(len(members), directory_offset, directory_size)
+        finally:
+            for _, data, _ in pending:
+                if isinstance(data, Future):
+                    data.cancel()
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait)
+
+class StoredMember:
+    """
+    A file of a StoredArchive
+
+    Args:
+        arcname: Path in the archive
+        size: Size of the content
+        crc32: CRC-32 of the content
+        open_content: Opens the content for reading
+        modified: Modification time shown by unzip tools
+    """
+
+    def __init__(self, arcname: str, size: int, crc32: int, open_content: Callable[[], BinaryIO],
+                 modified: datetime = None) -> None:
+        self.arcname = arcname
+        self.size = size
+        self.crc32 = crc32
+        self.open_content = open_content
+        self.modified = modified
+
+    def iter_range(self, start: int, stop: int) -> Iterator[bytes]:
+        """Bytes start to stop of the content"""
+        with self.open_content() as f:
+            if f.seekable():
+                f.seek(start)
+            else:
+                # Decompressed on the fly; read up to start
+                skip = start
+                while skip > 0:
+                    data = f.read(min(ZIP_BLOCK_SIZE, skip))
+                    if not data:
+                        break
+                    skip -= len(data)
+            remaining = stop - start
+            while remaining > 0:
+                data = f.read(min(ZIP_BLOCK_SIZE, remaining))
+                if not data:
+                    raise ValueError(f"{self.arcname} is shorter than its recorded size")
+                remaining -= len(data)
+                yield data
+
+class StoredArchive:
+    """
+    Store-mode archive laid out before it is sent. Headers take ZIP64 fields
+    only where sizes or offsets need them, so small archives stay readable
+    by old tools.
+    """
+
+    def __init__(self, members: Iterable[StoredMember]) -> None:
+        self._starts = []
+        self._parts = []  # bytes of headers, or a StoredMember for its content
+        position = 0
+        directory = []
+        for member in members:
+            name = member.arcname.replace(os.sep, '/').encode('utf-8')
+            modified = dos_datetime(member.modified)
+            header = local_header(name, METHOD_STORED, FLAG_UTF8, modified, member.crc32,
+                                  member.size, member.size, member.size >= ZIP64_LIMIT)
+            directory.append(central_header(name, METHOD_STORED, FLAG_UTF8, modified, member.crc32,
+                                            member.size, member.size, position))
+            position = self._add(position, header, len(header))
+            position = self._add(position, member, member.size)
+        count = len(directory)
+        directory = b''.join(directory)
+        trailer = directory + end_records(count, position, len(directory))
+        self.size = self._add(position, trailer, len(trailer))
+        # The directory holds every name, date, size and CRC
+        self.etag = hashlib.sha256(trailer).hexdigest()
+
+    def _add(self, position: int, part, length: int) -> int:
+        if length:
+            self._starts.append(position)
+            self._parts.append(part)
+        return position + length
+
+    def iter_range(self, start: int = 0, stop: int = None) -> Iterator[bytes]:
+        """Bytes start to stop of the archive"""
+        stop = self.size if stop is None else min(stop, self.size)
+        index = bisect_right(self._starts, start) - 1
+        while start < stop:
+            part_start, part = self._starts[index], self._parts[index]
+            part_stop = self._starts[index + 1] if index + 1 < len(self._starts) else self.size
+            end = min(stop, part_stop)
+            if isinstance(part, bytes):
+                yield part[start - part_start:end - part_start]
+            else:
+                yield from part.iter_range(start - part_start, end - part_start)
+            start = end
+            index += 1
+
+def stored_member(file, arcname: str) -> StoredMember:
+    """
+    StoredMember for a File. If the CRC-32 of its content isn't known yet,
+    the content is read to compute it and the result is cached on the blob,
+    or on the file itself when it has none, for the caller to commit.
+    """
+    blob = file.blob
+    crc = blob.crc32 if blob is not None else file.crc32
+    if crc is None:
+        crc = 0
+        for chunk in iter_content(file):
+            crc = zlib.crc32(chunk, crc)
+        if blob is not None:
+            blob.crc32 = crc
+        else:
+            # Keeps updated_at, which the archive's headers and ETag depend on
+            File.query.filter_by(id=file.id).update({File.crc32: crc, File.updated_at: file.updated_at},
+                                                    synchronize_session=False)
+    # Looked up now, the body is read after the request's session is gone
+    location = stored_location(file)
+    return StoredMember(arcname, file.size, crc, lambda: open_stored(*location), file.updated_at)
+
+def send_archive(archive: StoredArchive, disposition: str, on_close: Callable[[int], None] = None,
+                 throttle: Callable[[int], None] = None) -> Response:
+    """
+    Response with a StoredArchive, answering conditional and Range requests
+
+    Args:
+        archive: Archive to send
+        disposition: Content-Disposition of the response
+        on_close: Called once with the number of bytes sent, right away with 0
+                  for responses without a body (see send_region)
+        throttle: Bandwidth throttle for the body (see app.utils.bandwidth)
+
+    Returns:
+        Response: 200 or 206 with the (partial) archive, or 304/412 without a body
+    """
+    response = Response(mimetype='application/zip', direct_passthrough=True)
+    response.headers['Content-Disposition'] = disposition
+    response.content_length = archive.size
+    response.cache_control.no_cache = True
+    response.set_etag(archive.etag)
+    # Told on full responses too, so download managers know they may resume
+    response.accept_ranges = 'bytes'
+
+    response = response.make_conditional(request.environ, accept_ranges=True, complete_length=archive.size)
+    start, stop = 0, archive.size
+    if response.status_code == 206:
+        start, stop = response.content_range.start, response.content_range.stop
+    elif response.status_code != 200 or request.method == 'HEAD':
+        if on_close is not None:
+            on_close(0)
+        return response
+
+    body = archive.iter_range(start, stop)
+    if throttle is not None:
+        body = shape_chunks(body, throttle)
+    response.response = CountingStream(body, on_close)
+    return response
+
+def init_zip_streamer(app) -> ZipStreamer:
+    """Create the app's archive compression pool from its configuration"""
+    streamer = ZipStreamer(workers=app.config.get('ZIP_COMPRESS_WORKERS'),
+                           ahead=app.config.get('ZIP_COMPRESS_AHEAD', 16))
+    app.extensions['zip_streamer'] = streamer
+    return streamer
+
+def get_zip_streamer() -> ZipStreamer:
+    return current_app.extensions['zip_streamer']
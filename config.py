@@ -85,6 +85,42 @@ class Config:
     # Upload configuration
     ALLOW_FOLDER_UPLOAD = True
     TEMP_UPLOAD_PATH = str(get_base_storage_path() / 'temp')
+    
+    # Resumable (chunked) upload sessions
+    UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # 8MB per chunk
+    UPLOAD_SESSION_TTL_HOURS = 24  # Abandoned sessions are discarded after this
+    UPLOAD_TEMP_MAX_AGE_HOURS = 6  # Temp files of uploads untouched this long are removed
+    UPLOAD_JOB_TIMEOUT_HOURS = 6  # Unfinished upload jobs are marked failed, and their sessions aborted, after this
+    
+    # Upload admission control (app/utils/admission.py)
+    UPLOAD_MAX_CONCURRENT_PER_USER = 6  # Parallel upload requests per user
+    UPLOAD_MAX_CONCURRENT = 32  # Parallel upload requests in total
+    UPLOAD_MIN_FREE_SPACE = 1024 * 1024 * 1024  # Keep 1GB free on the storage disk
+    UPLOAD_RETRY_AFTER = 5  # Seconds clients are asked to wait when refused
+    DISK_SAMPLE_INTERVAL = 2.0  # Seconds between free space samples
+    UPLOAD_JOB_WORKERS = 2  # Threads finalizing uploads accepted with 202
+    UPLOAD_WRITE_WORKERS = 4  # Threads writing upload data; about one per disk behind UPLOAD_FOLDER
+    UPLOAD_WRITE_BUFFER = 64 * 1024 * 1024  # Upload data waiting to be written, across all requests
+    GROUP_SYNC_WINDOW = 0.005  # Seconds files wait for others to share a flush (storage_durability 'group')
+    
+    # Small-file packs (app/utils/packs.py)
+    PACK_MAX_FILE_SIZE = 64 * 1024  # Blobs up to this size are appended to pack segments; 0 disables packing
+    PACK_SEGMENT_SIZE = 256 * 1024 * 1024  # A new segment is started when the current one would grow past this
+    PACK_COMPACT_RATIO = 0.5  # Sealed segments with less live data than this fraction are rewritten
+    
+    # Downloads sent by the front-end server (app/utils/downloads.py): 'x-accel-redirect'
+    # (Nginx) or 'x-sendfile' (Apache/lighttpd); empty to send them from the app
+    DOWNLOAD_OFFLOAD = os.environ.get('DOWNLOAD_OFFLOAD', '')
+    DOWNLOAD_OFFLOAD_LOCATION = os.environ.get('DOWNLOAD_OFFLOAD_LOCATION', '/protected-files/')  # Internal Nginx location mapped to UPLOAD_FOLDER
+    TRANSFER_LOG_INTERVAL = 2.0  # Seconds between batched inserts of finished downloads' activities
+    
+    # Bandwidth shaping (app/utils/bandwidth.py); the limits are system settings
+    BANDWIDTH_REFRESH_INTERVAL = 5.0  # Seconds before changed limits apply to running transfers
+    BANDWIDTH_BURST_SECONDS = 0.5  # A transfer may send this many seconds' worth of its limit at once
+    
+    # Folder downloads (app/utils/zip_stream.py)
+    ZIP_COMPRESS_WORKERS = os.cpu_count() or 2  # Threads deflating archive entries, shared by all downloads
+    ZIP_COMPRESS_AHEAD = 16  # 1MB blocks a download may have compressed ahead of what has been sent
 
     @staticmethod
     def init_app(app):
@@ -3,6 +3,68 @@
 from app import create_app
 import platform
 from pathlib import Path
+from werkzeug.serving import WSGIRequestHandler
+
+class ContinueOnRead:
+    """wsgi.input that sends "100 Continue" on its first read"""
+
+    def __init__(self, stream, wfile) -> None:
+        self._stream = stream
+        self._wfile = wfile
+        self._continued = False
+
+    def _continue(self) -> None:
+        if not self._continued:
+            self._continued = True
+            self._wfile.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+            self._wfile.flush()
+
+    def read(self, *args):
+        self._continue()
+        return self._stream.read(*args)
+
+    def readline(self, *args):
+        self._continue()
+        return self._stream.readline(*args)
+
+    def readinto(self, buffer):
+        self._continue()
+        return self._stream.readinto(buffer)
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+class DeferredContinueRequestHandler(WSGIRequestHandler):
+    """
+    Request handler that answers "Expect: 100-continue" only once the
+    application starts reading the body. Werkzeug's handler sends it before
+    the application runs, so a client would start transmitting an upload the
+    server is about to refuse (quota, size or admission limits).
+    """
+
+    _expect_continue = False
+
+    def handle_expect_100(self) -> bool:
+        # Called by http.server while parsing the headers; defer the answer
+        self._expect_continue = True
+        return True
+
+    def run_wsgi(self) -> None:
+        if self._expect_continue:
+            # Keep Werkzeug from answering before the application runs
+            del self.headers["Expect"]
+        try:
+            super().run_wsgi()
+        finally:
+            # The handler serves every request of a keep-alive connection
+            self._expect_continue = False
+
+    def make_environ(self):
+        environ = super().make_environ()
+        if self._expect_continue:
+            environ["HTTP_EXPECT"] = "100-continue"
+            environ["wsgi.input"] = ContinueOnRead(environ["wsgi.input"], self.wfile)
+        return environ
 
 if __name__ == '__main__':
     app = create_app()
@@ -35,7 +97,8 @@
             print("Running without HTTPS. Please configure SSL certificates for secure operation.")
             app.run(debug=app.config.get('DEBUG', False), 
                     host=server_host, 
-                    port=server_port)
+                    port=server_port,
+                    request_handler=DeferredContinueRequestHandler)
         else:
             try:
                 context.load_cert_chain(cert_path, key_path)
@@ -43,14 +106,17 @@
                 app.run(debug=app.config.get('DEBUG', False), 
                         host=server_host, 
                         port=server_port, 
-                        ssl_context=context)
+                        ssl_context=context,
+                        request_handler=DeferredContinueRequestHandler)
             except Exception as e:
                 print(f"Error loading SSL certificates: {e}")
                 print("Running without HTTPS. Please check your SSL configuration.")
                 app.run(debug=app.config.get('DEBUG', False), 
                         host=server_host, 
-                        port=server_port)
+                        port=server_port,
+                        request_handler=DeferredContinueRequestHandler)
     else:
         app.run(debug=app.config.get('DEBUG', False), 
                 host=server_host, 
-                port=server_port) 
\ No newline at end of file
+                port=server_port,
+                request_handler=DeferredContinueRequestHandler) 
\ No newline at end of file
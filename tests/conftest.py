@@ -1,6 +1,71 @@
+import os
 import sys
+import tempfile
 from pathlib import Path
 
+import pytest
+
 ROOT = Path(__file__).resolve().parents[1]
 if str(ROOT) not in sys.path:
     sys.path.insert(0, str(ROOT))
+
+
+@pytest.fixture
+def make_app(tmp_path, monkeypatch):
+    """Build the real app on a storage folder and database under tmp_path"""
+    import app as app_package
+
+    # The app's own reference; tests may have reloaded the config module since
+    config = app_package.config
+
+    # create_app points the process's temp directory at TEMP_UPLOAD_PATH
+    for name in ("TMPDIR", "TEMP", "TMP"):
+        if name in os.environ:
+            monkeypatch.setenv(name, os.environ[name])
+        else:
+            monkeypatch.delenv(name, raising=False)
+    monkeypatch.setattr(tempfile, "tempdir", tempfile.tempdir)
+
+    def make(database_uri=None, **settings):
+        storage = tmp_path / "storage"
+        for name in ("uploads", "temp", "trash"):
+            (storage / name).mkdir(parents=True, exist_ok=True)
+        testing = type("TestingConfig", (config["default"],), dict({
+            "TESTING": True,
+            "SECRET_KEY": "test",
+            "SQLALCHEMY_DATABASE_URI": database_uri or f"sqlite:///{tmp_path / 'test.db'}",
+            "UPLOAD_FOLDER": str(storage / "uploads"),
+            "TEMP_UPLOAD_PATH": str(storage / "temp"),
+            "TRASH_PATH": str(storage / "trash"),
+        }, **settings))
+        monkeypatch.setitem(config, "testing", testing)
+        return app_package.create_app("testing")
+
+    return make
+
+
+@pytest.fixture
+def app(make_app):
+    return make_app()
+
+
+@pytest.fixture
+def client(app):
+    """Test client logged in as the default admin"""
+    client = app.test_client()
+    client.post("/login", data={"username": "admin", "password": "admin123"})
+    return client
+
+
+@pytest.fixture
+def upload(client):
+    """Upload {path: bytes} through the multipart form; paths may contain folders"""
+    import io
+
+    def upload(files, folder_id=None, **form):
+        data = {"folder_id": "" if folder_id is None else str(folder_id)}
+        data.update({name: str(value) for name, value in form.items()})
+        data["files[]"] = [(io.BytesIO(content), path) for path, content in files.items()]
+        return client.post("/files/upload", data=data, content_type="multipart/form-data")
+
+    return upload
@@ -0,0 +1,50 @@
+import pytest
+
+from app.utils.admission import AdmissionRejected, UploadAdmission
+
+
+class FakeSampler:
+    def __init__(self, free: int) -> None:
+        self.free_bytes = free
+        self.fresh = True
+
+    def free(self):
+        fresh, self.fresh = self.fresh, False
+        return self.free_bytes, fresh
+
+
+def test_per_user_slots_are_limited_and_released():
+    admission = UploadAdmission(FakeSampler(10**9), max_per_user=2, max_total=10)
+    first = admission.acquire(1)
+    admission.acquire(1)
+
+    with pytest.raises(AdmissionRejected) as excinfo:
+        admission.acquire(1)
+    assert excinfo.value.status_code == 429
+    assert excinfo.value.retry_after
+
+    # Other users still get in, and a released slot can be reused
+    admission.acquire(2)
+    admission.release(first)
+    admission.acquire(1)
+
+
+def test_inflight_bytes_count_against_free_space():
+    admission = UploadAdmission(FakeSampler(1000), min_free_space=100)
+    ticket = admission.acquire(1, 600)
+
+    # Would fit once the running upload is gone: temporary, so retryable
+    with pytest.raises(AdmissionRejected) as excinfo:
+        admission.acquire(2, 400)
+    assert excinfo.value.status_code == 507
+    assert excinfo.value.retry_after
+
+    # Never fits
+    with pytest.raises(AdmissionRejected) as excinfo:
+        admission.acquire(2, 950)
+    assert excinfo.value.retry_after is None
+
+    # Finished uploads stay counted until the disk is sampled again
+    admission.release(ticket)
+    with pytest.raises(AdmissionRejected):
+        admission.acquire(2, 400)
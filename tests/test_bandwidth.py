@@ -0,0 +1,68 @@
+import io
+
+import pytest
+
+from app.utils.bandwidth import SHAPING_CHUNK, ShapedInput, TokenBucket, shape_chunks
+
+
+def test_bucket_allows_a_burst_then_paces_at_its_rate():
+    bucket = TokenBucket(rate=1000, burst=500)
+
+    assert bucket.reserve(500, now=10.0) == 0
+    # Every further 100 bytes take a tenth of a second
+    assert abs(bucket.reserve(100, now=10.0) - 0.1) < 1e-9
+    assert abs(bucket.reserve(100, now=10.0) - 0.2) < 1e-9
+    # Idle time refills it, up to the burst
+    assert bucket.reserve(500, now=20.0) == 0
+
+
+def test_waiting_transfers_take_turns():
+    bucket = TokenBucket(rate=1000, burst=0)
+    waits = {'a': [], 'b': []}
+    for _ in range(3):
+        for name in waits:
+            waits[name].append(bucket.reserve(100, now=0.0))
+
+    # Chunks are granted in the order they were asked for
+    assert [round(w, 2) for w in waits['a']] == [0.1, 0.3, 0.5]
+    assert [round(w, 2) for w in waits['b']] == [0.2, 0.4, 0.6]
+
+
+def test_shaping_passes_data_through_in_small_chunks():
+    granted = []
+    data = bytes(range(256)) * 1000
+
+    assert b"".join(shape_chunks([data], granted.append)) == data
+    assert max(granted) == SHAPING_CHUNK and sum(granted) == len(data)
+
+    granted.clear()
+    assert ShapedInput(io.BytesIO(data), granted.append).read() == data
+    assert max(granted) == SHAPING_CHUNK and sum(granted) == len(data)
+
+
+def test_running_transfers_follow_a_limit_set_later(tmp_path):
+    from app.utils.bandwidth import LIMIT_SETTINGS, BandwidthShaper
+    from app.utils.downloads import FileRegion
+
+    limits = dict.fromkeys(LIMIT_SETTINGS, 0)
+    shaper = BandwidthShaper(None, refresh_interval=0)
+    shaper._load_limits = lambda: dict(limits)
+    throttle = shaper.throttle(1, 'download')
+    data = bytes(range(256)) * 1000
+    path = tmp_path / "file.bin"
+    path.write_bytes(data)
+
+    # No limit: chunks pass whole and a file may go out with sendfile()
+    chunks = shape_chunks(iter([data, data]), throttle)
+    assert next(chunks) == data
+    with FileRegion(str(path), throttle=throttle) as region:
+        assert region.fileno() >= 0
+
+    limits[('download', False)] = 100 * 1024 * 1024
+    rest = list(chunks)
+    assert b"".join(rest) == data and max(len(chunk) for chunk in rest) == SHAPING_CHUNK
+    assert 'download' in shaper._global
+    with FileRegion(str(path), throttle=throttle) as region:
+        with pytest.raises(io.UnsupportedOperation):
+            region.fileno()
+        assert len(region.read(len(data))) == SHAPING_CHUNK
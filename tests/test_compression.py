@@ -0,0 +1,38 @@
+import os
+
+from app.utils.compression import compress_file, is_compressible, open_stored
+
+
+TEXT = b"2024-01-01 12:00:00 INFO request handled in 12ms\n" * 2000
+
+
+def test_compress_file_round_trips(tmp_path):
+    for codec in ("gzip", "lzma"):
+        src = tmp_path / f"{codec}.part"
+        dst = tmp_path / f"{codec}.blob"
+        src.write_bytes(TEXT)
+
+        stored_size = compress_file(str(src), str(dst), codec)
+
+        assert stored_size == os.path.getsize(dst) < len(TEXT)
+        assert not src.exists()
+        with open_stored(str(dst), codec) as f:
+            assert f.read() == TEXT
+
+
+def test_incompressible_data_is_left_raw(tmp_path):
+    src = tmp_path / "random.part"
+    dst = tmp_path / "random.blob"
+    src.write_bytes(os.urandom(100000))
+
+    assert compress_file(str(src), str(dst), "gzip") is None
+    assert src.exists() and not dst.exists()
+    # No partial output is left beside the destination
+    assert os.listdir(tmp_path) == ["random.part"]
+
+
+def test_only_text_like_files_are_compressible():
+    assert is_compressible("server.LOG")
+    assert is_compressible("data.csv")
+    assert not is_compressible("photo.jpg")
+    assert not is_compressible("Makefile")
@@ -0,0 +1,97 @@
+import io
+import os
+import random
+import zlib
+
+import pytest
+
+from app.utils.delta import apply_delta, compute_delta, compute_signature, encode_delta, roll_checksum
+
+
+BLOCK_SIZE = 1024
+
+
+def make_delta(tmp_path, base: bytes, new: bytes):
+    base_path = tmp_path / "base.bin"
+    base_path.write_bytes(base)
+    signature = compute_signature(str(base_path), BLOCK_SIZE)
+    instructions = list(compute_delta(io.BytesIO(new), signature))
+    stream = io.BytesIO(b"".join(encode_delta(instructions, BLOCK_SIZE)))
+    return base_path, instructions, stream
+
+
+def rebuild(base_path, stream):
+    out = io.BytesIO()
+    with open(base_path, "rb") as base:
+        literal_bytes = apply_delta(base, stream, out)
+    return out.getvalue(), literal_bytes
+
+
+def test_rolled_checksum_matches_adler32():
+    data = os.urandom(5000)
+    checksum = zlib.adler32(data[:BLOCK_SIZE])
+    for start in range(1, len(data) - BLOCK_SIZE):
+        checksum = roll_checksum(checksum, data[start - 1], data[start + BLOCK_SIZE - 1], BLOCK_SIZE)
+        assert checksum == zlib.adler32(data[start:start + BLOCK_SIZE])
+
+
+@pytest.mark.parametrize("edit", ["insert", "delete", "overwrite", "append", "truncate"])
+def test_delta_round_trip_only_sends_changed_bytes(tmp_path, edit):
+    rng = random.Random(edit)
+    base = bytes(rng.getrandbits(8) for _ in range(50 * BLOCK_SIZE + 123))
+    new = {
+        "insert": base[:20000] + b"inserted bytes" + base[20000:],
+        "delete": base[:20000] + base[20100:],
+        "overwrite": base[:30000] + b"X" * 10 + base[30010:],
+        "append": base + b"appended tail",
+        "truncate": base[:40000],
+    }[edit]
+
+    base_path, instructions, stream = make_delta(tmp_path, base, new)
+    rebuilt, literal_bytes = rebuild(base_path, stream)
+
+    assert rebuilt == new
+    assert literal_bytes <= 2 * BLOCK_SIZE + 20
+    assert any(op[0] == "copy" for op in instructions)
+
+
+def test_apply_delta_rejects_copy_beyond_base(tmp_path):
+    base_path = tmp_path / "base.bin"
+    base_path.write_bytes(b"a" * BLOCK_SIZE)
+    stream = io.BytesIO(b"".join(encode_delta([("copy", 5, 1)], BLOCK_SIZE)))
+
+    with pytest.raises(ValueError):
+        rebuild(base_path, stream)
+
+
+def test_delta_upload_requires_a_digest_of_the_new_version(tmp_path, app, client, upload):
+    import base64
+    import hashlib
+    from app.models.file import File
+    from app.utils.compression import iter_content
+
+    rng = random.Random(7)
+    base = bytes(rng.getrandbits(8) for _ in range(20 * BLOCK_SIZE))
+    new = base[:5000] + b"an edit in the middle" + base[5000:]
+    upload({"disk.img": base})
+    with app.app_context():
+        file_id = File.query.one().id
+
+    _, _, stream = make_delta(tmp_path, base, new)
+    body = stream.getvalue()
+    url = f"/api/files/{file_id}/delta?base_sha256={hashlib.sha256(base).hexdigest()}"
+    auth = {"Authorization": "Basic admin:admin123"}
+
+    response = client.post(url, data=body, headers=auth)
+    assert response.status_code == 400 and "Digest" in response.get_json()["error"]
+    # Digests of other algorithms don't identify the new version either
+    md5 = base64.b64encode(hashlib.md5(new).digest()).decode()
+    assert client.post(url, data=body, headers=dict(auth, Digest=f"md5={md5}")).status_code == 400
+    with app.app_context():
+        assert b"".join(iter_content(File.query.one())) == base
+
+    sha256 = base64.b64encode(hashlib.sha256(new).digest()).decode()
+    response = client.post(url, data=body, headers=dict(auth, Digest=f"sha-256={sha256}"))
+    assert response.status_code == 200
+    with app.app_context():
+        assert b"".join(iter_content(File.query.one())) == new
@@ -0,0 +1,142 @@
+import os
+
+from flask import Flask
+
+from app.utils.downloads import CountingStream, FileRegion, send_region
+
+
+def test_region_reads_only_its_bytes(tmp_path):
+    path = tmp_path / "segment.pack"
+    path.write_bytes(b"xxxHELLOyyy")
+    sent = []
+
+    with FileRegion(str(path), 3, 5, on_close=sent.append) as region:
+        assert region.read() == b"HELLO"
+        assert region.read() == b""
+        assert region.seek(-2, os.SEEK_END) == 3
+        assert region.read(10) == b"LO"
+        region.seek(100)
+        assert region.tell() == 5
+
+    assert sent == [7]
+
+
+def test_region_handed_to_sendfile_counts_as_sent(tmp_path):
+    path = tmp_path / "blob"
+    path.write_bytes(b"x" * 1000)
+    sent = []
+
+    region = FileRegion(str(path), 200, on_close=sent.append)
+    # A server using sendfile() takes the descriptor where the region starts
+    assert os.lseek(region.fileno(), 0, os.SEEK_CUR) == 200
+    region.close()
+
+    assert sent == [800]
+
+
+def test_counting_stream_reports_what_was_taken():
+    sent = []
+    stream = CountingStream(iter([b"abc", b"defg", b"hi"]), on_close=sent.append)
+
+    body = iter(stream)
+    assert next(body) + next(body) == b"abcdefg"
+    # Client went away before the last chunk
+    stream.close()
+    stream.close()
+
+    assert sent == [7]
+
+
+def test_send_region_answers_ranges_and_conditions(tmp_path):
+    path = tmp_path / "blob"
+    data = os.urandom(10000)
+    path.write_bytes(b"-" * 100 + data)
+    app = Flask(__name__)
+
+    @app.route("/blob")
+    def blob():
+        return send_region(str(path), (100, len(data)), "application/octet-stream",
+                           "attachment", etag="abc")
+
+    client = app.test_client()
+    response = client.get("/blob")
+    assert response.status_code == 200 and response.data == data
+
+    response = client.get("/blob", headers={"Range": "bytes=5000-5999"})
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == "bytes 5000-5999/10000"
+    assert response.data == data[5000:6000]
+
+    assert client.get("/blob", headers={"Range": "bytes=20000-"}).status_code == 416
+    assert client.get("/blob", headers={"If-None-Match": '"abc"'}).status_code == 304
+    # A stale If-Range gets the whole file
+    response = client.get("/blob", headers={"Range": "bytes=0-9", "If-Range": '"old"'})
+    assert response.status_code == 200 and response.data == data
+
+
+def test_send_region_offloads_whole_files(tmp_path):
+    path = tmp_path / "blobs" / "ab" / "cd" / "abcd"
+    path.parent.mkdir(parents=True)
+    path.write_bytes(b"data")
+    app = Flask(__name__)
+    app.config.update(UPLOAD_FOLDER=str(tmp_path), DOWNLOAD_OFFLOAD="x-accel-redirect")
+
+    @app.route("/blob")
+    def blob():
+        return send_region(str(path), None, "text/plain", "inline", etag="abc")
+
+    @app.route("/region")
+    def region():
+        return send_region(str(path), (1, 2), "text/plain", "inline")
+
+    client = app.test_client()
+    response = client.get("/blob")
+    assert response.headers["X-Accel-Redirect"] == "/protected-files/blobs/ab/cd/abcd"
+    assert response.data == b""
+    response = client.get("/blob", headers={"If-None-Match": '"abc"'})
+    assert response.status_code == 304 and "X-Accel-Redirect" not in response.headers
+    # Parts of a file can't be handed over, the app sends them itself
+    response = client.get("/region")
+    assert "X-Accel-Redirect" not in response.headers and response.data == b"at"
+
+
+def test_folder_download_is_recorded_once_sent(app, client, upload):
+    from app.models.activity import Activity
+    from app.models.file import Folder
+
+    upload({"notes.txt": b"some notes\n" * 100, "photo.jpg": os.urandom(5000)})
+    with app.app_context():
+        root = Folder.query.filter_by(user_id=1, parent_id=None).first().id
+
+    response = client.get(f"/files/download_folder/{root}")
+    archive = response.data
+    response.close()
+    # Client went away after the first chunk
+    response = client.get(f"/files/download_folder/{root}", buffered=False)
+    next(iter(response.response))
+    response.close()
+
+    app.extensions["transfer_log"].flush()
+    with app.app_context():
+        rows = Activity.query.filter_by(action="download_folder").order_by(Activity.id).all()
+        assert [(row.bytes_sent, row.completed) for row in rows][0] == (len(archive), True)
+        assert rows[1].completed is False and rows[1].bytes_sent < len(archive)
+
+
+def test_folder_download_records_how_it_was_archived(app, client, upload):
+    from app.models.activity import Activity
+    from app.models.file import Folder
+
+    upload({"notes.txt": b"some notes\n" * 100})
+    with app.app_context():
+        root = Folder.query.filter_by(user_id=1, parent_id=None).first().id
+
+    for query in ("", "?mode=store"):
+        response = client.get(f"/files/download_folder/{root}{query}")
+        response.data
+        response.close()
+
+    app.extensions["transfer_log"].flush()
+    with app.app_context():
+        rows = Activity.query.filter_by(action="download_folder").order_by(Activity.id).all()
+        assert [row.details for row in rows] == ["Streamed folder as zip", "Streamed folder as stored zip"]
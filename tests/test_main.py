@@ -103,3 +103,17 @@ def test_main_falls_back_once_when_cert_load_fails(monkeypatch):
 
     assert len(app.run_calls) == 1
     assert "ssl_context" not in app.run_calls[0]
+
+
+def test_continue_is_sent_on_first_read():
+    import io
+    from main import ContinueOnRead
+
+    wfile = io.BytesIO()
+    stream = ContinueOnRead(io.BytesIO(b"body"), wfile)
+
+    # Nothing is sent until the application reads the body
+    assert wfile.getvalue() == b""
+    assert stream.read(2) == b"bo"
+    assert stream.read() == b"dy"
+    assert wfile.getvalue() == b"HTTP/1.1 100 Continue\r\n\r\n"
@@ -0,0 +1,103 @@
+import io
+import os
+
+import pytest
+
+from app.utils.multipart_stream import MultipartStreamParser
+
+
+BOUNDARY = b"----formboundary7MA4YWxk"
+
+
+def multipart(*parts):
+    """Body with (name, filename or None, data) parts"""
+    body = b""
+    for name, filename, data in parts:
+        body += b"--" + BOUNDARY + b"\r\n"
+        disposition = b'Content-Disposition: form-data; name="' + name.encode() + b'"'
+        if filename is not None:
+            disposition += b'; filename="' + filename.encode() + b'"'
+            disposition += b"\r\nContent-Type: application/octet-stream"
+        body += disposition + b"\r\n\r\n" + data + b"\r\n"
+    return body + b"--" + BOUNDARY + b"--\r\n"
+
+
+def read_all(parser):
+    return [(part.name, part.filename, b"".join(part)) for part in parser]
+
+
+def test_fields_and_several_files_are_streamed_in_order():
+    photo = os.urandom(200000)
+    body = multipart(("folder_id", None, b"12"), ("files[]", "a/notes.txt", b"first file"),
+                     ("files[]", "a/b/photo.jpg", photo), ("files[]", "empty.txt", b""))
+
+    parser = MultipartStreamParser(io.BytesIO(body), BOUNDARY, read_size=4096)
+    parts = iter(parser)
+    field = next(parts)
+    assert field.filename is None and field.read_text() == "12"
+    assert read_all(parts) == [("files[]", "a/notes.txt", b"first file"), ("files[]", "a/b/photo.jpg", photo),
+                               ("files[]", "empty.txt", b"")]
+
+
+@pytest.mark.parametrize("read_size", [1, 3, 7, len(BOUNDARY) + 3])
+def test_boundary_split_across_reads(read_size):
+    # Data that starts like a delimiter must not end the part early
+    tricky = b"line\r\n--" + BOUNDARY[:-1] + b"x\r\n--"
+    body = multipart(("files[]", "a.txt", tricky), ("files[]", "b.txt", b"second"))
+
+    parts = read_all(MultipartStreamParser(io.BytesIO(body), BOUNDARY, read_size=read_size))
+
+    assert parts == [("files[]", "a.txt", tricky), ("files[]", "b.txt", b"second")]
+
+
+def test_unread_parts_are_skipped():
+    body = multipart(("files[]", "a.txt", b"x" * 10000), ("note", None, b"after"))
+
+    parts = list(MultipartStreamParser(io.BytesIO(body), BOUNDARY, read_size=512))
+
+    assert [part.name for part in parts] == ["files[]", "note"]
+
+
+@pytest.mark.parametrize("cut", [10, 200, -len(BOUNDARY) - 6])
+def test_truncated_body_is_an_error(cut):
+    body = multipart(("files[]", "a.txt", b"y" * 150))[:cut]
+
+    with pytest.raises(ValueError):
+        read_all(MultipartStreamParser(io.BytesIO(body), BOUNDARY, read_size=64))
+
+
+def test_oversized_field_is_refused():
+    body = multipart(("folder_id", None, b"1" * 5000), ("files[]", "a.txt", b"data"))
+    parts = iter(MultipartStreamParser(io.BytesIO(body), BOUNDARY, read_size=256))
+
+    with pytest.raises(ValueError, match="too large"):
+        next(parts).read_text(max_size=1024)
+
+
+def test_large_file_part_arrives_in_pieces():
+    data = os.urandom(3 * 65536 + 17)
+    body = multipart(("files[]", "big.bin", data))
+    part = next(iter(MultipartStreamParser(io.BytesIO(body), BOUNDARY, read_size=65536)))
+
+    pieces = list(part)
+
+    assert b"".join(pieces) == data
+    # Never buffered whole; a piece may hold what was kept back from the last read
+    assert len(pieces) > 1 and max(len(piece) for piece in pieces) < 2 * 65536
+
+
+def test_oversized_file_part_is_dropped_while_streaming(app, client, upload):
+    from app.extensions import db
+    from app.models.file import File
+    from app.models.system import SystemSetting
+
+    with app.app_context():
+        SystemSetting.query.filter_by(key="max_upload_size").one().value = "1000"
+        db.session.commit()
+
+    upload({"big.bin": os.urandom(5000), "small.txt": b"fits"})
+
+    with app.app_context():
+        assert [file.original_filename for file in File.query] == ["small.txt"]
+    temp = os.path.join(app.config["UPLOAD_FOLDER"], "blobs", "tmp")
+    assert not os.path.isdir(temp) or os.listdir(temp) == []
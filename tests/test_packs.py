@@ -0,0 +1,28 @@
+from app.utils.compression import compress_data, open_stored
+from app.utils.packs import PackStore, sealed_segments
+
+
+def test_append_rolls_over_to_a_new_segment(tmp_path):
+    store = PackStore(str(tmp_path), segment_size=10)
+
+    first = store.append(b"abcdef")
+    second = store.append(b"gh")
+    third = store.append(b"ijklm")
+
+    assert first[1] == 0 and second == (first[0], 6)
+    assert third[0] != first[0] and third[1] == 0
+    with open(first[0], "rb") as f:
+        assert f.read() == b"abcdefgh"
+    # The full segment is sealed, the one being appended to is not
+    assert sealed_segments(str(tmp_path)) == [first[0]]
+
+
+def test_compressed_data_is_read_back_from_its_region(tmp_path):
+    text = b"log line\n" * 500
+    stored = compress_data(text, "gzip")
+    store = PackStore(str(tmp_path))
+    store.append(b"other blob")
+    path, offset = store.append(stored)
+
+    with open_stored(path, "gzip", (offset, len(stored))) as f:
+        assert f.read() == text
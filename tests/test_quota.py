@@ -0,0 +1,148 @@
+import threading
+from datetime import timedelta
+
+import pytest
+
+
+@pytest.fixture
+def user_id(app):
+    """A user with a 1000 byte quota, 100 bytes of it used"""
+    from app.extensions import db
+    from app.models.user import User
+
+    with app.app_context():
+        user = User(username="carol", email="carol@example.com", storage_quota=1000, storage_used=100)
+        db.session.add(user)
+        db.session.commit()
+        return user.id
+
+
+def usage(user_id):
+    from app.extensions import db
+    from app.models.user import User
+
+    db.session.expire_all()
+    user = db.session.get(User, user_id)
+    return user.storage_used, user.storage_reserved
+
+
+def test_concurrent_reservations_never_exceed_the_quota(app, user_id):
+    from app.extensions import db
+    from app.models.user import User
+    from app.utils.quota import QuotaExceeded, reserve_quota
+
+    start = threading.Barrier(8)
+    outcomes = []
+
+    def reserve():
+        with app.app_context():
+            user = db.session.get(User, user_id)
+            start.wait()
+            try:
+                reserve_quota(user, 250)
+                db.session.commit()
+                outcomes.append(True)
+            except QuotaExceeded:
+                db.session.rollback()
+                outcomes.append(False)
+
+    threads = [threading.Thread(target=reserve) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert outcomes.count(True) == 3
+    with app.app_context():
+        assert usage(user_id) == (100, 750)
+
+
+def test_partial_reservation_takes_what_is_left(app, user_id):
+    from app.extensions import db
+    from app.models.user import User
+    from app.utils.quota import QuotaExceeded, reserve_quota
+
+    with app.app_context():
+        user = db.session.get(User, user_id)
+        assert reserve_quota(user, 5000, partial=True).size == 900
+        db.session.commit()
+        with pytest.raises(QuotaExceeded):
+            reserve_quota(user, 1, partial=True)
+
+
+def test_commit_turns_a_reservation_into_usage(app, user_id):
+    from app.extensions import db
+    from app.models.upload import QuotaReservation
+    from app.models.user import User
+    from app.utils.quota import commit_reservation, reserve_quota
+
+    with app.app_context():
+        user = db.session.get(User, user_id)
+        reservation = reserve_quota(user, 500)
+        db.session.commit()
+        # Less was stored than reserved; the rest goes back
+        commit_reservation(user, reservation, 300)
+        db.session.commit()
+        assert usage(user_id) == (400, 0)
+        assert QuotaReservation.query.count() == 0
+
+
+def test_commit_after_expiry_charges_the_quota_directly(app, user_id):
+    from app.extensions import db
+    from app.models.user import User
+    from app.utils.quota import QuotaExceeded, commit_reservation, expire_reservations, reserve_quota
+
+    with app.app_context():
+        user = db.session.get(User, user_id)
+        late = reserve_quota(user, 300, ttl=timedelta(seconds=-1))
+        lost = reserve_quota(user, 300, ttl=timedelta(seconds=-1))
+        db.session.commit()
+        assert expire_reservations() == 2
+        assert usage(user_id) == (100, 0)
+
+        commit_reservation(user, late, 300)
+        db.session.commit()
+        assert usage(user_id) == (400, 0)
+
+        # Meanwhile another upload took the space the expired reservation held
+        user.storage_used = 900
+        db.session.commit()
+        with pytest.raises(QuotaExceeded):
+            commit_reservation(user, lost, 300)
+
+
+def test_expiry_keeps_live_and_session_reservations(app, user_id):
+    from app.extensions import db
+    from app.models.upload import QuotaReservation
+    from app.models.user import User
+    from app.utils.quota import expire_reservations, reserve_quota
+
+    with app.app_context():
+        user = db.session.get(User, user_id)
+        reserve_quota(user, 100, ttl=timedelta(seconds=-1))
+        live = reserve_quota(user, 200)
+        held = reserve_quota(user, 300, ttl=None)
+        db.session.commit()
+        kept = {live.id, held.id}
+
+        assert expire_reservations() == 1
+        assert {reservation.id for reservation in QuotaReservation.query} == kept
+        assert usage(user_id) == (100, 500)
+        assert expire_reservations() == 0
+
+
+def test_aborted_upload_session_releases_its_reservation(app, client):
+    from app.models.user import User
+
+    response = client.post("/files/upload/sessions", json={"filename": "big.txt", "size": 4096})
+    session_id = response.get_json()["session"]["id"]
+    with app.app_context():
+        used = usage(User.query.filter_by(username="admin").one().id)
+        assert used[1] == 4096
+
+    assert client.delete(f"/files/upload/sessions/{session_id}").status_code == 200
+    with app.app_context():
+        assert usage(User.query.filter_by(username="admin").one().id) == (used[0], 0)
+        # Aborting twice does not give the space back twice
+        client.delete(f"/files/upload/sessions/{session_id}")
+        assert usage(User.query.filter_by(username="admin").one().id) == (used[0], 0)
@@ -0,0 +1,105 @@
+import sqlite3
+
+# Tables as the release before the blob store created them
+OLD_SCHEMA = """
+CREATE TABLE users (
+    id INTEGER NOT NULL, username VARCHAR(64), email VARCHAR(120), password_hash VARCHAR(128),
+    role VARCHAR(20), storage_quota BIGINT, storage_used BIGINT, created_at DATETIME,
+    last_login DATETIME, trash_retention_days INTEGER, PRIMARY KEY (id)
+);
+CREATE UNIQUE INDEX ix_users_email ON users (email);
+CREATE UNIQUE INDEX ix_users_username ON users (username);
+CREATE TABLE folders (
+    id INTEGER NOT NULL, name VARCHAR(255) NOT NULL, parent_id INTEGER, user_id INTEGER NOT NULL,
+    created_at DATETIME, updated_at DATETIME, is_deleted BOOLEAN, deleted_at DATETIME,
+    expiry_date DATETIME, PRIMARY KEY (id)
+);
+CREATE TABLE files (
+    id INTEGER NOT NULL, filename VARCHAR(255) NOT NULL, original_filename VARCHAR(255) NOT NULL,
+    file_path VARCHAR(255) NOT NULL, size BIGINT NOT NULL, file_type VARCHAR(50),
+    user_id INTEGER NOT NULL, folder_id INTEGER, created_at DATETIME, updated_at DATETIME,
+    is_deleted BOOLEAN, deleted_at DATETIME, expiry_date DATETIME, PRIMARY KEY (id)
+);
+CREATE TABLE activities (
+    id INTEGER NOT NULL, user_id INTEGER NOT NULL, action VARCHAR(64) NOT NULL, target VARCHAR(255),
+    details TEXT, ip_address VARCHAR(50), timestamp DATETIME, file_size BIGINT, duration FLOAT,
+    transfer_speed FLOAT, file_type VARCHAR(50), PRIMARY KEY (id)
+);
+INSERT INTO users (id, username, email, password_hash, role, storage_quota, storage_used)
+    VALUES (7, 'old', 'old@example.com', 'x', 'user', 1000, 100);
+INSERT INTO files (id, filename, original_filename, file_path, size, user_id, is_deleted)
+    VALUES (1, 'a.txt', 'a.txt', '/nowhere/a.txt', 100, 7, 0);
+"""
+
+
+def old_database(tmp_path):
+    path = tmp_path / "old.db"
+    with sqlite3.connect(path) as connection:
+        connection.executescript(OLD_SCHEMA)
+    return f"sqlite:///{path}"
+
+
+def columns(app, table):
+    from sqlalchemy import inspect
+    from app.extensions import db
+
+    with app.app_context():
+        return {column["name"] for column in inspect(db.engine).get_columns(table)}
+
+
+def test_app_starts_on_a_database_of_an_older_version(tmp_path, make_app):
+    app = make_app(old_database(tmp_path))
+
+    assert {"blob_id", "sha256"} <= columns(app, "files")
+    client = app.test_client()
+    client.post("/login", data={"username": "admin", "password": "admin123"})
+    assert client.get("/files").status_code == 200
+
+    from app.extensions import db
+    from app.models.file import File
+    with app.app_context():
+        file = db.session.get(File, 1)
+        assert file.blob is None and file.sha256 is None
+
+
+def test_schema_upgrade_is_idempotent(tmp_path, make_app):
+    database = old_database(tmp_path)
+    make_app(database)
+    app = make_app(database)
+
+    from app.models.db_init import upgrade_schema
+    with app.app_context():
+        assert upgrade_schema() == []
+
+
+def test_reserved_quota_is_back_filled(tmp_path, make_app):
+    database = old_database(tmp_path)
+    path = database[len("sqlite:///"):]
+    with sqlite3.connect(path) as connection:
+        # As created by a build where the column was still nullable
+        connection.execute("ALTER TABLE users ADD COLUMN storage_reserved BIGINT")
+    app = make_app(database)
+
+    from app.extensions import db
+    from app.models.user import User
+    from app.utils.quota import reserve_quota
+    with app.app_context():
+        user = db.session.get(User, 7)
+        assert user.storage_reserved == 0
+        reserve_quota(user, 500)
+        db.session.commit()
+        assert user.storage_reserved == 500
+
+
+def test_download_metrics_are_recorded_on_an_older_database(tmp_path, make_app):
+    app = make_app(old_database(tmp_path))
+
+    from app.models.activity import Activity
+    from app.utils.transfer_tracker import DownloadTracker, get_transfer_log
+    with app.app_context():
+        tracker = DownloadTracker(7, "download", "a.txt", 100)
+        tracker.expected = 100
+        tracker.finish(60)
+        assert get_transfer_log().flush() == 1
+        activity = Activity.query.filter_by(action="download").one()
+        assert activity.bytes_sent == 60 and activity.completed is False
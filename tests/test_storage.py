@@ -0,0 +1,119 @@
+import base64
+import errno
+import hashlib
+import os
+import zlib
+
+import pytest
+
+from app.utils import storage
+from app.utils.storage import (STORED_DIGESTS, DigestMismatch, GroupSync, StorageWriter, WRITE_BLOCK_SIZE, copy_file, move_file,
+                               parse_digest_headers)
+
+
+DATA = b"home cloud server" * 100
+
+
+def b64(digest: bytes) -> str:
+    return base64.b64encode(digest).decode()
+
+
+def test_parse_digest_headers_reads_all_header_forms():
+    headers = {
+        "Digest": f"SHA-256={b64(hashlib.sha256(DATA).digest())}, unixsum=30637",
+        "Content-Digest": f"sha-512=:{b64(hashlib.sha512(DATA).digest())}:",
+        "Content-MD5": b64(hashlib.md5(DATA).digest()),
+    }
+
+    assert parse_digest_headers(headers) == {
+        "sha256": hashlib.sha256(DATA).hexdigest(),
+        "sha512": hashlib.sha512(DATA).hexdigest(),
+        "md5": hashlib.md5(DATA).hexdigest(),
+    }
+
+
+def test_parse_digest_headers_rejects_malformed_values():
+    with pytest.raises(ValueError):
+        parse_digest_headers({"Content-MD5": "not-a-digest"})
+
+
+def test_storage_writer_removes_file_on_digest_mismatch(tmp_path):
+    path = tmp_path / "upload.part"
+
+    with pytest.raises(DigestMismatch):
+        with StorageWriter(str(path), expected_digests={"md5": "0" * 32}) as writer:
+            writer.write(DATA)
+
+    assert not path.exists()
+
+
+def test_storage_writer_hashes_in_single_pass(tmp_path):
+    path = tmp_path / "upload.part"
+    expected = {"md5": hashlib.md5(DATA).hexdigest()}
+
+    with StorageWriter(str(path), hash_algorithms=STORED_DIGESTS, expected_digests=expected) as writer:
+        writer.write(DATA[:500])
+        writer.write(DATA[500:])
+
+    assert path.read_bytes() == DATA
+    assert writer.hexdigest("sha256") == hashlib.sha256(DATA).hexdigest()
+    assert writer.hexdigest("crc32") == f"{zlib.crc32(DATA):08x}"
+
+
+def test_move_file_copies_across_filesystems(tmp_path, monkeypatch):
+    src = tmp_path / "src.part"
+    src.write_bytes(DATA)
+    real_replace = os.replace
+
+    def replace(a, b):
+        if a == str(src):
+            raise OSError(errno.EXDEV, "Invalid cross-device link")
+        real_replace(a, b)
+
+    monkeypatch.setattr(storage.os, "replace", replace)
+    move_file(str(src), str(tmp_path / "dst"))
+
+    assert not src.exists()
+    assert (tmp_path / "dst").read_bytes() == DATA
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["dst"]
+
+
+def test_copy_file_falls_back_when_kernel_copy_is_unsupported(tmp_path, monkeypatch):
+    def unsupported(*args):
+        raise OSError(errno.ENOSYS, "Function not implemented")
+
+    monkeypatch.setattr(storage.os, "copy_file_range", unsupported, raising=False)
+    monkeypatch.setattr(storage.os, "sendfile", unsupported, raising=False)
+    (tmp_path / "src").write_bytes(DATA)
+    copy_file(str(tmp_path / "src"), str(tmp_path / "dst"))
+
+    assert (tmp_path / "dst").read_bytes() == DATA
+
+
+def test_storage_writer_trims_allocation_and_syncs_before_close(tmp_path):
+    path = tmp_path / "upload.part"
+    synced = []
+    data = os.urandom(WRITE_BLOCK_SIZE + 1000)
+
+    writer = StorageWriter(str(path), expected_size=4 * WRITE_BLOCK_SIZE, sync=synced.extend)
+    for start in range(0, len(data), 7000):
+        writer.write(data[start:start + 7000])
+    writer.finish()
+
+    # Less data arrived than declared; the file holds exactly what was written
+    assert path.read_bytes() == data
+    assert len(synced) == 1
+
+
+def test_group_sync_flushes_files_together(tmp_path):
+    group = GroupSync(window=0.01)
+    fds = [os.open(str(tmp_path / f"f{i}"), os.O_WRONLY | os.O_CREAT) for i in range(3)]
+    try:
+        group.sync(fds)
+        group.sync(fds[:1])
+    finally:
+        for fd in fds:
+            os.close(fd)
+
+    with pytest.raises(OSError):
+        group.sync([fds[0]])
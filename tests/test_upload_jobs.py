@@ -0,0 +1,26 @@
+from app.utils.upload_jobs import JobProgress
+
+
+def test_progress_counts_each_file_once():
+    progress = JobProgress([{'name': 'a.txt', 'size': 10}, {'name': 'b.txt', 'size': 5}])
+    progress.start()
+    progress.file_done(1, file_id=7)
+    progress.file_done(1)
+
+    state = progress.snapshot()
+    assert state['status'] == 'processing'
+    assert state['processed_files'] == 1
+    assert state['processed_bytes'] == 5
+    assert state['files'][1] == {'name': 'b.txt', 'size': 5, 'status': 'done', 'file_id': 7}
+    assert state['files'][0]['status'] == 'processing'
+
+
+def test_failed_job_reports_every_file_failed():
+    progress = JobProgress([{'name': 'a.txt', 'size': 10}, {'name': 'b.txt', 'size': 5}])
+    progress.start()
+    progress.file_done(0)
+    progress.fail()
+
+    state = progress.snapshot()
+    assert state['status'] == 'failed'
+    assert [file['status'] for file in state['files']] == ['failed', 'failed']
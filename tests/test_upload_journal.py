@@ -0,0 +1,24 @@
+from app.utils.upload_journal import UploadJournal, read_journal
+
+
+def test_journal_keeps_only_open_entries(tmp_path):
+    journal = UploadJournal(str(tmp_path))
+    first = journal.begin(["/blobs/a"])
+    journal.begin(["/blobs/b", "/blobs/c"])
+    journal.end(first)
+
+    # A torn line from a crash mid-write is ignored
+    with open(journal.path, "a") as f:
+        f.write('{"id": "x", "pa')
+
+    entries = read_journal(journal.path)
+    assert [entry["paths"] for entry in entries] == [["/blobs/b", "/blobs/c"]]
+
+
+def test_journal_file_is_removed_once_everything_is_closed(tmp_path):
+    journal = UploadJournal(str(tmp_path))
+    entry = journal.begin(["/blobs/a"])
+    journal.end(entry)
+
+    assert list(tmp_path.iterdir()) == []
+    assert journal.stale_entries(0) == []
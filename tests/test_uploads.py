@@ -0,0 +1,415 @@
+import hashlib
+import os
+
+import pytest
+
+from app.models.user import User
+from app.utils.uploads import (MULTIPART_OVERHEAD_ALLOWANCE, UploadError, check_upload_request,
+                               parse_declared_sizes)
+
+
+MB = 1024 * 1024
+
+
+def make_user(quota: int, used: int = 0, reserved: int = 0) -> User:
+    return User(storage_quota=quota, storage_used=used, storage_reserved=reserved)
+
+
+def test_declared_sizes_are_checked_against_limit_and_quota():
+    user = make_user(quota=100 * MB, used=40 * MB, reserved=10 * MB)
+
+    check_upload_request(user, None, [20 * MB, 30 * MB], max_size=30 * MB)
+
+    with pytest.raises(UploadError) as excinfo:
+        check_upload_request(user, None, [31 * MB], max_size=30 * MB)
+    assert excinfo.value.status_code == 413
+
+    with pytest.raises(UploadError) as excinfo:
+        check_upload_request(user, None, [30 * MB, 30 * MB], max_size=30 * MB)
+    assert excinfo.value.status_code == 507
+
+
+def test_content_length_leaves_room_for_multipart_framing():
+    user = make_user(quota=100 * MB)
+
+    check_upload_request(user, 100 * MB + MULTIPART_OVERHEAD_ALLOWANCE, [], max_size=200 * MB)
+
+    with pytest.raises(UploadError) as excinfo:
+        check_upload_request(user, 50 * 1024 * MB, [], max_size=200 * MB)
+    assert excinfo.value.status_code == 507
+
+    with pytest.raises(UploadError) as excinfo:
+        check_upload_request(user, 60 * MB, [], max_size=50 * MB, single_file=True)
+    assert excinfo.value.status_code == 413
+
+
+def test_parse_declared_sizes_rejects_garbage():
+    assert parse_declared_sizes("1,2,3") == [1, 2, 3]
+    assert parse_declared_sizes(None) == []
+    with pytest.raises(UploadError):
+        parse_declared_sizes("1,-2")
+
+
+CHUNK = 4
+
+
+@pytest.fixture
+def session_client(make_app):
+    """Client logged in as admin on an app with tiny session chunks"""
+    app = make_app(UPLOAD_CHUNK_SIZE=CHUNK)
+    client = app.test_client()
+    client.post("/login", data={"username": "admin", "password": "admin123"})
+    client.application = app
+    return client
+
+
+def start_session(client, filename, size):
+    response = client.post("/files/upload/sessions", json={"filename": filename, "size": size})
+    assert response.status_code == 201
+    return response.get_json()["session"]
+
+
+def put_chunk(client, session_id, index, data):
+    return client.put(f"/files/upload/sessions/{session_id}/chunks/{index}", data=data)
+
+
+def stored_content(app, file_id):
+    from app.extensions import db
+    from app.models.file import File
+    from app.utils.compression import iter_content
+
+    with app.app_context():
+        return b"".join(iter_content(db.session.get(File, file_id)))
+
+
+def test_session_chunks_may_arrive_in_any_order(session_client):
+    data = b"0123456789abcdefgh"
+    upload_session = start_session(session_client, "notes.txt", len(data))
+    assert upload_session["total_chunks"] == 5
+
+    for index in (4, 1, 3):
+        assert put_chunk(session_client, upload_session["id"], index, data[index * CHUNK:][:CHUNK]).status_code == 200
+    status = session_client.get(f"/files/upload/sessions/{upload_session['id']}").get_json()["session"]
+    assert status["received_ranges"] == [[4, 8], [12, 18]] and status["next_chunk"] == 0
+
+    # Finalizing with chunks missing is refused and keeps what was received
+    response = session_client.post(f"/files/upload/sessions/{upload_session['id']}/complete")
+    assert response.status_code == 409 and response.get_json()["session"]["status"] == "active"
+
+    for index in (2, 0):
+        put_chunk(session_client, upload_session["id"], index, data[index * CHUNK:][:CHUNK])
+    response = session_client.post(f"/files/upload/sessions/{upload_session['id']}/complete")
+    assert response.status_code == 200
+    assert stored_content(session_client.application, response.get_json()["file"]["id"]) == data
+
+
+def test_repeated_chunks_are_counted_once(session_client, monkeypatch):
+    from app.models.upload import UploadSession
+
+    upload_session = start_session(session_client, "notes.txt", 8)
+    put_chunk(session_client, upload_session["id"], 0, b"abcd")
+    # A client retry after losing the response
+    response = put_chunk(session_client, upload_session["id"], 0, b"abcd")
+    assert response.status_code == 200 and response.get_json()["session"]["received_size"] == 4
+
+    # Two connections storing the same chunk at once: the unique constraint
+    # on (session, index) lets only one of them count
+    monkeypatch.setattr(UploadSession, "has_chunk", lambda self, index: False)
+    response = put_chunk(session_client, upload_session["id"], 0, b"abcd")
+    assert response.status_code == 200 and response.get_json()["session"]["received_size"] == 4
+
+
+def test_session_sizes_and_offsets_are_validated(session_client):
+    response = session_client.post("/files/upload/sessions", json={"filename": "a.txt", "size": -1})
+    assert response.status_code == 400
+    response = session_client.post("/files/upload/sessions", json={"filename": "a.txt"})
+    assert response.status_code == 400
+
+    upload_session = start_session(session_client, "a.txt", 6)
+    # The last chunk is shorter, every other one is exactly the chunk size
+    assert put_chunk(session_client, upload_session["id"], 0, b"abc").status_code == 400
+    assert put_chunk(session_client, upload_session["id"], 1, b"efgh").status_code == 400
+    assert put_chunk(session_client, upload_session["id"], 2, b"ij").status_code == 400
+    assert put_chunk(session_client, upload_session["id"], -1, b"abcd").status_code == 404
+    status = session_client.get(f"/files/upload/sessions/{upload_session['id']}").get_json()["session"]
+    assert status["received_size"] == 0 and status["received_ranges"] == []
+
+    assert put_chunk(session_client, upload_session["id"], 1, b"ef").status_code == 200
+
+
+@pytest.mark.parametrize("payload", [
+    {"filename": "a.txt", "size": "100"},
+    {"filename": "a.txt", "size": 1.5},
+    {"filename": "a.txt", "size": True},
+    {"filename": 123, "size": 100},
+    {"filename": "a.txt", "size": 100, "relative_path": ["a", "b"]},
+    {"filename": "a.txt", "size": 100, "folder_id": "root"},
+    {"filename": "a.txt", "size": 100, "folder_id": 1.5},
+    ["a.txt", 100],
+])
+def test_session_requests_of_the_wrong_type_are_refused(session_client, payload):
+    from app.models.upload import UploadSession
+
+    response = session_client.post("/files/upload/sessions", json=payload)
+    assert response.status_code == 400 and "error" in response.get_json()
+    with session_client.application.app_context():
+        assert UploadSession.query.count() == 0
+
+def test_expired_sessions_are_aborted_and_release_their_quota(session_client):
+    from datetime import datetime, timedelta
+    from app.extensions import db
+    from app.models.upload import UploadChunk, UploadSession
+    from app.models.user import User
+    from app.utils.uploads import cleanup_expired_upload_sessions
+
+    app = session_client.application
+    stale = start_session(session_client, "stale.txt", 8)
+    fresh = start_session(session_client, "fresh.txt", 8)
+    put_chunk(session_client, stale["id"], 0, b"abcd")
+
+    with app.app_context():
+        assert db.session.get(User, 1).storage_reserved == 16
+        expired = db.session.get(UploadSession, stale["id"])
+        expired.expires_at = datetime.utcnow() - timedelta(minutes=1)
+        db.session.commit()
+        staging_path = expired.staging_path
+
+        assert cleanup_expired_upload_sessions() == 1
+        assert db.session.get(UploadSession, stale["id"]).status == "aborted"
+        assert db.session.get(UploadSession, fresh["id"]).status == "active"
+        assert UploadChunk.query.filter_by(session_id=stale["id"]).count() == 0
+        assert db.session.get(User, 1).storage_reserved == 8
+    assert not os.path.exists(staging_path)
+    assert put_chunk(session_client, stale["id"], 1, b"efgh").status_code == 409
+
+
+def test_sessions_being_finalized_are_left_to_their_job(session_client, monkeypatch):
+    from datetime import datetime, timedelta
+    from app.extensions import db
+    from app.models.upload import UploadSession
+    from app.utils.uploads import cleanup_expired_upload_sessions
+
+    app = session_client.application
+    runner = app.extensions["upload_jobs"]
+    upload_session = start_session(session_client, "big.txt", 8)
+    put_chunk(session_client, upload_session["id"], 0, b"abcd")
+    put_chunk(session_client, upload_session["id"], 1, b"efgh")
+    # Queued, but the worker has not got to it yet
+    monkeypatch.setattr(runner, "submit", lambda *args: None)
+    response = session_client.post(f"/files/upload/sessions/{upload_session['id']}/complete",
+                                   headers={"Prefer": "respond-async"})
+    assert response.status_code == 202
+    job_id = response.get_json()["job"]["id"]
+
+    def age(hours):
+        row = db.session.get(UploadSession, upload_session["id"])
+        row.expires_at = row.updated_at = datetime.utcnow() - timedelta(hours=hours)
+        db.session.commit()
+
+    with app.app_context():
+        assert db.session.get(UploadSession, upload_session["id"]).job_id == job_id
+        # Past its session expiry, but the job may still be hashing a large file
+        age(1)
+        assert cleanup_expired_upload_sessions() == 0
+
+        age(app.config["UPLOAD_JOB_TIMEOUT_HOURS"] + 1)
+        monkeypatch.setattr(runner, "progress", lambda job: {"status": "processing"} if job == job_id else None)
+        assert cleanup_expired_upload_sessions() == 0
+        assert db.session.get(UploadSession, upload_session["id"]).status == "finalizing"
+
+        # The job is gone (the server restarted) and its time is up
+        monkeypatch.undo()
+        assert cleanup_expired_upload_sessions() == 1
+        assert db.session.get(UploadSession, upload_session["id"]).status == "aborted"
+
+@pytest.mark.parametrize("compression", ["none", "gzip"])
+def test_failed_finalize_leaves_the_session_retryable(session_client, monkeypatch, compression):
+    from app.extensions import db
+    from app.models.file import Blob, File
+    from app.models.system import SystemSetting
+    from app.models.upload import UploadSession
+    from app.models.user import User
+    from app.utils import uploads
+    from app.utils.blob_store import blob_path
+
+    app = session_client.application
+    with app.app_context():
+        SystemSetting.query.filter_by(key="storage_compression").one().value = compression
+        db.session.commit()
+    data = b"text that compresses well " * 4
+    upload_session = start_session(session_client, "notes.txt", len(data))
+    for index in range(upload_session["total_chunks"]):
+        put_chunk(session_client, upload_session["id"], index, data[index * CHUNK:][:CHUNK])
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("database went away")
+
+    # Fails after the content was moved into the blob store
+    monkeypatch.setattr(uploads, "record_uploaded_file", fail)
+    with pytest.raises(RuntimeError):
+        session_client.post(f"/files/upload/sessions/{upload_session['id']}/complete")
+
+    with app.app_context():
+        row = db.session.get(UploadSession, upload_session["id"])
+        assert row.status == "active" and row.reservation is not None
+        with open(row.staging_path, "rb") as f:
+            assert f.read() == data
+        assert Blob.query.count() == 0 and File.query.count() == 0
+        assert db.session.get(User, 1).storage_reserved == len(data)
+        assert not os.path.exists(blob_path(hashlib.sha256(data).hexdigest()))
+
+    monkeypatch.undo()
+    response = session_client.post(f"/files/upload/sessions/{upload_session['id']}/complete")
+    assert response.status_code == 200
+    assert stored_content(app, response.get_json()["file"]["id"]) == data
+    with app.app_context():
+        user = db.session.get(User, 1)
+        assert user.storage_reserved == 0 and user.storage_used == len(data)
+
+
+def folder_tree(app):
+    """{path: parent path} of the admin's folders, and {path: content size} of their files"""
+    from app.models.file import File, Folder
+
+    with app.app_context():
+        folders = {folder.id: folder for folder in Folder.query.filter_by(user_id=1)}
+
+        def path(folder_id):
+            folder = folders[folder_id]
+            return folder.name if folder.parent_id is None else f"{path(folder.parent_id)}/{folder.name}"
+
+        files = {f"{path(file.folder_id)}/{file.original_filename}": file.size for file in File.query}
+        return sorted(path(folder_id) for folder_id in folders), files
+
+
+def test_folder_upload_creates_nested_folders_in_one_batch(app, client, upload):
+    from app.models.activity import Activity
+    from app.models.file import Blob
+
+    response = upload({
+        "project/readme.txt": b"read me",
+        "project/src/main.txt": b"main",
+        "project/src/lib/util.txt": b"util",
+        "project/docs/guide.txt": b"read me",
+    }, is_folder_upload="true")
+    assert response.status_code == 302
+
+    folders, files = folder_tree(app)
+    root = folders[0]
+    assert folders == [root, f"{root}/project", f"{root}/project/docs", f"{root}/project/src",
+                       f"{root}/project/src/lib"]
+    assert files == {f"{root}/project/readme.txt": 7, f"{root}/project/src/main.txt": 4,
+                     f"{root}/project/src/lib/util.txt": 4, f"{root}/project/docs/guide.txt": 7}
+    with app.app_context():
+        # Identical content is stored once
+        assert sorted(blob.ref_count for blob in Blob.query) == [1, 1, 2]
+        assert Activity.query.filter_by(action="upload").count() == 4
+
+    # A second upload reuses the folders that now exist
+    upload({"project/src/more.txt": b"more"}, is_folder_upload="true")
+    assert folder_tree(app)[0] == folders
+
+
+def test_names_taken_in_the_same_batch_are_made_unique(app, client, upload):
+    from app.models.file import File
+
+    upload({"a.txt": b"already there"})
+    # Without folder uploads both paths land in the base folder as a.txt
+    upload({"one/a.txt": b"first", "two/a.txt": b"second"})
+
+    with app.app_context():
+        names = {file.original_filename: file.size for file in File.query}
+    assert len(names) == 3 and names.pop("a.txt") == len(b"already there")
+    assert sorted(names.values()) == [5, 6]
+    assert all(name.startswith("a_") and name.endswith(".txt") for name in names)
+
+
+def test_failed_batch_leaves_no_rows_and_releases_the_quota(app, client, upload, monkeypatch):
+    from app.extensions import db
+    from app.models.file import Blob, File, Folder
+    from app.models.user import User
+    from app.utils import uploads
+
+    def fail(filename):
+        raise RuntimeError("disk full")
+
+    # Fails after the folders were inserted and the blobs stored
+    monkeypatch.setattr(uploads, "get_file_type", fail)
+    upload({"project/src/main.txt": b"main", "project/readme.txt": b"read me"}, is_folder_upload="true")
+
+    with app.app_context():
+        assert Folder.query.filter_by(name="project").count() == 0
+        assert File.query.count() == 0 and Blob.query.count() == 0
+        user = db.session.get(User, 1)
+        assert user.storage_used == 0 and user.storage_reserved == 0
+
+    monkeypatch.undo()
+    upload({"project/src/main.txt": b"main", "project/readme.txt": b"read me"}, is_folder_upload="true")
+    assert len(folder_tree(app)[1]) == 2
+
+
+def instant(client, *entries, **payload):
+    response = client.post("/files/upload/instant", json=dict(payload, files=list(entries)))
+    assert response.status_code == 200
+    return response.get_json()["results"]
+
+
+def entry(filename, content, **fields):
+    return dict(filename=filename, size=len(content), sha256=hashlib.sha256(content).hexdigest(), **fields)
+
+
+@pytest.fixture
+def other_client(app):
+    """Client logged in as a second, regular user"""
+    from app.extensions import db
+    from app.models.user import User
+
+    with app.app_context():
+        db.session.add(User(username="bob", email="bob@example.com", password="bob12345", role="user"))
+        db.session.commit()
+    client = app.test_client()
+    client.post("/login", data={"username": "bob", "password": "bob12345"})
+    return client
+
+
+def test_instant_upload_only_matches_the_users_own_content(app, client, upload, other_client):
+    from app.models.file import Blob, File
+
+    content = b"quarterly report" * 100
+    upload({"report.txt": content})
+
+    # Knowing the hash of someone else's file does not give access to it
+    assert instant(other_client, entry("report.txt", content)) == [{"instant": False}]
+    # Nor does a hash with the wrong size
+    assert instant(client, dict(entry("copy.txt", content), size=5)) == [{"instant": False}]
+    with app.app_context():
+        assert File.query.count() == 1 and Blob.query.one().ref_count == 1
+
+
+def test_instant_upload_takes_a_reference_and_charges_the_quota(app, client, upload):
+    from app.extensions import db
+    from app.models.file import Blob, File
+    from app.models.user import User
+
+    content = b"holiday photos" * 1000
+    upload({"photos.txt": content})
+
+    results = instant(client, entry("copy.txt", content), entry("backup/photos.txt", content,
+                                                                  relative_path="backup/photos.txt"),
+                      entry("new.txt", b"not stored yet"))
+
+    assert [result["instant"] for result in results] == [True, True, False]
+    with app.app_context():
+        assert Blob.query.one().ref_count == 3
+        assert db.session.get(User, 1).storage_used == 3 * len(content)
+        assert sorted(file.original_filename for file in File.query) == ["copy.txt", "photos.txt", "photos.txt"]
+
+        # Content that would exceed the quota is refused, the blob is left as it was
+        user = db.session.get(User, 1)
+        user.storage_quota = 3 * len(content) + 10
+        db.session.commit()
+    results = instant(client, entry("one-more.txt", content))
+    assert results == [{"instant": False, "error": "Not enough storage space"}]
+    with app.app_context():
+        assert Blob.query.one().ref_count == 3
+        assert db.session.get(User, 1).storage_used == 3 * len(content)
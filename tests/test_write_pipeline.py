@@ -0,0 +1,46 @@
+import hashlib
+
+import pytest
+
+from app.utils.storage import DigestMismatch, SizeLimitExceeded
+from app.utils.write_pipeline import WritePipeline
+
+
+def test_files_are_written_concurrently_and_in_order(tmp_path):
+    pipeline = WritePipeline(workers=3, max_buffered=1024)
+    writers = []
+    for n in range(5):
+        writer = pipeline.open(str(tmp_path / f"{n}.part"), hash_algorithms=("sha256",))
+        for block in range(50):
+            writer.write(bytes([n]) * 100 + str(block).encode())
+        writer.finish()
+        writers.append(writer)
+
+    for n, writer in enumerate(writers):
+        assert writer.wait(5)
+        expected = b"".join(bytes([n]) * 100 + str(block).encode() for block in range(50))
+        assert writer.error is None
+        assert writer.size == len(expected)
+        assert (tmp_path / f"{n}.part").read_bytes() == expected
+        assert writer.hexdigest("sha256") == hashlib.sha256(expected).hexdigest()
+    pipeline.shutdown()
+
+
+def test_limit_is_enforced_on_the_caller_and_digests_when_finished(tmp_path):
+    pipeline = WritePipeline(workers=2)
+
+    writer = pipeline.open(str(tmp_path / "big.part"), max_size=10)
+    writer.write(b"x" * 10)
+    with pytest.raises(SizeLimitExceeded):
+        writer.write(b"x")
+    writer.abort()
+    assert writer.wait(5)
+    assert not (tmp_path / "big.part").exists()
+
+    writer = pipeline.open(str(tmp_path / "bad.part"), expected_digests={"sha256": "0" * 64})
+    writer.write(b"data")
+    writer.finish()
+    assert writer.wait(5)
+    assert isinstance(writer.error, DigestMismatch)
+    assert not (tmp_path / "bad.part").exists()
+    pipeline.shutdown()
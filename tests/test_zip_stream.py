@@ -0,0 +1,187 @@
+import io
+import os
+import zipfile
+import zlib
+from datetime import datetime
+
+from app.utils.zip_stream import (ZIP_BLOCK_SIZE, StoredArchive, StoredMember, ZipEntry, ZipStreamer,
+                                  should_deflate)
+
+
+def test_compressed_types_are_stored():
+    assert should_deflate("notes.txt")
+    assert should_deflate("scan.bmp")
+    assert not should_deflate("photo.jpg")
+    assert not should_deflate("movie.mp4")
+    assert not should_deflate("backup.zip")
+    assert not should_deflate("report.docx")
+
+
+def test_streamed_archive_reads_back(tmp_path):
+    text = b"".join(b"line %d of the log\n" % i for i in range(200000))
+    assert len(text) > 2 * ZIP_BLOCK_SIZE
+    photo = os.urandom(300000)
+    streamer = ZipStreamer(workers=4, ahead=2)
+
+    archive = b"".join(streamer.stream([
+        ZipEntry("logs/app.log", iter([text[:5000], text[5000:]]), size=len(text),
+                 modified=datetime(2024, 5, 1, 12, 30)),
+        ZipEntry("photo.jpg", iter([photo]), size=len(photo)),
+        ZipEntry("empty.txt", iter([]), size=0),
+    ]))
+    streamer.shutdown()
+
+    with zipfile.ZipFile(io.BytesIO(archive)) as z:
+        assert z.testzip() is None
+        log = z.getinfo("logs/app.log")
+        assert log.compress_type == zipfile.ZIP_DEFLATED and log.compress_size < len(text) // 4
+        assert log.date_time == (2024, 5, 1, 12, 30, 0)
+        assert z.getinfo("photo.jpg").compress_type == zipfile.ZIP_STORED
+        assert z.read("logs/app.log") == text
+        assert z.read("photo.jpg") == photo
+        assert z.read("empty.txt") == b""
+
+
+def test_closing_early_closes_the_entry_being_read():
+    closed = []
+
+    def chunks():
+        try:
+            yield b"a" * 1000
+            yield b"b" * 1000
+        finally:
+            closed.append(True)
+
+    streamer = ZipStreamer(workers=1, ahead=1)
+    archive = streamer.stream([ZipEntry("a.txt", chunks(), size=2000)])
+    next(archive)
+    archive.close()
+    streamer.shutdown()
+
+    assert closed == [True]
+
+
+class ArchiveReader(io.RawIOBase):
+    """Seekable file over a StoredArchive, reading each request as a range"""
+
+    def __init__(self, archive):
+        self.archive = archive
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        base = {os.SEEK_SET: 0, os.SEEK_CUR: self.position, os.SEEK_END: self.archive.size}[whence]
+        self.position = base + pos
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def readinto(self, buffer):
+        data = b"".join(self.archive.iter_range(self.position, self.position + len(buffer)))
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+def _member(path, arcname, crc=None):
+    data = path.read_bytes()
+    return StoredMember(arcname, len(data), zlib.crc32(data) if crc is None else crc,
+                        lambda: open(path, "rb"), datetime(2024, 1, 2, 3, 4, 6))
+
+
+def test_stored_archive_has_exact_size_and_ranges(tmp_path):
+    (tmp_path / "a.txt").write_bytes(b"hello world" * 1000)
+    (tmp_path / "empty").write_bytes(b"")
+    (tmp_path / "b.bin").write_bytes(os.urandom(50000))
+    members = [_member(tmp_path / "a.txt", "docs/a.txt"), _member(tmp_path / "empty", "empty"),
+               _member(tmp_path / "b.bin", "b.bin")]
+    archive = StoredArchive(members)
+
+    whole = b"".join(archive.iter_range())
+    assert len(whole) == archive.size
+    with zipfile.ZipFile(io.BytesIO(whole)) as z:
+        assert z.testzip() is None
+        assert z.read("b.bin") == (tmp_path / "b.bin").read_bytes()
+        assert z.getinfo("docs/a.txt").compress_type == zipfile.ZIP_STORED
+
+    # Any split of the archive adds up to the whole
+    cuts = [0, 1, 29, 11000, 11031, 40000, archive.size - 10, archive.size]
+    parts = [b"".join(archive.iter_range(start, stop)) for start, stop in zip(cuts, cuts[1:])]
+    assert b"".join(parts) == whole
+    # The layout depends only on the members
+    assert StoredArchive(members).etag == archive.etag
+
+
+def test_stored_archive_uses_zip64_past_4gb(tmp_path):
+    big = tmp_path / "big.img"
+    with open(big, "wb") as f:
+        f.truncate(5 * 1024 ** 3)  # Sparse, nothing is written
+    (tmp_path / "small.txt").write_bytes(b"after the big one")
+    archive = StoredArchive([
+        StoredMember("big.img", 5 * 1024 ** 3, 0, lambda: open(big, "rb")),
+        _member(tmp_path / "small.txt", "small.txt"),
+    ])
+
+    with zipfile.ZipFile(ArchiveReader(archive)) as z:
+        assert z.getinfo("big.img").file_size == 5 * 1024 ** 3
+        assert z.getinfo("small.txt").header_offset > 5 * 1024 ** 3
+        assert z.read("small.txt") == b"after the big one"
+
+
+def test_uploads_record_the_crc_of_their_content(app, client, upload):
+    from app.models.file import Blob
+
+    photo = os.urandom(300000)
+    upload({"album/photo.jpg": photo, "album/notes.txt": b"notes\n" * 1000}, is_folder_upload="true")
+
+    with app.app_context():
+        crcs = {blob.size: blob.crc32 for blob in Blob.query}
+        assert crcs == {len(photo): zlib.crc32(photo), 6000: zlib.crc32(b"notes\n" * 1000)}
+
+
+def test_crc_of_files_without_a_blob_is_cached(app, client, upload):
+    from app.extensions import db
+    from app.models.file import File, Folder
+
+    upload({"a.txt": b"legacy content"})
+    with app.app_context():
+        # As stored before the blob store: a file of its own and no blob
+        file = File.query.one()
+        legacy = os.path.join(app.config["UPLOAD_FOLDER"], "legacy.txt")
+        with open(legacy, "wb") as f:
+            f.write(b"legacy content")
+        file.blob_id = None
+        file.file_path = legacy
+        db.session.commit()
+        root = Folder.query.filter_by(user_id=1, parent_id=None).first().id
+        updated_at = file.updated_at
+
+    first = client.get(f"/files/download_folder/{root}?mode=store")
+    with app.app_context():
+        file = File.query.one()
+        assert file.crc32 == zlib.crc32(b"legacy content") and file.updated_at == updated_at
+    second = client.get(f"/files/download_folder/{root}?mode=store")
+    assert second.headers["ETag"] == first.headers["ETag"]
+    with zipfile.ZipFile(io.BytesIO(second.data)) as z:
+        assert z.read("a.txt") == b"legacy content"
+
+
+def test_migrate_storage_fills_missing_crcs(app, client, upload):
+    from app.extensions import db
+    from app.models.file import Blob
+    from app.utils.blob_store import migrate_storage_layout
+
+    text = b"stored by an older version\n" * 500
+    upload({"old.txt": text})
+    with app.app_context():
+        Blob.query.update({Blob.crc32: None})
+        db.session.commit()
+        assert migrate_storage_layout()["crcs_computed"] == 1
+        assert Blob.query.one().crc32 == zlib.crc32(text)
+        assert migrate_storage_layout()["crcs_computed"] == 0